@@ -1,54 +1,567 @@
 # -*- coding: utf-8 -*-
 
-import os, sys, pyinotify, time, re, git
+import os, sys, time, re, git, errno, select, threading, traceback
+from collections import OrderedDict, deque
+from Queue import Queue
 from subprocess import Popen, PIPE
+from trampometro.ignore import IgnoreMatcher
+from trampometro.metrics import Metrics, STATS_FILE, STATS_INTERVAL
+from trampometro.trace import TraceWriter
+from trampometro.store import ActivityStore, STORE_FILE
+from trampometro.sessions import Sessions
+from trampometro import worklog
+from trampometro.worklog import COMPACTION_SIZE, WORKLOG_TEXT, WORKLOG_BINARY, BinaryLog, RECORD
+from trampometro.backends import BACKENDS, BACKEND_INOTIFY
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 DEFAULT_HEARTBEAT = 300
+FLUSH_SIZE = 1024
+FLUSH_INTERVAL = 5
+CATFILE_CACHE_SIZE = 256
+CATFILE_IDLE_TIMEOUT = 60
+DEFAULT_WORKERS = 4
+DISCOVERY_DEPTH = 3
+DISCOVERY_WORKERS = 8
+# Repositories changed this recently are watched first at startup
+ACTIVE_WINDOW = 7 * 24 * 3600
+
+DETECT_OBJECTS = 'objects'
+DETECT_REFLOG = 'reflog'
+# Reflog actions that record a commit made in this repository
+LOCAL_COMMIT_ACTIONS = ('commit', 'cherry-pick', 'revert')
+
+# Worked time goes to meta/worklog, amended into the commit, or to a git note on it
+ANNOTATE_AMEND = 'amend'
+ANNOTATE_NOTES = 'notes'
+NOTES_REF = 'refs/notes/trampometro'
+# Git dir paths never watched: packs and notes are written by fetch, gc and
+# ourselves, never by a commit
+UNWATCHED_GITPATHS = ('objects/pack', 'refs/notes')
+
+# Git dir paths that mean a bulk operation (gc, rebase) has started
+BULK_MARKERS = ('gc.pid', 'rebase-merge', 'rebase-apply')
+# These only mean one when events come faster than BULK_RATE per second,
+# as in a checkout of a distant branch or a large reset
+BULK_LOCKS = ('index.lock', 'ORIG_HEAD')
+BULK_RATE = 200
+# A bulk operation is over when no markers are left and events stopped for this long
+BULK_QUIET = 2
+# or, with markers left, for this long: a rebase stopped on a conflict or edit
+# leaves its marker while the user works, until it is continued
+BULK_STALLED = 30
 DEBUG_LEVEL = 0
 
-class EventHandler(pyinotify.ProcessEvent):
+# Unaffected by tests faking time.time, for measuring how long things take
+clock = time.time
+
+def scan(path):
+    # Returns the subdirectories of path and the names of all its entries.
+    # A directory that vanished is just empty, no matter when it went away.
+    try:
+        if scandir is not None:
+            entries = list(scandir(path))
+            return ([ entry.path for entry in entries if entry.is_dir(follow_symlinks=False) ],
+                    set([ entry.name for entry in entries ]))
+        names = os.listdir(path)
+    except OSError:
+        return [], set()
+    paths = [ os.path.join(path, name) for name in names ]
+    return [ path for path in paths if os.path.isdir(path) and not os.path.islink(path) ], set(names)
+
+def find_gitdir(basedir):
+    dotgit = os.path.join(basedir, '.git')
+    if os.path.isfile(dotgit):
+        # Submodules point to a git directory kept inside the superproject's .git
+        content = open(dotgit).read().strip()
+        if content.startswith('gitdir:'):
+            return os.path.normpath(os.path.join(basedir, content[len('gitdir:'):].strip()))
+    return dotgit
+
+class PathIndex(object):
+
+    def __init__(self):
+        self.root = {}
+
+    def add(self, path, value):
+        node = self.root
+        for part in path.strip('/').split('/'):
+            node = node.setdefault(part, {})
+        node[None] = (path.rstrip('/'), value)
+
+    def remove(self, path):
+        node = self.root
+        for part in path.strip('/').split('/'):
+            node = node.get(part)
+            if node is None:
+                return
+        node.pop(None, None)
+
+    def find(self, path):
+        # Returns (prefix, value) for the longest indexed prefix of path, so
+        # nested repositories win over the ones containing them
+        found = None
+        node = self.root
+        for part in path.strip('/').split('/'):
+            node = node.get(part)
+            if node is None:
+                break
+            found = node.get(None, found)
+        return found
 
-    def __init__(self, monitor):
-        super(EventHandler, self).__init__()
-        self.monitor = monitor
+class WorkerPool(object):
 
-    def process_IN_CREATE(self, event):
-        self.monitor.notify(event.pathname, event.maskname)
-        if os.path.isdir(event.pathname):
-            self.monitor.register_dir(event.pathname)
+    def __init__(self, size=DEFAULT_WORKERS):
+        # Jobs submitted under the same lane run in order, different lanes run in parallel
+        self.lanes = {}
+        self.ready = Queue()
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.jobs = 0
+        self.threads = [ threading.Thread(target=self.work) for i in range(size) ]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
 
-    def process_IN_DELETE(self, event):
-        self.monitor.notify(event.pathname, event.maskname)
+    def submit(self, lane, function, *args):
+        with self.lock:
+            self.jobs += 1
+            if lane in self.lanes:
+                self.lanes[lane].append((function, args))
+                return
+            self.lanes[lane] = deque([(function, args)])
+        self.ready.put(lane)
+
+    def work(self):
+        while True:
+            lane = self.ready.get()
+            if lane is None:
+                return
+            while True:
+                with self.lock:
+                    if not self.lanes[lane]:
+                        del self.lanes[lane]
+                        break
+                    function, args = self.lanes[lane].popleft()
+                try:
+                    function(*args)
+                except Exception:
+                    traceback.print_exc()
+                with self.lock:
+                    self.jobs -= 1
+                    if not self.jobs:
+                        self.idle.notify_all()
+
+    def wait(self):
+        with self.lock:
+            while self.jobs:
+                self.idle.wait()
+
+    def stop(self):
+        for thread in self.threads:
+            self.ready.put(None)
+        for thread in self.threads:
+            thread.join()
+
+class CatFile(object):
+
+    def __init__(self, basedir, metrics=None):
+        self.basedir = basedir
+        self.metrics = metrics or Metrics()
+        self.processes = {}
+        self.types = OrderedDict()
+        self.last_used = time.time()
+
+    def process(self, mode):
+        proc = self.processes.get(mode)
+        if proc is None or proc.poll() is not None:
+            self.metrics.count('git.cat-file')
+            proc = self.processes[mode] = Popen(['git', 'cat-file', mode], cwd=self.basedir,
+                                                stdin=PIPE, stdout=PIPE, close_fds=True)
+        return proc
+
+    def request(self, mode, object_id):
+        self.last_used = time.time()
+        for attempt in range(2):
+            proc = self.process(mode)
+            try:
+                proc.stdin.write('%s\n' % object_id)
+                proc.stdin.flush()
+                header = proc.stdout.readline()
+            except IOError:
+                header = ''
+            if header:
+                return proc, header.split()
+            # Worker died, start a fresh one and try again
+            self.close(mode)
+        raise IOError('git cat-file %s is not responding on %s' % (mode, self.basedir))
+
+    def object_type(self, object_id):
+        try:
+            object_type = self.types.pop(object_id)
+        except KeyError:
+            proc, header = self.request('--batch-check', object_id)
+            object_type = header[1]
+            if object_type == 'missing':
+                return None
+        self.types[object_id] = object_type
+        if len(self.types) > CATFILE_CACHE_SIZE:
+            self.types.popitem(last=False)
+        return object_type
 
-    def process_IN_CLOSE_WRITE(self, event):
-        self.monitor.notify(event.pathname, event.maskname)
+    def contents(self, object_id):
+        proc, header = self.request('--batch', object_id)
+        if header[1] == 'missing':
+            return None
+        data = proc.stdout.read(int(header[2]))
+        proc.stdout.read(1)
+        return data
+
+    def close(self, mode=None):
+        modes = [mode] if mode else self.processes.keys()
+        for mode in modes:
+            proc = self.processes.pop(mode, None)
+            if proc is None:
+                continue
+            try:
+                proc.stdin.close()
+            except IOError:
+                pass
+            proc.wait()
+
+    def close_if_idle(self):
+        if self.processes and not 0 <= time.time() - self.last_used < CATFILE_IDLE_TIMEOUT:
+            self.close()
+
+class NotesWriter(object):
+    """
+    Adds git notes through a persistent git fast-import, which writes
+    objects straight into a pack and never touches the index or the
+    working tree.
+    """
+
+    def __init__(self, basedir, metrics=None, ref=NOTES_REF):
+        self.basedir = basedir
+        self.metrics = metrics or Metrics()
+        self.ref = ref
+        self.proc = None
+        self.last_used = time.time()
+
+    def process(self):
+        if self.proc is None or self.proc.poll() is not None:
+            self.metrics.count('git.fast-import')
+            # Small imports would be unpacked into loose objects, and a reflog
+            # written for the notes ref; both would come back as events
+            self.proc = Popen(['git', '-c', 'fastimport.unpackLimit=0', '-c', 'core.logAllRefUpdates=false',
+                               'fast-import', '--quiet'], cwd=self.basedir,
+                              stdin=PIPE, stdout=PIPE, close_fds=True)
+            # A new fast-import knows nothing of the notes written before
+            tip = Popen(['git', 'rev-parse', '--verify', '-q', self.ref], cwd=self.basedir,
+                        stdout=PIPE, close_fds=True).communicate()[0].strip()
+            self.parent = 'from %s\n' % tip if tip else ''
+        return self.proc
+
+    def add(self, object_id, text):
+        self.last_used = time.time()
+        message = 'Notes added by trampometro\n'
+        proc = self.process()
+        proc.stdin.write('commit %s\n' % self.ref)
+        proc.stdin.write('committer trampometro <trampometro> %d +0000\n' % time.time())
+        proc.stdin.write('data %d\n%s' % (len(message), message))
+        proc.stdin.write(self.parent)
+        proc.stdin.write('N inline %s\n' % object_id)
+        proc.stdin.write('data %d\n%s' % (len(text), text))
+        # Updates the ref; progress is echoed once that is done
+        proc.stdin.write('checkpoint\nprogress %s\n' % object_id)
+        proc.stdin.flush()
+        self.parent = ''
+        if not proc.stdout.readline():
+            self.close()
+            raise IOError('git fast-import failed on %s' % self.basedir)
+
+    def close(self):
+        if self.proc is None:
+            return
+        try:
+            self.proc.stdin.close()
+        except IOError:
+            pass
+        self.proc.wait()
+        self.proc = None
+
+    def close_if_idle(self):
+        if self.proc is not None and not 0 <= time.time() - self.last_used < CATFILE_IDLE_TIMEOUT:
+            self.close()
+
+class WorkAccumulator(object):
+
+    def __init__(self, heartbeat):
+        self.heartbeat = heartbeat
+        self.closed = 0
+        self.start = self.last = None
+
+    def add(self, timestamp, end=None):
+        # end is given for an interval of events from a compacted log
+        if end is None:
+            end = timestamp
+        if self.last is not None and 0 <= timestamp - self.last <= self.heartbeat:
+            self.last = end
+            return
+        if self.last is not None:
+            self.closed += self.last - self.start
+        self.start = timestamp
+        self.last = end
+
+    @property
+    def total(self):
+        if self.start is None:
+            return self.closed
+        return self.closed + self.last - self.start
 
 class Repository(object):
 
-    def __init__(self, basedir):
+    def __init__(self, basedir, metrics=None, store=None, log_format=WORKLOG_TEXT):
         self.basedir = basedir
         self.name = basedir.rpartition('/')[2]
+        self.metrics = metrics or Metrics()
         self.logfile = os.path.join(self.basedir, '.worklog')
-        self.repository = git.Repo(self.basedir)
+        # An ActivityStore in place of .worklog, if given
+        self.store = store
+        # A BinaryLog in place of the text .worklog, if asked for
+        self.binary = None
+        # Set when the log is of another version: it is left alone, and
+        # activity of this repository is no longer logged
+        self.refused = False
+        if log_format == WORKLOG_BINARY and store is None:
+            self.binary = BinaryLog('%s.bin' % self.logfile)
+            if os.path.exists(self.logfile):
+                try:
+                    worklog.convert(self.logfile, self.binary.filename)
+                except ValueError, e:
+                    self.refuse(e)
+            self.logfile = self.binary.filename
+        # Held to append to, clear or put a compacted .worklog in place
+        self.lock = threading.Lock()
+        self.cleared = 0
+        self._repository = None
+        self.gitdir = find_gitdir(self.basedir)
+        self.cat_file = CatFile(self.basedir, self.metrics)
+        self.annotate = ANNOTATE_AMEND
+        self.backend = BACKEND_INOTIFY
+        self.notes = NotesWriter(self.basedir, self.metrics)
+        self.ignore = IgnoreMatcher(self.basedir, self.gitdir)
         self.last_commit = ''
+        self.busy = False
+        # Set once our own commit is logged, for commits made meanwhile to be looked for
+        self.logged = False
+        self.reflog = os.path.join(self.gitdir, 'logs/HEAD')
+        self.reflog_offset = self.reflog_size()
+        self.pending_commits = []
+        # Events counted in the second starting at rate_start
+        self.rate_start = 0
+        self.rate_events = 0
+        # Set while a bulk git operation runs; events are only counted then
+        self.bulk = False
+        self.bulk_events = 0
+        self.bulk_last = 0
+        self.buffer = []
+        self.last_flush = time.time()
+        self.accumulators = {}
+        self.accumulator(DEFAULT_HEARTBEAT)
+        # Only what compaction would shrink counts, so a large log that is
+        # compacted already is not rewritten on every start
+        if self.store is not None or self.refused:
+            self.uncompacted = 0
+        elif self.binary is not None:
+            self.uncompacted = self.binary.uncompacted()
+        else:
+            self.uncompacted = worklog.uncompacted(self.logfile)
+
+    @property
+    def repository(self):
+        # Most repositories never see a commit while we run, so this is built on demand
+        if self._repository is None:
+            self._repository = git.Repo(self.basedir)
+        return self._repository
+
+    def last_modified(self):
+        mtimes = []
+        for path in (self.basedir, self.gitdir, os.path.join(self.gitdir, 'index'), self.logfile):
+            try:
+                mtimes.append(os.stat(path).st_mtime)
+            except OSError:
+                pass
+        return max(mtimes or [0])
 
     @property
     def log(self):
-        try:
-            return [ float(line) for line in open(self.logfile) ]
-        except IOError:
+        self.flush()
+        if self.store is not None:
+            return self.store.timestamps(self.basedir)
+        return worklog.expand(self.intervals)
+
+    @property
+    def intervals(self):
+        # (start, end) of each line of the log, so a compacted log stays small
+        self.flush()
+        if self.store is not None:
+            return [ (timestamp, timestamp) for timestamp in self.store.timestamps(self.basedir) ]
+        if self.refused:
             return []
+        if self.binary is not None:
+            try:
+                return self.binary.intervals()
+            except ValueError, e:
+                self.refuse(e)
+                return []
+        return worklog.read(self.logfile)
+
+    def refuse(self, error):
+        if not self.refused:
+            print >> sys.stderr, "Not logging activity of %s: %s" % (self.basedir, error)
+        self.refused = True
+        self.buffer = []
+        self.uncompacted = 0
+
+    def accumulator(self, heartbeat):
+        try:
+            return self.accumulators[heartbeat]
+        except KeyError:
+            # Only rebuilt from disk the first time a heartbeat is asked for
+            accumulator = self.accumulators[heartbeat] = WorkAccumulator(heartbeat)
+            for start, end in self.intervals:
+                accumulator.add(start, end)
+            return accumulator
 
     def notify(self):
-        open(self.logfile, 'a').write('%.6f\n' % time.time())
+        now = time.time()
+        self.buffer.append(now)
+        for accumulator in self.accumulators.values():
+            accumulator.add(now)
+        self.autoflush()
+
+    def autoflush(self):
+        # Buffered activity is lost on crash, so never keep it longer than FLUSH_INTERVAL
+        if len(self.buffer) >= FLUSH_SIZE or not 0 <= time.time() - self.last_flush < FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        self.last_flush = time.time()
+        if not self.buffer:
+            return
+        self.metrics.observe('flush.events', len(self.buffer))
+        if self.store is not None:
+            self.store.add(self.basedir, self.buffer)
+            self.buffer = []
+            return
+        if self.refused:
+            self.buffer = []
+            return
+        if self.binary is not None:
+            try:
+                with self.lock:
+                    self.binary.append([ (timestamp, timestamp) for timestamp in self.buffer ])
+            except ValueError, e:
+                self.refuse(e)
+                return
+            self.uncompacted += RECORD.size * len(self.buffer)
+            self.buffer = []
+            return
+        data = ''.join([ '%.6f\n' % timestamp for timestamp in self.buffer ])
+        self.buffer = []
+        with self.lock:
+            log = open(self.logfile, 'a')
+            log.write(data)
+            log.close()
+        self.uncompacted += len(data)
+
+    def compact(self):
+        # Run by a worker while events are still appended
+        cleared = self.cleared
+        if self.refused:
+            return
+        if self.binary is not None:
+            try:
+                worklog.compact_binary(self.logfile, self.lock, lambda: self.cleared == cleared)
+            except ValueError, e:
+                self.refuse(e)
+        else:
+            worklog.compact(self.logfile, self.lock, lambda: self.cleared == cleared)
 
     def is_commit(self, object_id):
-        current_dir = os.getcwd()
-        os.chdir(self.basedir)
-        proc = Popen(('git cat-file -t %s' % object_id).split(), stdout=PIPE)
-        proc.wait()
-        os.chdir(current_dir)
-        return proc.stdout.read().strip() == 'commit'
+        return self.cat_file.object_type(object_id) == 'commit'
+
+    def rate(self, now):
+        # Events in the current second, this one included
+        if not 0 <= now - self.rate_start < 1:
+            self.rate_start = now
+            self.rate_events = 0
+        self.rate_events += 1
+        return self.rate_events
+
+    def bulk_running(self):
+        return bool([ path for path in BULK_MARKERS + ('index.lock',)
+                      if os.path.exists(os.path.join(self.gitdir, path)) ])
+
+    def quiet(self):
+        # Nothing buffered, running or waiting that RepositorySet.tick() must see to
+        return not (self.buffer or self.busy or self.logged or self.bulk or self.pending_commits
+                    or self.cat_file.processes or self.notes.proc is not None
+                    or self.uncompacted >= COMPACTION_SIZE)
+
+    def ignores(self, path, isdir=False):
+        # Paths are relative to the repository; .git has its own watch rules
+        if path == '.git' or path.startswith('.git/'):
+            return False
+        return self.ignore.ignored(path, isdir)
+
+    def reflog_size(self):
+        try:
+            return os.path.getsize(self.reflog)
+        except OSError:
+            return 0
+
+    def read_reflog(self):
+        try:
+            reflog = open(self.reflog)
+        except IOError:
+            return
+        reflog.seek(0, os.SEEK_END)
+        if reflog.tell() < self.reflog_offset:
+            # Reflog was expired or rewritten, only entries added from now on count
+            self.reflog_offset = reflog.tell()
+        reflog.seek(self.reflog_offset)
+        data = reflog.read()
+        reflog.close()
+
+        # A partially written entry is left for the next read
+        data = data[:data.rfind('\n') + 1]
+        self.reflog_offset += len(data)
+
+        for line in data.splitlines():
+            header, tab, message = line.partition('\t')
+            action = message.split(':')[0].split(' ')[0]
+            if action in LOCAL_COMMIT_ACTIONS:
+                self.pending_commits.append(header.split()[1])
+            else:
+                # HEAD moved somewhere else, commits before that are not the user's last
+                self.pending_commits = []
+                if DEBUG_LEVEL > 1:
+                    print "Ignoring reflog entry %s" % message
+
+    def reflog_commit(self):
+        self.read_reflog()
+        # The reflog is written just before the ref is updated, so wait for HEAD to catch up
+        if self.pending_commits and self.is_head_commit(self.pending_commits[-1]):
+            commit_id = self.pending_commits[-1]
+            self.pending_commits = []
+            return commit_id
 
     def is_head_commit(self, commit_id):
         if DEBUG_LEVEL > 1:
@@ -58,126 +571,590 @@ class Repository(object):
     def notify_commit(self, object_id):
         if DEBUG_LEVEL > 0:
             print "commit notified on %s" % self.name
-            
-        current_dir = os.getcwd()
-        os.chdir(self.basedir)
-        
+
         worked_time = self.calculate_time()
         self.clear()
+        self.log_commit(object_id, worked_time)
 
-        proc = Popen(('git cat-file -p %s' % object_id).split(), stdout=PIPE)
-        proc.wait()
-        commit_info = proc.stdout.read()
-        author_info = [ line for line in commit_info.split('\n') if line.startswith('author') ][0].split()
+    def git(self, *args):
+        # Never os.chdir: other repositories may be running git at the same time
+        started = clock()
+        proc = Popen(('git',) + args, cwd=self.basedir, stdout=PIPE, close_fds=True)
+        output = proc.communicate()[0]
+        self.metrics.count('git.%s' % args[0])
+        self.metrics.observe('git.us', (clock() - started) * 1e6)
+        return output
+
+    def log_commit(self, object_id, worked_time):
+        if self.annotate == ANNOTATE_NOTES:
+            self.notes.add(object_id, '%s\n' % self.format_time(worked_time))
+            if DEBUG_LEVEL > 0:
+                print "noted %s on %s" % (self.name, self.format_time(worked_time))
+            self.last_commit = object_id
+            return
+
+        commit_info = self.cat_file.contents(object_id)
+        headers, sep, message = commit_info.partition('\n\n')
+        author_info = [ line for line in headers.split('\n') if line.startswith('author') ][0].split()
         author = ' '.join(author_info[1:-2])
+        summary = message.strip().split('\n')[0]
 
-        if not os.path.isdir('meta'):
-            os.mkdir('meta')
-        log = open(os.path.join(self.basedir, 'meta/worklog'), 'a')
+        meta = os.path.join(self.basedir, 'meta')
+        if not os.path.isdir(meta):
+            os.mkdir(meta)
+        log = open(os.path.join(meta, 'worklog'), 'a')
         log.write('\n')
         log.write(author)
         log.write('\n')
         log.write(self.format_time(worked_time))
         log.write('\n')
-        log.write(self.repository.head.commit.summary.encode('utf-8'))
+        log.write(summary)
         log.write('\n')
         log.close()
 
         if DEBUG_LEVEL > 0:
             print "logged %s on %s" % (self.name, self.format_time(worked_time))
-        
-        self.repository.index.add(['meta/worklog'])
-        os.system('git commit --amend -C HEAD >/dev/null')
+
+        self.git('add', 'meta/worklog')
+        self.git('commit', '--amend', '-C', 'HEAD')
 
         self.last_commit = self.repository.head.commit.hexsha
-        
-        os.chdir(current_dir)
 
     def calculate_time(self, heartbeat = DEFAULT_HEARTBEAT):
-        time = 0
-        activity = self.log
-
-        while activity:
-            start = activity.pop(0)
-            current = start
-            while activity and activity[0] - current <= heartbeat and activity[0] >= current:
-                current = activity.pop(0)
-            time += current - start
-
-        return time
+        return self.accumulator(heartbeat).total
 
     def clear(self):
-        open(self.logfile, 'w').close()
+        self.buffer = []
+        self.accumulators = dict([ (heartbeat, WorkAccumulator(heartbeat)) for heartbeat in self.accumulators ])
+        if self.store is not None:
+            self.store.clear(self.basedir)
+            return
+        if self.refused:
+            return
+        try:
+            with self.lock:
+                if self.binary is not None:
+                    self.binary.clear()
+                else:
+                    open(self.logfile, 'w').close()
+                self.cleared += 1
+        except ValueError, e:
+            self.refuse(e)
+            return
+        self.uncompacted = 0
 
     def format_time(self, time):
         return '%02d:%02d:%02d' % (int(time/3600), int((time % 3600) / 60), time % 60)
         
+def find_repositories(basedirs, max_depth=DISCOVERY_DEPTH, load=None):
+    # Walks every base dir in parallel, down to max_depth levels, stopping
+    # at repositories; the ones nested in them are found by watching them.
+    # Results come in base dir order, which decides who keeps the short
+    # name when two base dirs have the same relative path.
+    found = []
+    pool = WorkerPool(DISCOVERY_WORKERS)
+
+    def visit(path, depth, root):
+        if os.path.isdir(os.path.join(path, '.git')):
+            found.append((root, path, load(path) if load else path))
+        elif depth < max_depth and not os.path.islink(path):
+            for subdir in sorted(os.listdir(path)):
+                subdir = os.path.join(path, subdir)
+                if os.path.isdir(subdir):
+                    pool.submit(subdir, visit, subdir, depth + 1, root)
+
+    try:
+        for root, basedir in enumerate(basedirs):
+            pool.submit(basedir, visit, basedir, 0, root)
+        pool.wait()
+    finally:
+        pool.stop()
+    return [ repository for root, path, repository in sorted(found) ]
+
+def repository_name(basedirs, path, taken=()):
+    for basedir in basedirs:
+        if path == basedir:
+            return os.path.basename(path)
+        if path.startswith(basedir + '/'):
+            name = path[len(basedir) + 1:]
+            # Same relative path under two base dirs
+            return path if name in taken else name
+    return path
+
 class RepositorySet(dict):
 
-    def __init__(self, basedir, timeout=10):
-        assert os.path.isdir(basedir)
+    def __init__(self, basedir, timeout=10, commit_detection=DETECT_OBJECTS, background=False,
+                 workers=DEFAULT_WORKERS, max_depth=DISCOVERY_DEPTH, stats_file=None, trace=None,
+                 store=None, annotate=ANNOTATE_AMEND, backend=BACKEND_INOTIFY, backends=None,
+                 log_format=WORKLOG_TEXT, repositories=None, dry_run=False):
+        # basedir is one directory or a list of them
+        basedirs = [basedir] if isinstance(basedir, basestring) else basedir
+        for basedir in basedirs:
+            assert os.path.isdir(basedir)
+        assert commit_detection in (DETECT_OBJECTS, DETECT_REFLOG)
+        assert annotate in (ANNOTATE_AMEND, ANNOTATE_NOTES)
+        self.annotate = annotate
+        assert log_format in (WORKLOG_TEXT, WORKLOG_BINARY)
+        self.log_format = log_format
+        # Commits are only counted, never logged, for replaying traces on real repositories
+        self.dry_run = dry_run
 
-        self.basedir = os.path.realpath(basedir)
-        self.wm = pyinotify.WatchManager()
-        self.mask = pyinotify.IN_DELETE | pyinotify.IN_CREATE  | pyinotify.IN_CLOSE_WRITE
+        self.basedirs = [ os.path.realpath(basedir) for basedir in basedirs ]
+        self.basedir = self.basedirs[0]
+        self.commit_detection = commit_detection
+        # Every raw event goes to this trace file, for trampometro replay
+        self.recorder = TraceWriter(trace) if trace else None
 
-        self.notifier = pyinotify.Notifier(self.wm, EventHandler(self), timeout=timeout)
+        # backends maps repository paths to the backend watching each of
+        # them, backend watches all the others
+        assert backend in BACKENDS
+        self.default_backend = backend
+        self.repository_backends = dict([ (os.path.realpath(path), name) for path, name in (backends or {}).items() ])
+        for name in self.repository_backends.values():
+            assert name in BACKENDS
+        self.timeout = timeout
+        self.backends = OrderedDict()
+        self.backend(backend)
 
-        for subdir in os.listdir(self.basedir):
-            path = os.path.join(self.basedir, subdir)
-            if os.path.isdir(os.path.join(path, '.git')):
-                self[subdir] = Repository(path)
-                self.wm.add_watch(path, self.mask, rec=True)
+        # Paths of repositories, their aliases and git dirs, to find the
+        # innermost repository of a path without touching the filesystem
+        self.index = PathIndex()
+        # wd -> (watched path, index entry of that path, backend watching it)
+        self.watch_index = {}
+        # watched path -> wd
+        self.watched = {}
 
-        self.status = 'IDLE'
-        self.last_activity = time.time()
+        self.metrics = Metrics()
+        # ActivityStore or its filename, for activity kept in SQLite instead of .worklog files
+        self.store = ActivityStore(store) if isinstance(store, basestring) else store
+        # Metrics are written here every STATS_INTERVAL while they change
+        self.stats_file = stats_file
+        self.last_stats = 0
 
-    def register_dir(self, path):
-        self.wm.add_watch(path, self.mask, rec=True)
+        self.timings = OrderedDict()
+        started = clock()
+        def load(path):
+            repository = Repository(path, self.metrics, self.store, self.log_format)
+            repository.mtime = repository.last_modified()
+            return repository
+        if repositories is None:
+            repositories = find_repositories(self.basedirs, max_depth, load)
+            named = {}
+        else:
+            # (name, path) of each repository, found and named by a coordinator
+            named = dict([ (path, name) for name, path in repositories ])
+            paths, repositories = [ path for name, path in repositories ], []
+            for path in paths:
+                try:
+                    repositories.append(load(path))
+                except Exception:
+                    # Skipped, as find_repositories' workers do
+                    traceback.print_exc()
+        self.timings['discovery'] = clock() - started
+
+        # Active repositories get their watches now, the rest from tick()
+        started = clock()
+        self.deferred = deque()
+        now = clock()
+        names = {}
+        for repository in repositories:
+            names[repository] = named.get(repository.basedir) or \
+                repository_name(self.basedirs, repository.basedir, self)
+            self.add_repository(names[repository], repository.basedir, repository)
+        for repository in sorted(repositories, key=lambda repository: -repository.mtime):
+            if now - repository.mtime <= ACTIVE_WINDOW:
+                self.watch_tree(repository.basedir)
+            else:
+                self.deferred.append(names[repository])
+        self.timings['active watches'] = clock() - started
+        self.timings['deferred watches'] = 0
+
+        if DEBUG_LEVEL > 0:
+            print "Found %d repositories, %d to be watched later" % (len(self), len(self.deferred))
+            self.print_timings()
+
+        self.workers = None
+        if background:
+            # Commits are logged in threads, one lane per repository, so event
+            # intake never waits on git
+            self.workers = WorkerPool(workers)
+
+        self.listeners = []
+        self.commit_listeners = []
+        self.session_listeners = []
+        self._status = 'IDLE'
+        # Status goes IDLE when the last open session closes
+        self.sessions = Sessions(DEFAULT_HEARTBEAT, self.session_closed)
+        # Names of repositories tick() has something to do for, starting
+        # with logs left uncompacted by older versions
+        self.live = set([ name for name, repository in self.items() if not repository.quiet() ])
+
+    @property
+    def status(self):
+        return self._status
+
+    @status.setter
+    def status(self, status):
+        if status == self._status:
+            return
+        self._status = status
+        for listener in self.listeners:
+            listener(status)
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def add_commit_listener(self, listener):
+        # Called with repository name, commit id and worked seconds
+        self.commit_listeners.append(listener)
+
+    def add_session_listener(self, listener):
+        # Called with repository name, first and last event time of each session
+        self.session_listeners.append(listener)
+
+    def backend(self, name):
+        # Started the first time a repository needs it
         try:
-            for filename in os.listdir(path):
-                filename = os.path.join(path, filename)
-                self.notify(filename, 'IN_CREATE')
-                if os.path.isdir(filename):
-                    self.register_dir(filename)
-        except OSError:
-            # Directory might have been removed
-            pass
-        
+            return self.backends[name]
+        except KeyError:
+            backend = self.backends[name] = BACKENDS[name](self, self.timeout)
+            return backend
 
-    def notify(self, pathname, maskname = None):
-        if DEBUG_LEVEL > 1:
-            print "%s %s" % (maskname, pathname)
+    def backend_of(self, path):
+        found = self.index.find(path)
+        if found is None:
+            return self.backend(self.default_backend)
+        return self.backend(self[found[1][0]].backend)
+
+    @property
+    def wm(self):
+        return self.backend(BACKEND_INOTIFY).wm
+
+    @property
+    def notifier(self):
+        return self.backend(BACKEND_INOTIFY).notifier
+
+    def filenos(self):
+        # Descriptors to wait on for events; polled repositories have none
+        return [ fd for fd in [ backend.fileno() for backend in self.backends.values() ] if fd is not None ]
+
+    def fileno(self):
+        filenos = self.filenos()
+        return filenos[0] if filenos else None
+
+    def watch_deferred(self):
+        started = clock()
+        name = self.deferred.popleft()
+        if name in self:
+            self.watch_tree(self[name].basedir, self.watched)
+            # Commits made before the watches were in place
+            self.check_reflog(name)
+        self.timings['deferred watches'] += clock() - started
+        if DEBUG_LEVEL > 0 and not self.deferred:
+            self.print_timings()
+
+    def print_timings(self):
+        for phase, seconds in self.timings.items():
+            print "%-20s %8.3fs" % (phase, seconds)
 
-        if pathname.endswith('.worklog'):
+    def add_repository(self, name, path, repository=None):
+        repository = self[name] = repository or Repository(path, self.metrics, self.store, self.log_format)
+        repository.annotate = self.annotate
+        repository.backend = self.repository_backends.get(path, self.default_backend)
+        self.index.add(path, (name, False))
+        realpath = os.path.realpath(path)
+        if realpath != path:
+            # Symlinked checkout, events may come under either path
+            self.index.add(realpath, (name, False))
+        if not repository.gitdir.startswith(path + '/'):
+            self.index.add(repository.gitdir, (name, True))
+        return repository
+
+    def watch_repository(self, name, path):
+        # A repository that appeared while running
+        repository = self.add_repository(name, path)
+        self.watch_tree(path, self.watched)
+        if not repository.gitdir.startswith(path + '/'):
+            self.watch_tree(repository.gitdir, self.watched)
+        self.check_reflog(name)
+
+    def unwatch_repository(self, name):
+        if name not in self:
             return
+        self.unwatch_tree(self[name].basedir)
+        if name in self:
+            self.remove_repository(name)
 
-        pathname = os.path.realpath(pathname).replace('%s/' % self.basedir, '')
-        repository = pathname.split('/')[0]
+    def remove_repository(self, name):
+        repository = self.pop(name)
+        self.live.discard(name)
+        for path in (repository.basedir, os.path.realpath(repository.basedir), repository.gitdir):
+            found = self.index.find(path)
+            if found and found[0] == path and found[1][0] == name:
+                self.index.remove(path)
+        repository.cat_file.close()
 
+    def resolve(self, path, wd=None):
+        """
+        Returns the repository name for path, path relative to the repository's
+        working tree (None for a git dir outside of it) and path relative to its
+        git dir (None outside of the git dir).
+        """
         try:
-            self[repository].notify()
-            if '/.git/' not in pathname and not re.search('meta(/worklog)?$', pathname):
-                self.status = 'Working on %s' % repository
-            self.last_activity = time.time()
-            
+            found = self.watch_index[wd][1]
         except KeyError:
+            found = self.index.find(path)
+            if found is None:
+                realpath = os.path.realpath(path)
+                if realpath != path:
+                    found = self.index.find(realpath)
+                    path = realpath
+        if found is None:
+            return None, None, None
+
+        prefix, (name, gitdir) = found
+        relative = path[len(prefix) + 1:]
+        if gitdir:
+            return name, None, relative
+        if relative == '.git' or relative.startswith('.git/'):
+            return name, relative, relative[5:]
+        return name, relative, None
+
+    def excluded(self, path):
+        repository, relative, gitpath = self.resolve(path)
+        if repository is None:
+            return False
+        if gitpath is None:
+            return bool(relative) and self[repository].ignores(relative, True)
+        if [ prefix for prefix in UNWATCHED_GITPATHS if (gitpath + '/').startswith(prefix + '/') ]:
+            return True
+        if self.commit_detection != DETECT_REFLOG:
+            return False
+        # Inside the git dir only HEAD, logs/HEAD and refs/ are needed to see commits
+        return gitpath not in ('', 'logs', 'refs') and not gitpath.startswith('refs/')
+
+    def rewatch(self, repository):
+        basedir = self[repository].basedir
+        for wd, (path, found, backend) in self.watch_index.items():
+            if path.startswith(basedir + '/') and self.excluded(path):
+                backend.rm_watch(wd)
+                self.forget(wd)
+        self.watch_tree(basedir, self.watched)
+
+    def watch_tree(self, path, watched=()):
+        # Each directory is watched before it is listed, so whatever is created
+        # in it afterwards shows up as an event
+        directories = []
+        pending = [path]
+        while pending:
+            directory = pending.pop()
+            if self.excluded(directory):
+                continue
+            if directory not in watched:
+                backend = self.backend_of(directory)
+                wd = backend.add_watch(directory)
+                if wd is None:
+                    continue
+            subdirs, names = scan(directory)
+
+            found = self.index.find(directory)
+            if '.git' in names and (found is None or found[0] != directory):
+                self.discover(directory)
+                found = self.index.find(directory)
+            if directory not in watched:
+                if wd in self.watch_index:
+                    self.watched.pop(self.watch_index[wd][0], None)
+                self.watch_index[wd] = (directory, found, backend)
+                self.watched[directory] = wd
+
+            directories.append(directory)
+            pending.extend(subdirs)
+        return directories
+
+    def discover(self, path):
+        # A repository inside another one: a submodule or a nested checkout
+        if not os.path.isfile(os.path.join(find_gitdir(path), 'HEAD')):
+            return
+        name = repository_name(self.basedirs, path, self)
+        repository = self.add_repository(name, path)
+        if DEBUG_LEVEL > 0:
+            print "Found repository %s" % name
+        if not repository.gitdir.startswith(path + '/') and repository.gitdir not in self.watched:
+            self.watch_tree(repository.gitdir)
+
+    def gitdir_created(self, path):
+        # path got its .git while watched, by git init, clone or submodule
+        # update; its watches were resolved to the repository containing it
+        found = self.index.find(path)
+        if found is not None and found[0] == path:
+            return
+        self.discover(path)
+        found = self.index.find(path)
+        if found is None or found[0] != path:
+            # No HEAD yet, its creation comes next
+            return
+        name = found[1][0]
+        prefixes = (path + '/', self[name].gitdir + '/')
+        for wd, (watched, entry, backend) in self.watch_index.items():
+            if watched == path or watched.startswith(prefixes):
+                self.watch_index[wd] = (watched, self.index.find(watched), backend)
+        self.rewatch(name)
+
+    def forget(self, wd):
+        path, found, backend = self.watch_index.pop(wd, (None, None, None))
+        if self.watched.get(path) == wd:
+            del self.watched[path]
+        if found and found[0] == path and not found[1][1] and found[1][0] in self:
+            # The repository itself is gone
+            self.remove_repository(found[1][0])
+
+    def moved(self, wd):
+        if wd not in self.watch_index:
+            return
+        old_path, found, backend = self.watch_index[wd]
+        new_path = backend.moved_path(wd)
+        self.unwatch_tree(old_path)
+        if new_path is not None:
+            # Still inside the tree, the backend knows where it went
+            self.register_dir(new_path)
+
+    def unwatch_tree(self, path):
+        # path was moved away or deleted, and everything below it with it
+        if path not in self.watched:
+            return
+        for wd, (watched, found, backend) in self.watch_index.items():
+            if watched == path or watched.startswith(path + '/'):
+                backend.rm_watch(wd)
+                self.forget(wd)
+
+    def register_dir(self, path):
+        # The creation event of path itself was already logged as activity
+        for directory in self.watch_tree(path):
+            repository, relative, gitpath = self.resolve(directory)
+            if gitpath and re.match('objects/[0-9a-f]{2}$', gitpath):
+                # Objects may have been written before their directory was watched
+                try:
+                    filenames = os.listdir(directory)
+                except OSError:
+                    continue
+                for filename in filenames:
+                    self.detect_commit(repository, '%s/%s' % (gitpath, filename), 'IN_CREATE')
+
+    def notify(self, pathname, maskname = None, wd = None):
+        started = clock()
+        self.metrics.count('events.%s' % maskname)
+        try:
+            self.handle(pathname, maskname, wd)
+        finally:
+            self.metrics.observe('notify.us', (clock() - started) * 1e6)
+
+    def handle(self, pathname, maskname, wd):
+        if DEBUG_LEVEL > 1:
+            print "%s %s" % (maskname, pathname)
+
+        if pathname.rpartition('/')[2].startswith('.worklog'):
+            # The log itself, or the file it is compacted to
+            self.metrics.count('events.dropped.worklog')
+            return
+        if (pathname.endswith('/.git') or pathname.endswith('/.git/HEAD')) and \
+                ('IN_CREATE' in (maskname or '') or 'IN_MOVED_TO' in (maskname or '')):
+            self.gitdir_created(pathname[:pathname.rindex('/.git')])
+
+        repository, relative, gitpath = self.resolve(pathname, wd)
+        if repository is None:
+            self.metrics.count('events.dropped.unknown')
             if DEBUG_LEVEL > 1:
-                print "No such repository %s" % repository
+                print "No repository for %s" % pathname
             return
+        self.metrics.count('repository.%s.events' % repository)
+        self.live.add(repository)
+
+        now = time.time()
+        if self[repository].bulk:
+            # Nothing a bulk operation does is coding, and it will be reconciled at the end
+            self[repository].bulk_events += 1
+            self[repository].bulk_last = now
+            return
+        if self.bulk_started(repository, gitpath, now):
+            self.start_bulk(repository, now)
+            return
+
+        if gitpath is None:
+            if relative.rpartition('/')[2] == '.gitignore':
+                self.reload_ignore(repository)
+            if relative and self[repository].ignores(relative, 'IN_ISDIR' in (maskname or '')):
+                self.metrics.count('events.dropped.ignored')
+                return
+        elif gitpath == 'info/exclude':
+            self.reload_ignore(repository)
+
+        self[repository].notify()
+        self.sessions.touch(repository, now)
+        if gitpath is None and not re.match('meta(/worklog)?$', relative):
+            self.status = 'Working on %s' % repository
+
+        self.detect_commit(repository, gitpath, maskname)
+
+    def bulk_started(self, repository, gitpath, now):
+        if gitpath is not None and gitpath.partition('/')[0] in BULK_MARKERS:
+            return True
+        rate = self[repository].rate(now)
+        if rate < BULK_RATE:
+            return False
+        if gitpath in BULK_LOCKS:
+            return True
+        # Checked once as the rate gets high, as index.lock may have been created earlier
+        return rate == BULK_RATE and os.path.exists(os.path.join(self[repository].gitdir, 'index.lock'))
 
-        if re.search('.git/objects/[0-9a-f]{2}/[0-9a-f]{38}$', pathname) and maskname == 'IN_CREATE':
+    def start_bulk(self, repository, now):
+        if DEBUG_LEVEL > 0:
+            print "Bulk git operation on %s" % repository
+        self.metrics.count('bulk')
+        repository = self[repository]
+        repository.bulk = True
+        repository.bulk_events = 1
+        repository.bulk_last = now
+        if self.commit_detection != DETECT_REFLOG:
+            # The reflog is not followed in this mode; only what comes from now on matters
+            repository.reflog_offset = repository.reflog_size()
+            repository.pending_commits = []
+
+    def end_bulk(self, repository):
+        if DEBUG_LEVEL > 0:
+            print "Bulk git operation on %s over, %d events" % (repository, self[repository].bulk_events)
+        self.metrics.count('events.bulk', self[repository].bulk_events)
+        self[repository].bulk = False
+        # Files and .gitignore may have changed all over, and commits been made
+        self.reload_ignore(repository)
+        if not self[repository].busy:
+            self.check_reflog(repository)
+
+    def reload_ignore(self, repository):
+        if DEBUG_LEVEL > 0:
+            print "Reloading ignore rules of %s" % repository
+        self[repository].ignore.reload()
+        self.rewatch(repository)
+
+    def detect_commit(self, repository, gitpath, maskname):
+        # gitpath is relative to the repository's git dir, None outside of it
+        if gitpath is None or self[repository].busy or self[repository].bulk:
+            # Our own commit is still being written, its events are not the user's,
+            # or a bulk operation is running and will be reconciled at its end
+            return
+
+        if self.commit_detection == DETECT_REFLOG:
+            if gitpath in ('HEAD', 'logs/HEAD') or gitpath.startswith('refs/'):
+                self.check_reflog(repository)
+            return
+
+        if re.match('objects/[0-9a-f]{2}/[0-9a-f]{38}$', gitpath) and maskname == 'IN_CREATE':
             if DEBUG_LEVEL > 1:
                 print "New git object detected"
-            object_id = ''.join(pathname.split('/')[-2:])
+            object_id = ''.join(gitpath.split('/')[-2:])
 
             if not self[repository].is_commit(object_id):
                 # Object is not commit, ignore
                 return
-            
-            if object_id == self[repository].last_commit:
-                # This was our last commit logging work time, ignore
-                return
 
             """
             The test below was substituted by is_commit(), because there is a delay
@@ -191,7 +1168,7 @@ class RepositorySet(dict):
                 print "Object is commit"
 
             try:
-                fetch_head = os.path.join(self[repository].basedir, '.git/FETCH_HEAD')
+                fetch_head = os.path.join(self[repository].gitdir, 'FETCH_HEAD')
                 if os.path.exists(fetch_head):
                     fetch_object_id = open(fetch_head).read().split()[0]
                     if object_id == fetch_object_id:
@@ -202,33 +1179,301 @@ class RepositorySet(dict):
             if DEBUG_LEVEL > 0:
                 print "Commit does not come from a fetch"
 
-            self.status = '%s %s' % (repository, self[repository].format_time(self[repository].calculate_time()))
+            self.commit(repository, object_id)
+
+    def check_reflog(self, repository):
+        self.live.add(repository)
+        commit_id = self[repository].reflog_commit()
+        if commit_id:
+            if DEBUG_LEVEL > 0:
+                print "Commit %s found in reflog" % commit_id
+            self.commit(repository, commit_id)
+
+    def commit(self, repository, object_id):
+        if object_id == self[repository].last_commit:
+            # This was our last commit logging work time, ignore
+            return
+
+        self.metrics.count('commits')
+        if self.dry_run:
+            return
+        self.live.add(repository)
+        worked_time = self[repository].calculate_time()
+        self.status = '%s %s' % (repository, self[repository].format_time(worked_time))
+        for listener in self.commit_listeners:
+            listener(repository, object_id, worked_time)
+        if self.workers is None:
             self[repository].notify_commit(object_id)
+            return
 
-    def check(self):
-        assert self.notifier._timeout is not None, 'Notifier must be constructed with a short timeout'
-        if time.time() - self.last_activity > DEFAULT_HEARTBEAT:
+        self[repository].clear()
+        self[repository].busy = True
+        self.workers.submit(repository, self.log_commit, self[repository], object_id, worked_time)
+
+    def compact(self, repository):
+        self[repository].uncompacted = 0
+        if self.workers is None:
+            self[repository].compact()
+        else:
+            # In the repository's lane, never along with its commit being logged
+            self.workers.submit(repository, self[repository].compact)
+
+    def log_commit(self, repository, object_id, worked_time):
+        try:
+            repository.log_commit(object_id, worked_time)
+        finally:
+            repository.logged = True
+            repository.busy = False
+
+    def overflow(self):
+        # The kernel dropped events, so new directories and commits may have gone unseen
+        self.metrics.count('overflows')
+        if DEBUG_LEVEL > 0:
+            print "inotify queue overflow, rescanning repositories"
+        # One pass over all watches and one walk of each tree, nested
+        # repositories being walked along with the ones containing them
+        for wd, (path, found, backend) in self.watch_index.items():
+            if self.excluded(path):
+                backend.rm_watch(wd)
+                self.forget(wd)
+        walked = None
+        for basedir in sorted([ repository.basedir + '/' for repository in self.values() ]):
+            if walked is None or not basedir.startswith(walked):
+                walked = basedir
+                self.watch_tree(basedir[:-1], self.watched)
+        for repository in self:
+            if not self[repository].busy:
+                self.check_reflog(repository)
+
+    def wait(self):
+        if self.workers is not None:
+            self.workers.wait()
+
+    def tick(self):
+        if self.deferred:
+            self.watch_deferred()
+        self.sessions.expire(time.time())
+        for name in list(self.live):
+            repository = self[name]
+            repository.autoflush()
+            if repository.uncompacted >= COMPACTION_SIZE:
+                self.compact(name)
+            if repository.bulk and not 0 <= time.time() - repository.bulk_last < \
+                    (BULK_STALLED if repository.bulk_running() else BULK_QUIET):
+                self.end_bulk(name)
+            if not repository.busy:
+                repository.cat_file.close_if_idle()
+                repository.notes.close_if_idle()
+                if repository.logged:
+                    # Events of commits made while ours was logged were ignored,
+                    # the reflog has them whatever the detection mode
+                    repository.logged = False
+                    self.check_reflog(name)
+                elif repository.pending_commits:
+                    # HEAD may have caught up with a commit seen while we were busy
+                    self.check_reflog(name)
+            if repository.quiet():
+                self.live.discard(name)
+        if self.stats_file and self.metrics.changed and not 0 <= time.time() - self.last_stats < STATS_INTERVAL:
+            self.write_stats()
+
+    def session_closed(self, repository, start, end):
+        self.metrics.count('sessions')
+        self.metrics.observe('session.seconds', end - start)
+        for listener in self.session_listeners:
+            listener(repository, start, end)
+        if not self.sessions:
             self.status = 'IDLE'
-        self.notifier.process_events()
-        while self.notifier.check_events():
-            self.notifier.read_events()
-            self.notifier.process_events()
+
+    def gauges(self):
+        return {
+            'repositories': len(self),
+            'sessions': len(self.sessions),
+            'live': len(self.live),
+            'watches': len(self.watched),
+            'deferred': len(self.deferred),
+            'busy': len([ repository for repository in self.values() if repository.busy ]),
+            'buffered': sum([ len(repository.buffer) for repository in self.values() ]),
+            'jobs': self.workers.jobs if self.workers is not None else 0,
+            }
+
+    def worked(self):
+        # Seconds worked on each repository since its last commit
+        return dict([ (name, repository.calculate_time()) for name, repository in self.items() ])
+
+    def stats(self):
+        return self.metrics.snapshot(self.gauges())
+
+    def write_stats(self):
+        self.last_stats = time.time()
+        self.metrics.write(self.stats_file, self.gauges())
+
+    def next_timeout(self):
+        # Seconds until tick() has something to do, None if nothing is due ever
+        if self.deferred:
+            return 0
+        deadlines = []
+        if self.sessions:
+            deadlines.append(self.sessions.next_deadline())
+        for repository in [ self[name] for name in self.live ]:
+            if repository.buffer:
+                deadlines.append(repository.last_flush + FLUSH_INTERVAL)
+            if repository.cat_file.processes:
+                deadlines.append(repository.cat_file.last_used + CATFILE_IDLE_TIMEOUT)
+            if repository.notes.proc is not None:
+                deadlines.append(repository.notes.last_used + CATFILE_IDLE_TIMEOUT)
+            if repository.busy or repository.logged or repository.pending_commits:
+                deadlines.append(time.time() + 1)
+            if repository.bulk:
+                deadlines.append(max(repository.bulk_last + BULK_QUIET, time.time() + 1))
+        if self.stats_file and self.metrics.changed:
+            deadlines.append(self.last_stats + STATS_INTERVAL)
+        for backend in self.backends.values():
+            if backend.next_timeout() is not None:
+                deadlines.append(backend.next_timeout())
+        if not deadlines:
+            return None
+        return max(min(deadlines) - time.time(), 0)
+
+    def flush(self):
+        for repository in self.values():
+            repository.flush()
+        if self.recorder is not None:
+            self.recorder.flush()
+
+    def process(self):
+        # Handles only what is ready, for event loops waiting on filenos()
+        for backend in self.backends.values():
+            backend.process()
+        self.tick()
+
+    def check(self):
+        for backend in self.backends.values():
+            backend.check()
+        self.tick()
 
     def run(self):
-        self.notifier.loop()
+        try:
+            while True:
+                try:
+                    select.select(self.filenos(), [], [], self.next_timeout())
+                except select.error, e:
+                    if e.args[0] != errno.EINTR:
+                        raise
+                self.process()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        if self.workers is not None:
+            self.workers.stop()
+        self.flush()
+        for repository in self.values():
+            repository.cat_file.close()
+            repository.notes.close()
+        for backend in self.backends.values():
+            backend.close()
+        if self.recorder is not None:
+            self.recorder.close()
+        if self.store is not None:
+            self.store.close()
 
 
+# Subcommand -> module with its main()
+COMMANDS = {
+    'report': 'report',
+    'sweep': 'sweep',
+    'stats': 'metrics',
+    'replay': 'trace',
+    'status': 'daemon',
+    'convert': 'worklog',
+    }
+
 def run():
+    if sys.argv[1:2] and sys.argv[1] in COMMANDS:
+        module = __import__('trampometro.%s' % COMMANDS[sys.argv[1]], fromlist=['main'])
+        return module.main(sys.argv[2:])
+
+    args = sys.argv[1:]
+    trace = store = None
+    annotate = ANNOTATE_AMEND
+    commit_detection = DETECT_OBJECTS
+    backend, backends = BACKEND_INOTIFY, {}
+    log_format = WORKLOG_TEXT
+    shards = None
+    while args[:1] in (['--store'], ['--notes'], ['--binary'], ['--reflog']) or \
+            (args[:1] in (['--record'], ['--backend'], ['--shards']) and len(args) > 1):
+        if args[0] == '--store':
+            store = STORE_FILE
+            args = args[1:]
+        elif args[0] == '--notes':
+            annotate = ANNOTATE_NOTES
+            args = args[1:]
+        elif args[0] == '--binary':
+            log_format = WORKLOG_BINARY
+            args = args[1:]
+        elif args[0] == '--reflog':
+            commit_detection = DETECT_REFLOG
+            args = args[1:]
+        elif args[0] == '--backend':
+            if '=' in args[1]:
+                path, name = args[1].rsplit('=', 1)
+                backends[path] = name
+            else:
+                backend = args[1]
+            args = args[2:]
+        elif args[0] == '--shards':
+            shards = args[1]
+            args = args[2:]
+        else:
+            trace = args[1]
+            args = args[2:]
+
     try:
-        development_dir = sys.argv[1]
-        assert os.path.exists(development_dir)
-    except (IndexError, AssertionError):
+        development_dirs = args
+        assert development_dirs
+        for development_dir in development_dirs:
+            assert os.path.exists(development_dir)
+        for name in [backend] + backends.values():
+            assert name in BACKENDS
+        if shards is not None:
+            assert shards.isdigit() and int(shards) > 0
+            shards = int(shards)
+    except AssertionError:
         me = __file__.split('/')[-1]
-        print """Usage: %s development_dir
+        print """Usage: %s [--store] [--notes] [--binary] [--reflog] [--record trace]
+              [--backend [repository=]backend] [--shards processes]
+              development_dir [development_dir ...]
+       %s report [options] development_dir [development_dir ...]
+       %s sweep [options] development_dir|worklog [...]
+       %s stats [stats_file]
+       %s replay [options] trace development_dir [development_dir ...]
+       %s status
+       %s convert development_dir [development_dir ...]
 
-development_dir is the base dir where your git repositories are""" % me
+development_dir is a base dir where your git repositories are, at any
+depth up to %d levels. --store keeps activity in %s instead of a
+.worklog file in each repository. --notes puts worked time in a git note
+on %s instead of amending each commit. --binary logs activity to
+.worklog.bin, converting .worklog, as convert does for repositories not
+being watched. --reflog finds commits in .git/logs/HEAD instead of
+watching for new objects. --backend is one of %s, for all repositories or the one
+given. --shards splits repositories across that many worker processes.""" % (me, me, me, me, me, me, me, DISCOVERY_DEPTH, STORE_FILE, NOTES_REF,
+                ', '.join(sorted(BACKENDS)))
         sys.exit(0)
 
-    RepositorySet(development_dir, 50).run()
+    from trampometro.daemon import Daemon
+    options = dict(stats_file=STATS_FILE, trace=trace, store=store, annotate=annotate,
+                   commit_detection=commit_detection, backend=backend, backends=backends,
+                   log_format=log_format)
+    if shards:
+        from trampometro.shard import Coordinator
+        monitor = Coordinator(development_dirs, shards, **options)
+    else:
+        monitor = RepositorySet(development_dirs, background=True, **options)
+    # Applets and 'trampometro status' ask this daemon instead of watching on their own
+    Daemon(monitor).run()
     
 
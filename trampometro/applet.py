@@ -3,10 +3,13 @@
 import pygtk
 pygtk.require('2.0')
 
-import sys, os
+import sys, socket
 import gtk, gnomeapplet, gnome, gobject
 
-from trampometro import RepositorySet
+from trampometro.daemon import Client
+
+# Seconds between attempts to reach the daemon while it is not running
+RECONNECT_INTERVAL = 10
 
 class TrampometroApplet(object):
 
@@ -18,19 +21,46 @@ class TrampometroApplet(object):
         applet.add(self.hbox)
         self.hbox.add(self.label)
 
-        self.monitor = RepositorySet("%s/devel" % os.environ['HOME'])
-
-        self.check()
+        # The trampometro daemon does the watching, we only listen to it
+        self.client = None
+        self.connect()
 
         applet.show_all()
 
-    def check(self):
-        self.monitor.check()
-        if self.monitor.status:
-            self.label.set_label(self.monitor.status)
+    def connect(self):
+        try:
+            self.client = Client()
+            self.update(self.client.subscribe()['status'])
+        except socket.error:
+            self.client = None
+            self.update(None)
+            gobject.timeout_add(RECONNECT_INTERVAL * 1000, self.connect)
+            return False
+        gobject.io_add_watch(self.client.fileno(), gobject.IO_IN | gobject.IO_HUP, self.receive)
+        return False
+
+    def update(self, status):
+        if status:
+            self.label.set_label(status)
         else:
             self.label.set_label('---')
-        gobject.timeout_add(10, self.check)
+
+    def receive(self, fd, condition):
+        while True:
+            try:
+                message = self.client.read()
+            except (socket.error, ValueError):
+                message = None
+            if message is None:
+                # Daemon went away
+                self.client.close()
+                self.connect()
+                return False
+            if message.get('event') == 'status':
+                self.update(message['status'])
+            # Lines already received would not wake us up again
+            if '\n' not in self.client.input:
+                return True
 
         
 def applet_factory(applet, iid):
@@ -0,0 +1,380 @@
+# -*- coding: utf-8 -*-
+"""
+Ways of seeing filesystem changes, all feeding RepositorySet.notify.
+
+A backend watches directories one by one: add_watch returns a watch
+descriptor or None, rm_watch drops it. process handles whatever is ready
+without waiting and check waits a little for more, as tests need.
+"""
+
+import os, stat, time, errno, select, struct, ctypes, pyinotify
+from array import array
+
+BACKEND_INOTIFY = 'inotify'
+BACKEND_FANOTIFY = 'fanotify'
+BACKEND_POLL = 'poll'
+
+# Seconds between two scans of polled repositories
+POLL_INTERVAL = 2
+# Files are only compared in directories that changed this recently
+POLL_HOT_INTERVAL = 60
+
+def deliver(monitor, path, mask, queued=False):
+    # An event as inotify would have given it, for backends that keep no
+    # watch per directory to follow moves and deletions with. If events in
+    # new directories are queued before they are watched, they need no
+    # catching up with.
+    if monitor.recorder is not None:
+        monitor.recorder.record(time.time(), mask, path)
+    monitor.notify(path, pyinotify.EventsCodes.maskname(mask))
+    if mask & pyinotify.IN_ISDIR:
+        if mask & (pyinotify.IN_CREATE | pyinotify.IN_MOVED_TO):
+            if queued:
+                monitor.watch_tree(path, monitor.watched)
+            else:
+                monitor.register_dir(path)
+        elif mask & (pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM):
+            monitor.unwatch_tree(path)
+
+class EventHandler(pyinotify.ProcessEvent):
+
+    def __init__(self, monitor):
+        super(EventHandler, self).__init__()
+        self.monitor = monitor
+
+    def __call__(self, event):
+        if self.monitor.recorder is not None:
+            self.monitor.recorder.record(time.time(), event.mask, getattr(event, 'pathname', ''))
+        return super(EventHandler, self).__call__(event)
+
+    def process_IN_CREATE(self, event):
+        self.monitor.notify(event.pathname, event.maskname, event.wd)
+        if os.path.isdir(event.pathname):
+            self.monitor.register_dir(event.pathname)
+
+    def process_IN_DELETE(self, event):
+        self.monitor.notify(event.pathname, event.maskname, event.wd)
+
+    def process_IN_CLOSE_WRITE(self, event):
+        self.monitor.notify(event.pathname, event.maskname, event.wd)
+
+    def process_IN_MOVED_FROM(self, event):
+        self.monitor.notify(event.pathname, event.maskname, event.wd)
+
+    def process_IN_MOVED_TO(self, event):
+        self.monitor.notify(event.pathname, event.maskname, event.wd)
+        if event.dir and not hasattr(event, 'src_pathname'):
+            # Moved in from outside; moves inside the tree are handled on IN_MOVE_SELF
+            self.monitor.register_dir(event.pathname)
+
+    def process_IN_MOVE_SELF(self, event):
+        self.monitor.moved(event.wd)
+
+    def process_IN_IGNORED(self, event):
+        self.monitor.forget(event.wd)
+
+    def process_IN_Q_OVERFLOW(self, event):
+        self.monitor.overflow()
+
+class InotifyBackend(object):
+    # One inotify watch per directory, bounded by fs.inotify.max_user_watches
+
+    def __init__(self, monitor, timeout=10):
+        self.wm = pyinotify.WatchManager()
+        self.mask = pyinotify.IN_DELETE | pyinotify.IN_CREATE  | pyinotify.IN_CLOSE_WRITE
+        # Refs and HEAD are updated by renaming a lock file over them, and
+        # pyinotify needs both sides of a move to keep watch paths right
+        self.mask |= pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO | pyinotify.IN_MOVE_SELF
+        self.notifier = pyinotify.Notifier(self.wm, EventHandler(monitor), timeout=timeout)
+
+    def add_watch(self, path):
+        wd = self.wm.add_watch(path, self.mask).get(path, -1)
+        return wd if wd >= 0 else None
+
+    def rm_watch(self, wd):
+        self.wm.rm_watch(wd)
+
+    def moved_path(self, wd):
+        # Where a moved directory went, if it is still inside the tree
+        watch = self.wm.watches.get(wd)
+        if watch is None or watch.path.endswith('-unknown-path'):
+            return None
+        return watch.path
+
+    def fileno(self):
+        return self.wm.get_fd()
+
+    def next_timeout(self):
+        return None
+
+    def process(self):
+        while self.notifier.check_events(0):
+            self.notifier.read_events()
+            self.notifier.process_events()
+
+    def check(self):
+        assert self.notifier._timeout is not None, 'Notifier must be constructed with a short timeout'
+        self.notifier.process_events()
+        while self.notifier.check_events():
+            self.notifier.read_events()
+            self.notifier.process_events()
+
+    def close(self):
+        self.wm.close()
+
+FAN_CLOEXEC = 0x1
+FAN_NONBLOCK = 0x2
+FAN_REPORT_DIR_FID = 0x400
+FAN_REPORT_NAME = 0x800
+FAN_MARK_ADD = 0x1
+FAN_MARK_FILESYSTEM = 0x100
+FAN_EVENT_INFO_TYPE_DFID_NAME = 2
+AT_FDCWD = -100
+O_PATH = 0x200000
+# fanotify shares these bits with inotify
+FAN_EVENTS = (pyinotify.IN_CREATE, pyinotify.IN_MOVED_TO, pyinotify.IN_CLOSE_WRITE,
+              pyinotify.IN_MOVED_FROM, pyinotify.IN_DELETE)
+FAN_MASK = reduce(lambda a, b: a | b, FAN_EVENTS) | pyinotify.IN_ISDIR
+EVENT_METADATA = struct.Struct('<IBBHQii')
+INFO_HEADER = struct.Struct('<BBH')
+# Info header, fsid and the header of the file handle
+INFO_FID = struct.Struct('<BBH8xIi')
+# Resolved directory handles kept at most
+HANDLE_CACHE_SIZE = 4096
+
+libc = ctypes.CDLL(None, use_errno=True)
+if hasattr(libc, 'fanotify_mark'):
+    libc.fanotify_mark.argtypes = [ctypes.c_int, ctypes.c_uint, ctypes.c_uint64, ctypes.c_int, ctypes.c_char_p]
+
+class FanotifyBackend(object):
+    """
+    One fanotify mark per filesystem instead of a watch per directory, for
+    trees too large for max_user_watches. Marking a filesystem needs
+    CAP_SYS_ADMIN, turning the directory handles of events back into paths
+    CAP_DAC_READ_SEARCH, and names in events Linux 5.9. Everything on a
+    marked filesystem is reported, so events in directories that are not
+    watched are dropped here.
+    """
+
+    def __init__(self, monitor, timeout=10):
+        self.monitor = monitor
+        self.timeout = timeout / 1000.0
+        if not hasattr(libc, 'fanotify_init'):
+            raise OSError(errno.ENOSYS, 'fanotify is not available')
+        self.fd = libc.fanotify_init(FAN_CLOEXEC | FAN_NONBLOCK | FAN_REPORT_DIR_FID | FAN_REPORT_NAME,
+                                     os.O_RDONLY)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'fanotify_init: %s' % os.strerror(ctypes.get_errno()))
+        # st_dev -> a directory fd on that filesystem, for open_by_handle_at
+        self.marks = {}
+        self.directories = set()
+        self.handles = {}
+
+    def add_watch(self, path):
+        try:
+            device = os.stat(path).st_dev
+        except OSError:
+            return None
+        if device not in self.marks:
+            if libc.fanotify_mark(self.fd, FAN_MARK_ADD | FAN_MARK_FILESYSTEM, FAN_MASK, AT_FDCWD, path) < 0:
+                return None
+            self.marks[device] = os.open(path, os.O_RDONLY)
+        self.directories.add(path)
+        return path
+
+    def rm_watch(self, wd):
+        # The filesystem mark stays; events for wd are just not wanted anymore
+        self.directories.discard(wd)
+
+    def moved_path(self, wd):
+        return None
+
+    def fileno(self):
+        return self.fd
+
+    def next_timeout(self):
+        return None
+
+    def resolve(self, handle):
+        try:
+            return self.handles[handle]
+        except KeyError:
+            pass
+        buf = ctypes.create_string_buffer(handle)
+        for mark in self.marks.values():
+            fd = libc.open_by_handle_at(mark, buf, O_PATH)
+            if fd >= 0:
+                break
+        else:
+            # Gone already, or on a filesystem marked by someone else
+            return None
+        try:
+            path = os.readlink('/proc/self/fd/%d' % fd)
+        finally:
+            os.close(fd)
+        if len(self.handles) >= HANDLE_CACHE_SIZE:
+            self.handles.clear()
+        self.handles[handle] = path
+        return path
+
+    def read(self):
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError, e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return False
+            raise
+        offset = 0
+        while offset < len(data):
+            length, version, reserved, header, mask, fd, pid = EVENT_METADATA.unpack_from(data, offset)
+            if mask & pyinotify.IN_Q_OVERFLOW:
+                self.monitor.overflow()
+            info = offset + header
+            while info < offset + length:
+                kind, pad, size = INFO_HEADER.unpack_from(data, info)
+                if kind == FAN_EVENT_INFO_TYPE_DFID_NAME:
+                    kind, pad, size, handle_bytes, handle_type = INFO_FID.unpack_from(data, info)
+                    handle = data[info + 12:info + INFO_FID.size + handle_bytes]
+                    name = data[info + INFO_FID.size + handle_bytes:info + size].split('\0', 1)[0]
+                    self.dispatch(handle, name, mask)
+                info += size
+            offset += length
+        return True
+
+    def dispatch(self, handle, name, mask):
+        directory = self.resolve(handle)
+        if directory not in self.directories:
+            self.monitor.metrics.count('events.dropped.unwatched')
+            return
+        path = os.path.join(directory, name)
+        if mask & pyinotify.IN_ISDIR and mask & (pyinotify.IN_MOVED_FROM | pyinotify.IN_DELETE):
+            # Cached paths below a moved or deleted directory are wrong now
+            self.handles.clear()
+        # Events on the same file are merged, so one may stand for several
+        for event in FAN_EVENTS:
+            if mask & event:
+                deliver(self.monitor, path, event | (mask & pyinotify.IN_ISDIR), True)
+
+    def process(self):
+        while self.read():
+            pass
+
+    def check(self):
+        while select.select([self.fd], [], [], self.timeout)[0]:
+            self.process()
+
+    def close(self):
+        for fd in self.marks.values():
+            os.close(fd)
+        os.close(self.fd)
+
+class PollingBackend(object):
+    """
+    Scans for filesystems where inotify sees nothing, like network mounts.
+    Each watched directory is kept as its mtime, sorted entry names and
+    their mtimes, -1 for directories as they have a snapshot of their own.
+    Only directories are stat'ed on each scan and only those whose mtime
+    changed are listed again. A file rewritten in place leaves its
+    directory alone, so files are compared in directories that changed in
+    the last POLL_HOT_INTERVAL.
+    """
+
+    def __init__(self, monitor, timeout=None):
+        # timeout is for backends waiting on events, scans are every interval
+        self.monitor = monitor
+        self.interval = POLL_INTERVAL
+        # path -> (mtime, names, mtimes)
+        self.snapshots = {}
+        # path -> time of its last change
+        self.hot = {}
+        self.last_scan = 0
+
+    def entries(self, path):
+        try:
+            names = sorted(os.listdir(path))
+        except OSError:
+            return (), array('d')
+        found, mtimes = [], array('d')
+        for name in names:
+            try:
+                info = os.lstat(os.path.join(path, name))
+            except OSError:
+                continue
+            found.append(name)
+            mtimes.append(-1 if stat.S_ISDIR(info.st_mode) else info.st_mtime)
+        return tuple(found), mtimes
+
+    def add_watch(self, path):
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return None
+        self.snapshots[path] = (mtime,) + self.entries(path)
+        return path
+
+    def rm_watch(self, wd):
+        self.snapshots.pop(wd, None)
+        self.hot.pop(wd, None)
+
+    def moved_path(self, wd):
+        return None
+
+    def fileno(self):
+        return None
+
+    def next_timeout(self):
+        return self.last_scan + self.interval
+
+    def process(self):
+        if not 0 <= time.time() - self.last_scan < self.interval:
+            self.scan()
+
+    def check(self):
+        self.scan()
+
+    def scan(self):
+        now = self.last_scan = time.time()
+        for path in self.snapshots.keys():
+            snapshot = self.snapshots.get(path)
+            if snapshot is None:
+                # Dropped while handling events of another directory
+                continue
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                if os.path.dirname(path) not in self.snapshots:
+                    # No parent to see it go, as for the root of a repository
+                    self.monitor.unwatch_tree(path)
+                continue
+            if mtime != snapshot[0]:
+                self.hot[path] = now
+            elif not 0 <= now - self.hot.get(path, now - POLL_HOT_INTERVAL) < POLL_HOT_INTERVAL:
+                self.hot.pop(path, None)
+                continue
+            self.compare(path, snapshot, mtime)
+
+    def compare(self, path, snapshot, mtime):
+        names, mtimes = self.entries(path)
+        self.snapshots[path] = (mtime, names, mtimes)
+        before = dict(zip(snapshot[1], snapshot[2]))
+        after = dict(zip(names, mtimes))
+        for name, previous in sorted(before.items()):
+            if name not in after or (previous < 0) != (after[name] < 0):
+                deliver(self.monitor, os.path.join(path, name),
+                        pyinotify.IN_DELETE | (pyinotify.IN_ISDIR if previous < 0 else 0))
+                del before[name]
+        for name, mtime in zip(names, mtimes):
+            if name not in before:
+                deliver(self.monitor, os.path.join(path, name),
+                        pyinotify.IN_CREATE | (pyinotify.IN_ISDIR if mtime < 0 else 0))
+            elif mtime != before[name]:
+                deliver(self.monitor, os.path.join(path, name), pyinotify.IN_CLOSE_WRITE)
+
+    def close(self):
+        pass
+
+BACKENDS = {
+    BACKEND_INOTIFY: InotifyBackend,
+    BACKEND_FANOTIFY: FanotifyBackend,
+    BACKEND_POLL: PollingBackend,
+    }
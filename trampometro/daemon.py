@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""
+One monitor for all clients: the daemon owns the watches and
+answers on a UNIX socket, one JSON object per line each way.
+
+Requests are {"command": name}, with name one of status, repositories,
+commits, stats and subscribe. Subscribed clients are pushed
+{"event": "status", ...}, {"event": "commit", ...} and, as each work
+session closes, {"event": "session", ...}.
+"""
+
+import os, sys, time, json, errno, socket, select, signal
+from collections import deque
+
+SOCKET_PATH = os.path.expanduser('~/.trampometro/socket')
+RECENT_COMMITS = 20
+
+class Connection(object):
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.sock.setblocking(False)
+        self.input = ''
+        self.output = ''
+        self.subscribed = False
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def send(self, message):
+        self.output += json.dumps(message) + '\n'
+
+    def flush(self):
+        sent = self.sock.send(self.output)
+        self.output = self.output[sent:]
+
+class Daemon(object):
+
+    def __init__(self, monitor, path=SOCKET_PATH):
+        self.monitor = monitor
+        self.path = path
+        self.connections = {}
+        self.commits = deque(maxlen=RECENT_COMMITS)
+        self.running = False
+        monitor.add_listener(self.status_changed)
+        monitor.add_commit_listener(self.committed)
+        monitor.add_session_listener(self.session_closed)
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory, 0700)
+        if os.path.exists(path):
+            if Client.running(path):
+                raise RuntimeError('trampometro is already running on %s' % path)
+            # Left by a daemon that did not exit cleanly
+            os.remove(path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        os.chmod(path, 0600)
+        self.server.listen(5)
+        self.server.setblocking(False)
+
+    def status_changed(self, status):
+        self.push({ 'event': 'status', 'status': status })
+
+    def committed(self, repository, object_id, worked_time):
+        commit = { 'repository': repository, 'commit': object_id,
+                   'worked': worked_time, 'time': time.time() }
+        self.commits.append(commit)
+        event = { 'event': 'commit' }
+        event.update(commit)
+        self.push(event)
+
+    def session_closed(self, repository, start, end):
+        self.push({ 'event': 'session', 'repository': repository, 'start': start, 'end': end })
+
+    def push(self, message):
+        for connection in self.connections.values():
+            if connection.subscribed:
+                connection.send(message)
+
+    def answer(self, connection, request):
+        command = request.get('command') if isinstance(request, dict) else None
+        if command == 'status':
+            connection.send({ 'status': self.monitor.status })
+        elif command == 'repositories':
+            # Time worked on each repository since its last commit
+            connection.send({ 'repositories': self.monitor.worked() })
+        elif command == 'commits':
+            connection.send({ 'commits': list(self.commits) })
+        elif command == 'stats':
+            connection.send(self.monitor.stats())
+        elif command == 'subscribe':
+            connection.subscribed = True
+            connection.send({ 'event': 'status', 'status': self.monitor.status })
+        else:
+            connection.send({ 'error': 'unknown command %r' % command })
+
+    def accept(self):
+        try:
+            sock, address = self.server.accept()
+        except socket.error:
+            return
+        connection = Connection(sock)
+        self.connections[connection.fileno()] = connection
+
+    def drop(self, connection):
+        self.connections.pop(connection.fileno(), None)
+        connection.sock.close()
+
+    def read(self, connection):
+        try:
+            data = connection.sock.recv(4096)
+        except socket.error, e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            data = ''
+        if not data:
+            self.drop(connection)
+            return
+        connection.input += data
+        while '\n' in connection.input:
+            line, connection.input = connection.input.split('\n', 1)
+            try:
+                request = json.loads(line)
+            except ValueError:
+                request = None
+            self.answer(connection, request)
+
+    def write(self, connection):
+        try:
+            connection.flush()
+        except socket.error, e:
+            if e.errno not in (errno.EAGAIN, errno.EINTR):
+                self.drop(connection)
+
+    def step(self, timeout=None):
+        # One round of the loop: waits for events, clients or the next deadline
+        filenos = self.monitor.filenos()
+        readers = filenos + [self.server] + self.connections.values()
+        writers = [ connection for connection in self.connections.values() if connection.output ]
+        try:
+            readable, writable, failed = select.select(readers, writers, [], timeout)
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+        # Polled repositories have no descriptor, so this runs every round
+        self.monitor.process()
+        for ready in readable:
+            if ready is self.server:
+                self.accept()
+            elif ready not in filenos and ready.fileno() in self.connections:
+                self.read(ready)
+        for connection in writable:
+            if connection.fileno() in self.connections:
+                self.write(connection)
+
+    def stop(self, *args):
+        self.running = False
+
+    def run(self):
+        self.running = True
+        signal.signal(signal.SIGTERM, self.stop)
+        try:
+            while self.running:
+                self.step(self.monitor.next_timeout())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        for connection in self.connections.values():
+            self.drop(connection)
+        self.server.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.monitor.close()
+
+class Client(object):
+
+    def __init__(self, path=SOCKET_PATH):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.input = ''
+
+    @classmethod
+    def running(cls, path=SOCKET_PATH):
+        try:
+            cls(path).close()
+        except socket.error:
+            return False
+        return True
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def read(self):
+        # Next message from the daemon, None if it went away
+        while '\n' not in self.input:
+            data = self.sock.recv(4096)
+            if not data:
+                return None
+            self.input += data
+        line, self.input = self.input.split('\n', 1)
+        return json.loads(line)
+
+    def request(self, command):
+        self.sock.sendall(json.dumps({ 'command': command }) + '\n')
+        return self.read()
+
+    def subscribe(self):
+        return self.request('subscribe')
+
+    def close(self):
+        self.sock.close()
+
+def format_time(seconds):
+    seconds = int(seconds)
+    return '%02d:%02d:%02d' % (seconds / 3600, (seconds % 3600) / 60, seconds % 60)
+
+def main(args):
+    try:
+        client = Client(args[0] if args else SOCKET_PATH)
+    except socket.error:
+        print "trampometro is not running"
+        sys.exit(1)
+
+    print client.request('status')['status']
+    for name, seconds in sorted(client.request('repositories')['repositories'].items()):
+        if seconds:
+            print "  %-30s %s" % (name, format_time(seconds))
+    commits = client.request('commits')['commits']
+    if commits:
+        print "Recent commits:"
+    for commit in commits:
+        print "  %s %-30s %s %s" % (time.strftime('%H:%M:%S', time.localtime(commit['time'])),
+                                    commit['repository'], commit['commit'][:8], format_time(commit['worked']))
+    client.close()
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+import os, re
+
+USER_IGNORE_FILE = os.path.expanduser('~/.trampometro/ignore')
+
+def translate(pattern):
+    regex = []
+    i, n = 0, len(pattern)
+    while i < n:
+        if pattern.startswith('**/', i):
+            regex.append('(?:.*/)?')
+            i += 3
+        elif pattern.startswith('**', i):
+            regex.append('.*')
+            i += 2
+        elif pattern[i] == '*':
+            regex.append('[^/]*')
+            i += 1
+        elif pattern[i] == '?':
+            regex.append('[^/]')
+            i += 1
+        elif pattern[i] == '[' and ']' in pattern[i+2:]:
+            end = pattern.index(']', i + 2)
+            chars = pattern[i+1:end]
+            if chars.startswith('!'):
+                chars = '^' + chars[1:]
+            regex.append('[%s]' % chars.replace('\\', '\\\\'))
+            i = end + 1
+        elif pattern[i] == '\\' and i + 1 < n:
+            regex.append(re.escape(pattern[i+1]))
+            i += 2
+        else:
+            regex.append(re.escape(pattern[i]))
+            i += 1
+    return ''.join(regex)
+
+class IgnoreRule(object):
+
+    def __init__(self, line):
+        self.negated = line.startswith('!')
+        if self.negated:
+            line = line[1:]
+        elif line.startswith('\\'):
+            line = line[1:]
+        self.directory = line.endswith('/')
+        line = line.rstrip('/')
+        # A slash anywhere but at the end anchors the pattern to the .gitignore directory
+        prefix = '^' if '/' in line else '^(?:.*/)?'
+        self.regex = re.compile(prefix + translate(line.lstrip('/')) + '$')
+
+    def matches(self, path, isdir):
+        return (isdir or not self.directory) and self.regex.match(path) is not None
+
+def read_rules(filename):
+    try:
+        lines = open(filename).read().splitlines()
+    except IOError:
+        return []
+    rules = []
+    for line in lines:
+        line = line.rstrip()
+        if line and not line.startswith('#'):
+            rules.append(IgnoreRule(line))
+    return rules
+
+class IgnoreMatcher(object):
+
+    def __init__(self, basedir, gitdir=None):
+        self.basedir = basedir
+        self.gitdir = gitdir or os.path.join(basedir, '.git')
+        self.reload()
+
+    def reload(self):
+        # Lowest precedence first: the last matching rule wins, like in git
+        self.rules = { '': read_rules(USER_IGNORE_FILE) +
+                       read_rules(os.path.join(self.gitdir, 'info/exclude')) +
+                       read_rules(os.path.join(self.basedir, '.gitignore')) }
+        self.decisions = {}
+
+    def directory_rules(self, directory):
+        try:
+            return self.rules[directory]
+        except KeyError:
+            rules = self.rules[directory] = read_rules(os.path.join(self.basedir, directory, '.gitignore'))
+            return rules
+
+    def ignored(self, path, isdir=False):
+        """
+        Tells if path, relative to the repository root, is ignored.
+        Decisions for directories are cached until the rules are reloaded.
+        """
+        if isdir:
+            try:
+                return self.decisions[path]
+            except KeyError:
+                pass
+
+        parent = path.rpartition('/')[0]
+        if parent and self.ignored(parent, True):
+            # Nothing inside an ignored directory can be re-included
+            decision = True
+        else:
+            decision = self.match(path, parent, isdir)
+
+        if isdir:
+            self.decisions[path] = decision
+        return decision
+
+    def match(self, path, parent, isdir):
+        decision = False
+        directories = [''] + [ parent[:i] for i, char in enumerate(parent) if char == '/' ]
+        if parent:
+            directories.append(parent)
+        for directory in directories:
+            relative = path[len(directory) + 1:] if directory else path
+            for rule in self.directory_rules(directory):
+                if rule.matches(relative, isdir):
+                    decision = not rule.negated
+        return decision
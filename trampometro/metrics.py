@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+import os, sys, json, time
+
+STATS_FILE = os.path.expanduser('~/.trampometro/stats.json')
+STATS_INTERVAL = 10
+
+class Histogram(object):
+    # Power of two buckets: cheap to update, good enough to tell 10us from 10ms
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def observe(self, value):
+        bucket = int(value).bit_length()
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        # Upper bound of the bucket holding the p-th value
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= self.count * p:
+                return 2 ** bucket
+        return 0
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'max': self.max,
+            'p50': self.percentile(0.5),
+            'p99': self.percentile(0.99),
+            'buckets': dict([ (2 ** bucket, count) for bucket, count in self.buckets.items() ]),
+            }
+
+class Metrics(object):
+    """
+    Counters and histograms updated in place by the monitor. Nothing is
+    computed until someone asks for a snapshot.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.changed = False
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+        self.changed = True
+
+    def observe(self, name, value):
+        try:
+            histogram = self.histograms[name]
+        except KeyError:
+            histogram = self.histograms[name] = Histogram()
+        histogram.observe(value)
+        self.changed = True
+
+    def snapshot(self, gauges=None):
+        return {
+            'time': time.time(),
+            'counters': dict(self.counters),
+            'histograms': dict([ (name, histogram.snapshot()) for name, histogram in self.histograms.items() ]),
+            'gauges': gauges or {},
+            }
+
+    def write(self, filename, gauges=None):
+        write_snapshot(filename, self.snapshot(gauges))
+        self.changed = False
+
+def write_snapshot(filename, snapshot):
+    directory = os.path.dirname(filename)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    tmp = '%s.tmp' % filename
+    json.dump(snapshot, open(tmp, 'w'), indent=1, sort_keys=True)
+    # Readers never see a half written file
+    os.rename(tmp, filename)
+
+def merge_snapshots(snapshots):
+    # Snapshots of several processes as one: counters and gauges add up,
+    # histograms are merged bucket by bucket
+    counters, gauges, histograms = {}, {}, {}
+    for snapshot in snapshots:
+        for merged, values in ((counters, snapshot['counters']), (gauges, snapshot['gauges'])):
+            for name, value in values.items():
+                merged[name] = merged.get(name, 0) + value
+        for name, values in snapshot['histograms'].items():
+            try:
+                histogram = histograms[name]
+            except KeyError:
+                histogram = histograms[name] = Histogram()
+            histogram.count += values['count']
+            histogram.sum += values['sum']
+            histogram.max = max(histogram.max, values['max'])
+            for bound, count in values['buckets'].items():
+                bucket = int(bound).bit_length() - 1
+                histogram.buckets[bucket] = histogram.buckets.get(bucket, 0) + count
+    return {
+        'time': time.time(),
+        'counters': counters,
+        'histograms': dict([ (name, histogram.snapshot()) for name, histogram in histograms.items() ]),
+        'gauges': gauges,
+        }
+
+def main(args):
+    filename = args[0] if args else STATS_FILE
+    try:
+        stats = json.load(open(filename))
+    except (IOError, ValueError):
+        print "No stats in %s, is trampometro running?" % filename
+        sys.exit(1)
+
+    print "Written %ds ago" % (time.time() - stats['time'])
+    for name, value in sorted(stats['gauges'].items()):
+        print "%-40s %10s" % (name, value)
+    for name, value in sorted(stats['counters'].items()):
+        print "%-40s %10d" % (name, value)
+    for name, histogram in sorted(stats['histograms'].items()):
+        print "%-40s %10d  p50 <= %d  p99 <= %d  max %d" % (name, histogram['count'], histogram['p50'],
+                                                           histogram['p99'], histogram['max'])
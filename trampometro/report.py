@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+
+import os, re, sys, json, time, datetime
+from optparse import OptionParser
+from subprocess import Popen, PIPE
+
+REPORT_INDEX = os.path.expanduser('~/.trampometro/report.json')
+WORKLOG = 'meta/worklog'
+# Name <email>, as log_commit writes the author of newer entries
+AUTHOR = re.compile('.* <[^<>]*>$')
+
+def parse_time(text):
+    hours, minutes, seconds = text.split(':')
+    return int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+
+def parse_worklog(worklog, offset=0):
+    """
+    Yields (author, seconds, summary, offset) for each complete entry after
+    offset, offset being where the next entry starts. An entry being written
+    is left for the next call, one that cannot be parsed is skipped. Entries
+    from before authors were logged (blank line, summary, HH:MM:SS) come
+    with an empty author.
+    """
+    worklog.seek(offset)
+    while True:
+        start = worklog.tell()
+        lines = [ worklog.readline() for i in range(3) ]
+        if not lines[-1].endswith('\n'):
+            return
+        blank, first, worked = [ line.rstrip('\n') for line in lines ]
+        summary = None
+        if AUTHOR.match(first):
+            summary = worklog.readline()
+            if not summary.endswith('\n'):
+                return
+        try:
+            seconds = parse_time(worked)
+        except ValueError:
+            seconds = None
+        if blank or seconds is None:
+            # Out of step, entries start with a blank line
+            worklog.seek(start + len(lines[0]))
+            continue
+        if summary is None:
+            yield '', seconds, first, worklog.tell()
+        else:
+            yield first, seconds, summary.rstrip('\n'), worklog.tell()
+
+def line_days(basedir, first):
+    # Day of the commit that added each line of the worklog from line first
+    # (1 based) on, None for lines not committed yet
+    proc = Popen(['git', 'blame', '--line-porcelain', '-L', '%d,' % first, '--', WORKLOG],
+                 cwd=basedir, stdout=PIPE, stderr=PIPE, close_fds=True)
+    days = []
+    header = True
+    for line in proc.communicate()[0].splitlines():
+        if header:
+            committed = line.split()[0].strip('0') != ''
+            header = False
+        elif line.startswith('author-time '):
+            day = time.strftime('%Y-%m-%d', time.localtime(int(line.split()[1])))
+        elif line.startswith('\t'):
+            days.append(day if committed else None)
+            header = True
+    return days
+
+class ReportIndex(object):
+    """
+    Worked seconds per repository, author and day, kept up to date from
+    each repository's worklog by parsing only what was appended since
+    the last update.
+    """
+
+    def __init__(self, filename=REPORT_INDEX):
+        self.filename = filename
+        try:
+            self.repositories = json.load(open(filename))
+        except (IOError, ValueError):
+            self.repositories = {}
+        self.changed = False
+
+    def update(self, basedir):
+        filename = os.path.join(basedir, WORKLOG)
+        try:
+            size = os.stat(filename).st_size
+        except OSError:
+            size = 0
+        entry = self.repositories.get(basedir)
+        if entry is None or size < entry['offset']:
+            # New repository, or the worklog was rewritten (branch switch, rebase)
+            entry = self.repositories[basedir] = { 'offset': 0, 'line': 0, 'totals': {} }
+            self.changed = True
+        if size == entry['offset']:
+            return entry
+
+        worklog = open(filename)
+        if 'line' not in entry:
+            # Lines before offset, for indexes written before it was kept
+            entry['line'] = worklog.read(entry['offset']).count('\n')
+        start, line = entry['offset'], entry['line']
+        entries = list(parse_worklog(worklog, start))
+        worklog.seek(start)
+        data = worklog.read(entries[-1][3] - start if entries else 0)
+        worklog.close()
+        if not entries:
+            return entry
+
+        # An entry is dated by the commit its lines were amended into
+        days = line_days(basedir, line + 1)
+        for author, seconds, summary, offset in entries:
+            last = data.count('\n', 0, offset - start) - 1
+            if last >= len(days) or days[last] is None:
+                # Not committed yet, so there is no date; it is taken next time
+                break
+            totals = entry['totals'].setdefault(author, {})
+            totals[days[last]] = totals.get(days[last], 0) + seconds
+            entry['offset'] = offset
+            entry['line'] = line + last + 1
+            self.changed = True
+        return entry
+
+    def save(self):
+        if not self.changed:
+            return
+        directory = os.path.dirname(self.filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp = '%s.tmp' % self.filename
+        json.dump(self.repositories, open(tmp, 'w'))
+        os.rename(tmp, self.filename)
+        self.changed = False
+
+    def rows(self, repositories):
+        # repositories maps name to basedir
+        for name, basedir in repositories.items():
+            for author, days in self.update(basedir)['totals'].items():
+                for day, seconds in days.items():
+                    yield name, author, day, seconds
+
+def week(day):
+    year, week, weekday = datetime.date(*map(int, day.split('-'))).isocalendar()
+    return '%d-W%02d' % (year, week)
+
+GROUPS = {
+    'repository': lambda name, author, day: name,
+    'author': lambda name, author, day: author,
+    'day': lambda name, author, day: day,
+    'week': lambda name, author, day: week(day),
+    }
+
+def report(index, repositories, group='repository', since=None, until=None, author=None):
+    """
+    Returns [(key, seconds)] sorted by key, plus the grand total.
+    since and until are YYYY-MM-DD days, both included.
+    """
+    totals = {}
+    for name, who, day, seconds in index.rows(repositories):
+        if (since and day < since) or (until and day > until) or (author and author not in who):
+            continue
+        key = GROUPS[group](name, who, day)
+        totals[key] = totals.get(key, 0) + seconds
+    return sorted(totals.items()), sum(totals.values())
+
+def format_time(seconds):
+    return '%02d:%02d:%02d' % (seconds / 3600, (seconds % 3600) / 60, seconds % 60)
+
+def main(args):
+    from trampometro import find_repositories, repository_name
+    parser = OptionParser(usage='%prog report [options] development_dir [development_dir ...]')
+    parser.add_option('-b', '--by', dest='group', default='repository', choices=sorted(GROUPS),
+                      help='group totals by %s' % ', '.join(sorted(GROUPS)))
+    parser.add_option('-s', '--since', help='first day, as YYYY-MM-DD')
+    parser.add_option('-u', '--until', help='last day, as YYYY-MM-DD')
+    parser.add_option('-a', '--author', help='only authors containing this')
+    parser.add_option('-i', '--index', default=REPORT_INDEX, help='index file')
+    options, basedirs = parser.parse_args(args)
+    if not basedirs:
+        parser.print_usage()
+        sys.exit(0)
+
+    basedirs = [ os.path.realpath(basedir) for basedir in basedirs ]
+    repositories = {}
+    for path in find_repositories(basedirs):
+        repositories[repository_name(basedirs, path, repositories)] = path
+
+    index = ReportIndex(options.index)
+    rows, total = report(index, repositories, options.group, options.since, options.until, options.author)
+    index.save()
+
+    width = max([ len(key) for key, seconds in rows ] + [5])
+    for key, seconds in rows:
+        print '%-*s %s' % (width, key, format_time(seconds))
+    print '%-*s %s' % (width, 'Total', format_time(total))
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+from heapq import heappush, heappop
+
+class Sessions(object):
+    """
+    Open work sessions, one per repository, each closed heartbeat seconds
+    after its last event, as calculate_time would split them.
+
+    Deadlines live in a heap that is only pushed to when a session opens:
+    an event just moves the session's last time, and a deadline found
+    stale when it comes up is pushed again for the session's real one.
+    An event costs the same however many repositories are active.
+    """
+
+    def __init__(self, heartbeat, closed):
+        self.heartbeat = heartbeat
+        # Called with key, first and last event time of each closed session
+        self.closed = closed
+        # key -> [start, last, deadline queued for it]
+        self.sessions = {}
+        self.heap = []
+        self.now = None
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __contains__(self, key):
+        return key in self.sessions
+
+    def touch(self, key, now):
+        session = self.sessions.get(key)
+        if session is not None and 0 <= now - session[1] <= self.heartbeat:
+            session[1] = now
+            return
+        self.sessions[key] = [now, now, now + self.heartbeat]
+        heappush(self.heap, (now + self.heartbeat, key))
+        if session is not None:
+            # Its deadline has not come up yet, or the clock went back. The
+            # new session is open already, so this is never the last one closing
+            self.closed(key, session[0], session[1])
+
+    def close(self, key):
+        start, last, deadline = self.sessions.pop(key)
+        self.closed(key, start, last)
+
+    def expire(self, now):
+        if self.now is not None and now < self.now:
+            # The clock went back: the next event will open a new session
+            # anyway, so sessions last seen in the future are over
+            for key in [ key for key, session in self.sessions.items() if session[1] > now ]:
+                self.close(key)
+        self.now = now
+        while self.heap and self.heap[0][0] < now:
+            deadline, key = heappop(self.heap)
+            session = self.sessions.get(key)
+            if session is None or session[2] != deadline:
+                # Closed, or reopened with a deadline of its own
+                continue
+            if session[1] + self.heartbeat < now:
+                self.close(key)
+            else:
+                session[2] = session[1] + self.heartbeat
+                heappush(self.heap, (session[2], key))
+
+    def next_deadline(self):
+        # May be earlier than the real one, never later
+        return self.heap[0][0] if self.heap else None
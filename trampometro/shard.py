@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+"""
+Repositories split across worker processes, for trees with more activity
+than one core keeps up with. Each worker is a RepositorySet of its own,
+with its own inotify instance and watches, given the repositories whose
+path hashes to it. The coordinator finds and names repositories for all
+of them, merges their status, commits and sessions for the daemon, and
+hands repositories that appear to their worker.
+
+Workers and coordinator talk through pipes, sending tuples: the worker
+sends ('ready',), ('status', status), ('commit', name, object_id, worked),
+('session', name, start, end) and ('reply', data); the coordinator sends
+('add', name, path), ('remove', name), ('worked',), ('stats',) and ('stop',).
+"""
+
+import os, sys, time, zlib, errno, select, traceback
+from multiprocessing import Process, Pipe
+from trampometro import RepositorySet, find_repositories, repository_name, DISCOVERY_DEPTH
+from trampometro.metrics import Metrics, STATS_INTERVAL, merge_snapshots, write_snapshot
+
+DEFAULT_SHARDS = 4
+# Seconds between looks for repositories created or removed under the base dirs
+RESCAN_INTERVAL = 60
+# Seconds before a worker that failed to start is started again
+RESTART_DELAY = 10
+
+def shard_of(path, shards):
+    # Stable across runs and processes, unlike hash()
+    return (zlib.crc32(path) & 0xffffffff) % shards
+
+def work(conn, inherited, basedirs, repositories, options):
+    # Runs in the worker process until stopped or the coordinator goes away,
+    # which it only sees once no process but the coordinator has its pipes
+    for parent in inherited:
+        parent.close()
+    monitor = RepositorySet(basedirs, repositories=repositories, background=True, **options)
+    monitor.add_listener(lambda status: conn.send(('status', status)))
+    monitor.add_commit_listener(lambda *commit: conn.send(('commit',) + commit))
+    monitor.add_session_listener(lambda *session: conn.send(('session',) + session))
+    conn.send(('ready',))
+    try:
+        while True:
+            try:
+                select.select(monitor.filenos() + [conn], [], [], monitor.next_timeout())
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+            monitor.process()
+            while conn.poll():
+                message = conn.recv()
+                if message[0] == 'stop':
+                    return
+                elif message[0] == 'add':
+                    try:
+                        monitor.watch_repository(*message[1:])
+                    except Exception:
+                        traceback.print_exc()
+                elif message[0] == 'remove':
+                    monitor.unwatch_repository(message[1])
+                elif message[0] == 'worked':
+                    conn.send(('reply', monitor.worked()))
+                elif message[0] == 'stats':
+                    conn.send(('reply', monitor.stats()))
+    except (EOFError, KeyboardInterrupt):
+        pass
+    finally:
+        monitor.close()
+
+class Worker(object):
+
+    def __init__(self, shard, basedirs, options):
+        self.shard = shard
+        self.basedirs = basedirs
+        self.options = options
+        # name -> path of the repositories assigned to this worker
+        self.repositories = {}
+        self.conn = self.process = None
+        # When to start again, if it failed to
+        self.retry = None
+
+    def start(self, others=()):
+        self.conn, child = Pipe()
+        inherited = [ other.conn for other in others if other.conn is not None ] + [self.conn]
+        self.process = Process(target=work, args=(child, inherited, self.basedirs,
+                                                  sorted(self.repositories.items()), self.options))
+        self.process.daemon = True
+        self.process.start()
+        child.close()
+        self.retry = None
+        self.status = 'IDLE'
+        # Order of the last status change among workers, to merge them
+        self.changed = 0
+
+    def fileno(self):
+        return self.conn.fileno()
+
+    def send(self, *message):
+        try:
+            self.conn.send(message)
+        except (IOError, EOFError):
+            # Gone, the coordinator restarts it when its pipe is read
+            pass
+
+    def stop(self):
+        if self.retry is not None:
+            return
+        self.send('stop')
+        self.conn.close()
+        self.process.join(5)
+        if self.process.is_alive():
+            self.process.terminate()
+
+class Coordinator(object):
+
+    def __init__(self, basedir, shards=DEFAULT_SHARDS, max_depth=DISCOVERY_DEPTH, stats_file=None,
+                 trace=None, **options):
+        # basedir is one directory or a list of them
+        basedirs = [basedir] if isinstance(basedir, basestring) else basedir
+        for basedir in basedirs:
+            assert os.path.isdir(basedir)
+        assert shards > 0
+        self.basedirs = [ os.path.realpath(basedir) for basedir in basedirs ]
+        self.max_depth = max_depth
+        self.workers = []
+        for shard in range(shards):
+            worker_options = dict(options, max_depth=max_depth)
+            if trace:
+                # One trace per worker, each replayable on its own
+                worker_options['trace'] = '%s.%d' % (trace, shard)
+            self.workers.append(Worker(shard, self.basedirs, worker_options))
+
+        self.metrics = Metrics()
+        # Merged stats of all workers are written here every STATS_INTERVAL
+        self.stats_file = stats_file
+        self.last_stats = time.time()
+
+        self.listeners = []
+        self.commit_listeners = []
+        self.session_listeners = []
+        self._status = 'IDLE'
+        self.changes = 0
+
+        # path -> name of every repository found under the base dirs
+        self.names = {}
+        self.taken = set()
+        self.last_rescan = time.time()
+        for path in find_repositories(self.basedirs, max_depth):
+            self.assign(path)
+        for worker in self.workers:
+            worker.start(self.workers[:worker.shard])
+        for worker in self.workers:
+            self.ready(worker)
+
+    @property
+    def status(self):
+        return self._status
+
+    @status.setter
+    def status(self, status):
+        if status == self._status:
+            return
+        self._status = status
+        for listener in self.listeners:
+            listener(status)
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def add_commit_listener(self, listener):
+        self.commit_listeners.append(listener)
+
+    def add_session_listener(self, listener):
+        self.session_listeners.append(listener)
+
+    def assign(self, path):
+        name = repository_name(self.basedirs, path, self.taken)
+        self.names[path] = name
+        self.taken.add(name)
+        worker = self.workers[shard_of(path, len(self.workers))]
+        worker.repositories[name] = path
+        return worker, name
+
+    def running(self):
+        return [ worker for worker in self.workers if worker.retry is None ]
+
+    def filenos(self):
+        return [ worker.fileno() for worker in self.running() ]
+
+    def ready(self, worker):
+        # A worker that dies before it is ready is started again later,
+        # the others go on meanwhile
+        try:
+            self.receive(worker, 'ready')
+        except RuntimeError, e:
+            print >> sys.stderr, e
+            self.metrics.count('shards.failures')
+            worker.conn.close()
+            worker.process.join(0)
+            worker.retry = time.time() + RESTART_DELAY
+
+    def restart(self, worker):
+        # Its watches died with it, the new one sets them up again
+        self.metrics.count('shards.restarts')
+        if worker.retry is None:
+            worker.conn.close()
+            worker.process.join(0)
+        worker.conn = None
+        worker.start(self.workers)
+        self.ready(worker)
+        self.merge_status()
+
+    def receive(self, worker, expected):
+        # Handles whatever comes first, until the expected message comes;
+        # None if the worker died meanwhile
+        while True:
+            try:
+                message = worker.conn.recv()
+            except (EOFError, IOError):
+                if expected == 'ready':
+                    raise RuntimeError('worker %d did not start' % worker.shard)
+                self.restart(worker)
+                return None
+            if message[0] == expected:
+                return message[1:]
+            self.dispatch(worker, message)
+
+    def dispatch(self, worker, message):
+        if message[0] == 'status':
+            self.changes += 1
+            worker.status, worker.changed = message[1], self.changes
+            self.merge_status()
+        elif message[0] == 'commit':
+            for listener in self.commit_listeners:
+                listener(*message[1:])
+        elif message[0] == 'session':
+            for listener in self.session_listeners:
+                listener(*message[1:])
+
+    def merge_status(self):
+        # The last status of a worker still working, IDLE once all of them are
+        busy = [ worker for worker in self.workers if worker.status != 'IDLE' ]
+        if busy:
+            self.status = max(busy, key=lambda worker: worker.changed).status
+        else:
+            self.status = 'IDLE'
+
+    def request(self, command):
+        # Asks every worker at once, then waits for each answer in turn
+        workers = self.running()
+        for worker in workers:
+            worker.send(command)
+        replies = []
+        for worker in workers:
+            reply = self.receive(worker, 'reply')
+            if reply is not None:
+                replies.append(reply[0])
+        return replies
+
+    def worked(self):
+        worked = {}
+        for reply in self.request('worked'):
+            worked.update(reply)
+        return worked
+
+    def stats(self):
+        stats = merge_snapshots(self.request('stats') + [self.metrics.snapshot()])
+        stats['gauges']['shards'] = len(self.running())
+        return stats
+
+    def rescan(self):
+        # With a stable hash, rebalancing is giving new repositories to
+        # their worker and dropping the ones gone: no other one moves
+        self.last_rescan = time.time()
+        found = set(find_repositories(self.basedirs, self.max_depth))
+        for path in sorted(found - set(self.names)):
+            worker, name = self.assign(path)
+            worker.send('add', name, path)
+        for path in set(self.names) - found:
+            name = self.names.pop(path)
+            self.taken.discard(name)
+            worker = self.workers[shard_of(path, len(self.workers))]
+            worker.repositories.pop(name, None)
+            worker.send('remove', name)
+
+    def process(self):
+        for worker in self.running():
+            try:
+                while worker.conn.poll():
+                    self.dispatch(worker, worker.conn.recv())
+            except (EOFError, IOError):
+                self.restart(worker)
+        self.tick()
+
+    def tick(self):
+        for worker in self.workers:
+            if worker.retry is not None and not 0 <= worker.retry - time.time() <= RESTART_DELAY:
+                self.restart(worker)
+        if not 0 <= time.time() - self.last_rescan < RESCAN_INTERVAL:
+            self.rescan()
+        if self.stats_file and not 0 <= time.time() - self.last_stats < STATS_INTERVAL:
+            self.write_stats()
+
+    def write_stats(self):
+        self.last_stats = time.time()
+        write_snapshot(self.stats_file, self.stats())
+
+    def next_timeout(self):
+        deadlines = [self.last_rescan + RESCAN_INTERVAL]
+        deadlines += [ worker.retry for worker in self.workers if worker.retry is not None ]
+        if self.stats_file:
+            deadlines.append(self.last_stats + STATS_INTERVAL)
+        return max(min(deadlines) - time.time(), 0)
+
+    def close(self):
+        for worker in self.workers:
+            worker.stop()
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+import os, sqlite3, threading
+from trampometro.worklog import parse, expand
+
+STORE_FILE = os.path.expanduser('~/.trampometro/activity.db')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS repositories (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL
+);
+CREATE TABLE IF NOT EXISTS activity (
+    repository INTEGER NOT NULL,
+    timestamp REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS activity_time ON activity (repository, timestamp);
+"""
+
+class ActivityStore(object):
+    """
+    Activity of all repositories in one SQLite database, in place of the
+    .worklog file in each working tree. Repositories are known by path.
+    """
+
+    def __init__(self, filename=STORE_FILE, take_over=True):
+        directory = os.path.dirname(filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.filename = filename
+        # Repositories are loaded from worker threads at startup
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        # WAL stays consistent on a crash; at worst the last flush is lost, as with .worklog
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(SCHEMA)
+        self.ids = {}
+        # Whether .worklog files of repositories seen for the first time are imported and removed
+        self.take_over = take_over
+
+    def repository_id(self, path):
+        try:
+            return self.ids[path]
+        except KeyError:
+            pass
+        with self.lock:
+            row = self.db.execute('SELECT id FROM repositories WHERE path = ?', (path,)).fetchone()
+            if row is None:
+                with self.db:
+                    cursor = self.db.execute('INSERT INTO repositories (path) VALUES (?)', (path,))
+                    self.import_worklog(cursor.lastrowid, path)
+                row = (cursor.lastrowid,)
+            self.ids[path] = row[0]
+        return row[0]
+
+    def import_worklog(self, repository, path):
+        # First time this repository is seen: take over its .worklog
+        if not self.take_over:
+            return
+        worklog = os.path.join(path, '.worklog')
+        try:
+            data = open(worklog).read()
+        except IOError:
+            return
+        # Compacted intervals come in as events COMPACTION_GAP apart
+        timestamps = [ (repository, timestamp) for timestamp in expand(parse(data)) ]
+        self.db.executemany('INSERT INTO activity VALUES (?, ?)', timestamps)
+        os.remove(worklog)
+
+    def add(self, path, timestamps):
+        repository = self.repository_id(path)
+        with self.lock:
+            with self.db:
+                self.db.executemany('INSERT INTO activity VALUES (?, ?)',
+                                    [ (repository, timestamp) for timestamp in timestamps ])
+
+    def timestamps(self, path, since=None, until=None):
+        # In insertion order, like the lines of a .worklog
+        query = 'SELECT timestamp FROM activity WHERE repository = ?'
+        args = [self.repository_id(path)]
+        if since is not None:
+            query += ' AND timestamp >= ?'
+            args.append(since)
+        if until is not None:
+            query += ' AND timestamp <= ?'
+            args.append(until)
+        with self.lock:
+            return [ row[0] for row in self.db.execute(query + ' ORDER BY rowid', args) ]
+
+    def clear(self, path):
+        repository = self.repository_id(path)
+        with self.lock:
+            with self.db:
+                self.db.execute('DELETE FROM activity WHERE repository = ?', (repository,))
+
+    def repositories(self):
+        with self.lock:
+            return [ row[0] for row in self.db.execute('SELECT path FROM repositories ORDER BY path') ]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+import os, sys
+from bisect import bisect_right
+from optparse import OptionParser
+from trampometro.worklog import parse, expand, BinaryLog, BINARY_MAGIC, COMPACTION_GAP
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def read_worklog(filename):
+    try:
+        data = open(filename).read()
+    except IOError:
+        data = ''
+    if data.startswith(BINARY_MAGIC):
+        return expand(BinaryLog(filename).intervals())
+    if numpy is not None and ' ' not in data:
+        return numpy.fromstring(data, sep=' ')
+    # Compacted, exact for heartbeats of at least COMPACTION_GAP
+    return expand(parse(data))
+
+def sweep(timestamps, heartbeats):
+    """
+    Worked time for each heartbeat, the same as Repository.calculate_time
+    would give for each of them. A session goes on while gaps between
+    events are between 0 and the heartbeat, so worked time is the sum of
+    the gaps in that range. Gaps are taken in log order, as calculate_time
+    does, and sorted once so every heartbeat is a binary search.
+    """
+    if numpy is not None:
+        gaps = numpy.diff(numpy.asarray(timestamps, dtype=float))
+        gaps = numpy.sort(gaps[gaps >= 0])
+        sums = numpy.concatenate(([0.0], numpy.cumsum(gaps)))
+        return list(sums[numpy.searchsorted(gaps, heartbeats, side='right')])
+
+    gaps = sorted(gap for gap in [ b - a for a, b in zip(timestamps, timestamps[1:]) ] if gap >= 0)
+    sums = [0.0]
+    for gap in gaps:
+        sums.append(sums[-1] + gap)
+    return [ sums[bisect_right(gaps, heartbeat)] for heartbeat in heartbeats ]
+
+def sweep_logs(logs, heartbeats):
+    # Gaps between two repositories mean nothing, so each one is swept alone
+    totals = [0.0] * len(heartbeats)
+    for timestamps in logs:
+        for i, total in enumerate(sweep(timestamps, heartbeats)):
+            totals[i] += total
+    return totals
+
+def sweep_files(filenames, heartbeats):
+    return sweep_logs([ read_worklog(filename) for filename in filenames ], heartbeats)
+
+def main(args):
+    from trampometro import find_repositories, DEFAULT_HEARTBEAT
+    from trampometro.store import ActivityStore, STORE_FILE
+    parser = OptionParser(usage='%prog sweep [options] development_dir|worklog [...]')
+    parser.add_option('-H', '--heartbeats', help='comma separated heartbeats, in seconds')
+    parser.add_option('-f', '--from', dest='start', type='int', default=60, help='smallest heartbeat')
+    parser.add_option('-t', '--to', dest='stop', type='int', default=2 * DEFAULT_HEARTBEAT, help='largest heartbeat')
+    parser.add_option('-s', '--step', type='int', default=30, help='heartbeat increment')
+    parser.add_option('-d', '--store', action='store_true', default=False,
+                      help='sweep all repositories in %s' % STORE_FILE)
+    options, paths = parser.parse_args(args)
+    if not paths and not options.store:
+        parser.print_usage()
+        sys.exit(0)
+
+    if options.heartbeats:
+        heartbeats = [ int(heartbeat) for heartbeat in options.heartbeats.split(',') ]
+    else:
+        heartbeats = range(options.start, options.stop + 1, options.step)
+    if [ heartbeat for heartbeat in heartbeats if heartbeat < COMPACTION_GAP ]:
+        # Compacted logs no longer tell gaps shorter than that
+        parser.error('heartbeats must be at least %d seconds' % COMPACTION_GAP)
+
+    filenames = [ path for path in paths if not os.path.isdir(path) ]
+    basedirs = [ os.path.realpath(path) for path in paths if os.path.isdir(path) ]
+    if basedirs:
+        for path in find_repositories(basedirs):
+            filenames += [ filename for filename in (os.path.join(path, '.worklog'), os.path.join(path, '.worklog.bin'))
+                           if os.path.exists(filename) ]
+
+    logs = [ read_worklog(filename) for filename in filenames ]
+    if options.store:
+        store = ActivityStore()
+        logs += [ store.timestamps(path) for path in store.repositories() ]
+
+    for heartbeat, total in zip(heartbeats, sweep_logs(logs, heartbeats)):
+        total = int(total)
+        print '%6d %02d:%02d:%02d' % (heartbeat, total / 3600, (total % 3600) / 60, total % 60)
@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for event ingestion and commit detection. Run from the source tree:
+
+    python trampometro/test/benchmark.py [-n events] [-o results.json] [-c baseline.json] [scenario ...]
+
+Each scenario builds synthetic repositories in a temp dir and drives the
+real code, reporting throughput, per-operation latency percentiles, read
+and write syscalls (from /proc/self/io) and subprocesses started by
+trampometro. Results can be saved and compared against a previous run.
+"""
+
+import os, sys, time, json, shutil, tempfile, subprocess
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+import trampometro
+from trampometro import RepositorySet, Repository
+
+SCENARIOS = []
+# Slower than the baseline by more than this is reported as a regression
+REGRESSION = 0.2
+
+def scenario(function):
+    SCENARIOS.append(function)
+    return function
+
+def io_counters():
+    counters = {}
+    try:
+        for line in open('/proc/self/io'):
+            key, value = line.split(':')
+            counters[key] = int(value)
+    except IOError:
+        pass
+    return counters
+
+class Spawned(object):
+    # Counts subprocesses started by trampometro while installed
+    def __init__(self):
+        self.count = 0
+        self.original = trampometro.Popen
+
+    def __call__(self, *args, **kwargs):
+        self.count += 1
+        return self.original(*args, **kwargs)
+
+    def __enter__(self):
+        trampometro.Popen = self
+        return self
+
+    def __exit__(self, *exc):
+        trampometro.Popen = self.original
+
+class Measure(object):
+
+    def __init__(self):
+        self.latencies = []
+        self.operations = 0
+        self.spawned = Spawned()
+
+    def start(self):
+        # Called by scenarios once their setup is done
+        self.io = io_counters()
+        self.spawned.count = 0
+        self.started = time.time()
+
+    def time(self, function, *args):
+        started = time.time()
+        result = function(*args)
+        self.latencies.append(time.time() - started)
+        self.operations += 1
+        return result
+
+    def wrap(self, owner, name):
+        # Times every call to owner.name, for code called from inside the loop
+        function = getattr(owner, name)
+        setattr(owner, name, lambda *args: self.time(function, *args))
+
+    def run(self, function, *args):
+        self.start()
+        with self.spawned:
+            function(self, *args)
+            elapsed = time.time() - self.started
+        after = io_counters()
+        io, spawned = self.io, self.spawned
+        latencies = sorted(self.latencies)
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000 if latencies else 0
+        return {
+            'operations': self.operations,
+            'seconds': elapsed,
+            'throughput': self.operations / elapsed if elapsed else 0,
+            'p50_ms': percentile(0.5),
+            'p90_ms': percentile(0.9),
+            'p99_ms': percentile(0.99),
+            'max_ms': latencies[-1] * 1000 if latencies else 0,
+            'read_syscalls': after.get('syscr', 0) - io.get('syscr', 0),
+            'write_syscalls': after.get('syscw', 0) - io.get('syscw', 0),
+            'subprocesses': spawned.count,
+            }
+
+def git(basedir, *args):
+    subprocess.check_call(('git',) + args, cwd=basedir, stdout=open(os.devnull, 'w'))
+
+def make_repository(basedir, name, files=10):
+    path = os.path.join(basedir, name)
+    os.makedirs(path)
+    git(path, 'init', '-q')
+    git(path, 'config', 'user.name', 'Benchmark')
+    git(path, 'config', 'user.email', 'benchmark@example.com')
+    for i in range(files):
+        open(os.path.join(path, 'file%d' % i), 'w').write('%d\n' % i)
+    git(path, 'add', '.')
+    git(path, 'commit', '-q', '-m', 'initial')
+    return path
+
+def pace(rate, started, done):
+    # Keeps done events on schedule for rate events per second, 0 meaning no limit
+    if rate:
+        delay = started + float(done) / rate - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+@scenario
+def notify(measure, basedir, events, rate):
+    "RepositorySet.notify on paths spread over a few repositories"
+    paths = [ make_repository(basedir, 'repo%d' % i) for i in range(5) ]
+    monitor = RepositorySet(basedir)
+    measure.start()
+    for i in range(events):
+        measure.time(monitor.notify, '%s/dir%d/file%d' % (paths[i % 5], i % 7, i))
+    monitor.flush()
+
+@scenario
+def repository_notify(measure, basedir, events, rate):
+    "Repository.notify, buffered writes to .worklog"
+    repository = Repository(make_repository(basedir, 'repo'))
+    measure.start()
+    for i in range(events):
+        measure.time(repository.notify)
+    repository.flush()
+
+@scenario
+def calculate_time(measure, basedir, events, rate):
+    "calculate_time on a fresh Repository, reading the whole .worklog"
+    path = make_repository(basedir, 'repo')
+    log = open(os.path.join(path, '.worklog'), 'w')
+    now = 10**9
+    for i in range(events * 10):
+        now += (5, 30, 400)[i % 3]
+        log.write('%f\n' % now)
+    log.close()
+    measure.start()
+    for i in range(20):
+        measure.time(lambda: Repository(path).calculate_time())
+
+@scenario
+def is_commit(measure, basedir, events, rate):
+    "is_commit on commits and blobs, through the cat-file cache"
+    path = make_repository(basedir, 'repo', files=50)
+    objects = subprocess.Popen(['git', 'rev-list', '--objects', '--all'], cwd=path,
+                               stdout=subprocess.PIPE).communicate()[0].split()
+    objects = [ obj for obj in objects if len(obj) == 40 ]
+    repository = Repository(path)
+    measure.start()
+    for i in range(events):
+        measure.time(repository.is_commit, objects[i % len(objects)])
+    repository.cat_file.close()
+
+@scenario
+def edit_burst(measure, basedir, events, rate):
+    "Files written at the given rate, then picked up from inotify"
+    path = make_repository(basedir, 'repo')
+    monitor = RepositorySet(basedir)
+    measure.wrap(monitor, 'notify')
+    measure.start()
+    for i in range(events):
+        open(os.path.join(path, 'file%d' % (i % 10)), 'a').write('edit\n')
+        pace(rate, measure.started, i)
+        if i % 100 == 0:
+            monitor.check()
+    monitor.check()
+    monitor.flush()
+
+@scenario
+def bulk_directories(measure, basedir, events, rate):
+    "A deep directory tree appearing at once, as from an unpacked archive"
+    path = make_repository(basedir, 'repo')
+    monitor = RepositorySet(basedir)
+    measure.wrap(monitor, 'register_dir')
+    tree = os.path.join(basedir, 'tree')
+    for i in range(max(1, events / 10)):
+        os.makedirs(os.path.join(tree, 'd%d' % (i % 10), 'd%d' % i))
+        open(os.path.join(tree, 'd%d' % (i % 10), 'd%d' % i, 'file'), 'w').close()
+    measure.start()
+    os.rename(tree, os.path.join(path, 'tree'))
+    monitor.check()
+    monitor.flush()
+
+@scenario
+def object_storm(measure, basedir, events, rate):
+    "Loose objects written in bulk, as by git add of many files"
+    path = make_repository(basedir, 'repo')
+    monitor = RepositorySet(basedir)
+    measure.wrap(monitor, 'notify')
+    measure.start()
+    proc = subprocess.Popen(['git', 'hash-object', '-w', '--stdin-paths'], cwd=path,
+                            stdin=subprocess.PIPE, stdout=open(os.devnull, 'w'))
+    for i in range(events / 10):
+        name = os.path.join(path, 'blob%d' % i)
+        open(name, 'w').write('blob %d\n' % i)
+        proc.stdin.write(name + '\n')
+    proc.stdin.close()
+    proc.wait()
+    monitor.check()
+    monitor.flush()
+
+@scenario
+def commits(measure, basedir, events, rate):
+    "Commits detected and logged to meta/worklog"
+    path = make_repository(basedir, 'repo')
+    monitor = RepositorySet(basedir)
+    measure.wrap(monitor, 'commit')
+    measure.start()
+    for i in range(max(1, events / 100)):
+        open(os.path.join(path, 'file0'), 'a').write('edit\n')
+        git(path, 'commit', '-q', '-a', '-m', 'commit %d' % i)
+        monitor.check()
+    monitor.flush()
+
+def run_scenario(function, events, rate):
+    basedir = tempfile.mkdtemp(prefix='trampometro-benchmark-')
+    try:
+        return Measure().run(function, basedir, events, rate)
+    finally:
+        shutil.rmtree(basedir)
+
+def compare(results, baseline):
+    regressions = []
+    for name, result in sorted(results.items()):
+        old = baseline.get(name)
+        if not old or not old['throughput']:
+            continue
+        change = result['throughput'] / old['throughput'] - 1
+        flag = ''
+        if change < -REGRESSION:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print '%-18s %10.1f/s -> %10.1f/s %+6.1f%%%s' % (name, old['throughput'], result['throughput'], change * 100, flag)
+    return regressions
+
+def main(args):
+    parser = OptionParser(usage='%prog [options] [scenario ...]')
+    parser.add_option('-n', '--events', type='int', default=2000, help='events per scenario')
+    parser.add_option('-r', '--rate', type='float', default=0, help='events per second, 0 for no limit')
+    parser.add_option('-o', '--output', help='save results to this file')
+    parser.add_option('-c', '--compare', help='compare with results saved before')
+    options, names = parser.parse_args(args)
+
+    scenarios = [ function for function in SCENARIOS if not names or function.__name__ in names ]
+    results = {}
+    for function in scenarios:
+        result = results[function.__name__] = run_scenario(function, options.events, options.rate)
+        print '%-18s %8d ops %10.1f/s  p50 %7.3fms  p99 %7.3fms  max %8.3fms  %7d reads %7d writes %4d procs' % (
+            function.__name__, result['operations'], result['throughput'], result['p50_ms'],
+            result['p99_ms'], result['max_ms'], result['read_syscalls'], result['write_syscalls'],
+            result['subprocesses'])
+
+    if options.output:
+        json.dump({ 'events': options.events, 'rate': options.rate, 'time': time.time(),
+                    'results': results }, open(options.output, 'w'), indent=2)
+    if options.compare:
+        print
+        if compare(results, json.load(open(options.compare))['results']):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,8 +1,22 @@
 # -*- coding: utf-8 -*-
 
-import os, random, fudge, time, subprocess
+import os, random, fudge, time, subprocess, threading, json, pyinotify, socket
+import trampometro, trampometro.report, trampometro.sweep, trampometro.shard, trampometro.trace
+from StringIO import StringIO
 from unittest import TestCase
-from trampometro import RepositorySet, Repository, DEFAULT_HEARTBEAT
+from trampometro import RepositorySet, Repository, WorkerPool, DEFAULT_HEARTBEAT, FLUSH_SIZE, FLUSH_INTERVAL, \
+    CATFILE_IDLE_TIMEOUT, DETECT_REFLOG, ANNOTATE_NOTES, BULK_RATE, BULK_QUIET, BULK_STALLED, COMPACTION_SIZE
+from trampometro.report import ReportIndex, parse_worklog, report
+from trampometro.sweep import sweep, sweep_files
+from trampometro.metrics import Metrics, STATS_INTERVAL, merge_snapshots
+from trampometro.trace import TraceWriter, read_trace, replay
+from trampometro.store import ActivityStore
+from trampometro.daemon import Daemon, Client
+from trampometro.sessions import Sessions
+from trampometro.backends import FanotifyBackend, BACKEND_POLL, BACKEND_FANOTIFY
+from trampometro import worklog
+from trampometro.worklog import WORKLOG_BINARY, BinaryLog, HEADER, BINARY_MAGIC
+from trampometro.shard import Coordinator, shard_of
 
 def dev(test):
     test.tags = 'dev'
@@ -42,6 +56,18 @@ class BaseTest(TestCase):
         os.system('git config user.email "trampometro@example.com"')
         os.chdir(current_dir)
 
+    def stdout(self, command):
+        proc = subprocess.Popen(command.split(), stdout=subprocess.PIPE)
+        proc.wait()
+        return proc.stdout.read()
+
+    def make_commit(self):
+        open(self.testfile, 'w').write('hello world')
+        os.chdir('%s/testrepo' % self.basedir)
+        os.system('git add testfile >/dev/null')
+        os.system('git commit -a -m "test commit" >/dev/null')
+        return self.stdout('git rev-parse HEAD').strip(), self.stdout('git rev-parse HEAD:testfile').strip()
+
 class RepositorySetTest(BaseTest):
 
     def test_repository_detection(self):
@@ -68,6 +94,51 @@ class RepositorySetTest(BaseTest):
         self.assertTrue('repo1' in reposet)
         self.assertTrue('repo2' in reposet)
 
+    def test_repositories_are_found_under_several_base_dirs_and_levels(self):
+        self.mkdir('work')
+        self.mkdir('work/client')
+        self.mkdir('personal')
+        self.init_repo('work/client/project')
+        self.init_repo('work/tool')
+        self.init_repo('personal/tool')
+        os.makedirs('%s/personal/too/deep/for/us' % self.basedir)
+        self.init_repo('personal/too/deep/for/us')
+
+        reposet = RepositorySet(['%s/work' % self.basedir, '%s/personal' % self.basedir])
+        self.assertEquals(len(reposet), 3)
+        self.assertTrue('client/project' in reposet)
+        self.assertTrue('tool' in reposet)
+        self.assertTrue('%s/personal/tool' % self.basedir in reposet)
+
+        reposet = RepositorySet('%s/work' % self.basedir, max_depth=1)
+        self.assertEquals(reposet.keys(), ['tool'])
+
+    def test_git_repository_is_loaded_only_when_needed(self):
+        self.init_repo('repo1')
+        reposet = RepositorySet(self.basedir)
+        self.assertTrue(reposet['repo1']._repository is None)
+        self.assertTrue(reposet['repo1'].repository is not None)
+
+    def test_inactive_repositories_are_watched_on_tick(self):
+        self.init_repo('active')
+        self.init_repo('stale')
+        os.system('find %s/stale -exec touch -d "1 year ago" {} +' % self.basedir)
+
+        reposet = RepositorySet(self.basedir)
+        self.assertTrue('%s/active' % self.basedir in reposet.watched)
+        self.assertTrue('%s/stale' % self.basedir not in reposet.watched)
+        self.assertEquals(list(reposet.deferred), ['stale'])
+        self.assertEquals(reposet.next_timeout(), 0)
+
+        reposet.tick()
+        self.assertTrue('%s/stale' % self.basedir in reposet.watched)
+        self.assertEquals(len(reposet.deferred), 0)
+        self.assertEquals(reposet.timings.keys(), ['discovery', 'active watches', 'deferred watches'])
+
+        open('%s/stale/file' % self.basedir, 'w').close()
+        reposet.check()
+        self.assertTrue(len(reposet['stale'].log) > 0)
+
 class RepositoryTest(BaseTest):
 
     def setUp(self):
@@ -193,6 +264,220 @@ class RepositoryTest(BaseTest):
         repo.clear()
         self.assertEquals(repo.calculate_time(heartbeat = 70), 0)
 
+    def test_work_is_accumulated_without_rereading_log(self):
+        monitor = RepositorySet(self.basedir)
+        repo = monitor.get('testrepo')
+
+        for offset in (0, 60, 120, 1000, 1030, 500, 560):
+            self.set_now(10**9 + offset)
+            monitor.notify(self.testfile)
+        self.assertEquals(repo.calculate_time(), 210)
+
+        os.remove(repo.logfile)
+        self.assertEquals(repo.calculate_time(), 210)
+
+    def test_accumulated_work_is_rebuilt_from_log_at_startup(self):
+        monitor = RepositorySet(self.basedir)
+        repo = monitor.get('testrepo')
+
+        for offset in (0, 60, 120, 1000, 1030):
+            self.set_now(10**9 + offset)
+            monitor.notify(self.testfile)
+        repo.flush()
+
+        repo2 = RepositorySet(self.basedir).get('testrepo')
+        self.assertEquals(repo2.calculate_time(), 150)
+        self.assertEquals(repo2.calculate_time(heartbeat = 1000), 1030)
+
+    def disk_log(self, repo):
+        try:
+            return [ float(line) for line in open(repo.logfile) ]
+        except IOError:
+            return []
+
+    def test_activity_is_buffered_until_flush_interval(self):
+        monitor = RepositorySet(self.basedir)
+        repo = monitor.get('testrepo')
+
+        self.set_now(10**9)
+        repo.flush()
+        monitor.notify(self.testfile)
+        self.set_now(10**9 + 1)
+        monitor.notify(self.testfile)
+        self.assertEquals(len(self.disk_log(repo)), 0)
+
+        self.set_now(10**9 + FLUSH_INTERVAL)
+        monitor.notify(self.testfile)
+        self.assertEquals(self.disk_log(repo), [10**9, 10**9 + 1, 10**9 + FLUSH_INTERVAL])
+
+    def test_activity_is_flushed_when_buffer_is_full(self):
+        monitor = RepositorySet(self.basedir)
+        repo = monitor.get('testrepo')
+
+        self.set_now(10**9)
+        repo.flush()
+        for i in range(FLUSH_SIZE - 1):
+            monitor.notify(self.testfile)
+        self.assertEquals(len(self.disk_log(repo)), 0)
+
+        monitor.notify(self.testfile)
+        self.assertEquals(len(self.disk_log(repo)), FLUSH_SIZE)
+
+    def test_idle_buffer_is_flushed_by_monitor(self):
+        monitor = RepositorySet(self.basedir)
+        repo = monitor.get('testrepo')
+
+        self.set_now(10**9)
+        repo.flush()
+        monitor.notify(self.testfile)
+        monitor.tick()
+        self.assertEquals(len(self.disk_log(repo)), 0)
+
+        self.set_now(10**9 + FLUSH_INTERVAL)
+        monitor.tick()
+        self.assertEquals(self.disk_log(repo), [10**9])
+
+class PathResolutionTest(BaseTest):
+
+    def setUp(self):
+        super(PathResolutionTest, self).setUp()
+        self.init_repo('outer')
+        self.outer = '%s/outer' % self.basedir
+
+    def test_events_are_resolved_without_realpath(self):
+        monitor = RepositorySet(self.basedir)
+        repo = monitor.get('outer')
+
+        fake = fudge.Fake('realpath', callable=True).raises(AssertionError('realpath called'))
+        patch = fudge.patch_object(os.path, 'realpath', fake)
+        try:
+            monitor.notify('%s/file' % self.outer)
+            monitor.notify('%s/dir/file' % self.outer)
+        finally:
+            patch.restore()
+        self.assertEquals(len(repo.log), 2)
+
+    def test_nested_repository_gets_its_own_activity(self):
+        self.init_repo('outer/inner')
+        monitor = RepositorySet(self.basedir)
+        outer, inner = monitor.get('outer'), monitor.get('outer/inner')
+        self.assertTrue(inner is not None)
+
+        monitor.notify('%s/inner/file' % self.outer)
+        self.assertEquals(len(inner.log), 1)
+        self.assertEquals(len(outer.log), 0)
+        self.assertEquals(monitor.status, 'Working on outer/inner')
+
+        monitor.notify('%s/file' % self.outer)
+        self.assertEquals(len(outer.log), 1)
+
+    def test_repository_created_while_watching_gets_its_own_activity(self):
+        os.mkdir('%s/lib' % self.outer)
+        monitor = RepositorySet(self.basedir)
+        self.init_repo('outer/lib')
+        monitor.check()
+        self.assertEquals(sorted(monitor.keys()), ['outer', 'outer/lib'])
+        monitor.get('outer').clear()
+        monitor.status = 'IDLE'
+
+        open('%s/lib/file' % self.outer, 'w').write('hello')
+        monitor.check()
+        self.assertEquals(monitor.status, 'Working on outer/lib')
+        self.assertEquals(len(monitor.get('outer').log), 0)
+        self.assertTrue(len(monitor.get('outer/lib').log) > 0)
+        self.assertEquals(monitor.resolve('%s/lib/.git/HEAD' % self.outer), ('outer/lib', '.git/HEAD', 'HEAD'))
+
+    def test_submodule_activity_and_commits_are_attributed_to_submodule(self):
+        self.init_repo('lib')
+        os.system('cd %s/lib && touch libfile && git add libfile && git commit -q -m lib' % self.basedir)
+        os.system('cd %s && git -c protocol.file.allow=always submodule -q add %s/lib lib 2>/dev/null' % (self.outer, self.basedir))
+        os.system('cd %s/lib && git config user.name "Trampometro tester" && git config user.email "trampometro@example.com"' % self.outer)
+
+        monitor = RepositorySet(self.basedir)
+        submodule = monitor.get('outer/lib')
+        self.assertEquals(submodule.gitdir, '%s/.git/modules/lib' % self.outer)
+
+        self.set_now(10**9)
+        open('%s/lib/libfile' % self.outer, 'w').write('change')
+        monitor.check()
+        self.set_now(10**9 + 60)
+        open('%s/lib/libfile' % self.outer, 'a').write('more')
+        monitor.check()
+        self.assertEquals(len(monitor.get('outer').log), 0)
+
+        os.system('cd %s/lib && git commit -q -a -m "Submodule change"' % self.outer)
+        monitor.check()
+
+        content = [ line.strip() for line in open('%s/lib/meta/worklog' % self.outer) ]
+        self.assertTrue('Submodule change' in content)
+        self.assertTrue('00:01:00' in content)
+
+    def test_overflow_walks_each_directory_once(self):
+        self.init_repo('outer/inner')
+        os.makedirs('%s/inner/src/lib' % self.outer)
+        os.mkdir('%s/build' % self.outer)
+        monitor = RepositorySet(self.basedir)
+        self.assertTrue('%s/build' % self.outer in monitor.watched)
+        # Both unseen, as their events were dropped
+        open('%s/.gitignore' % self.outer, 'w').write('build\n')
+        os.mkdir('%s/inner/src/new' % self.outer)
+
+        scanned = []
+        scan = trampometro.scan
+        def counting_scan(path):
+            scanned.append(path)
+            return scan(path)
+        patch = fudge.patch_object(trampometro, 'scan', counting_scan)
+        try:
+            monitor.get('outer').ignore.reload()
+            monitor.overflow()
+        finally:
+            patch.restore()
+        self.assertEquals(len(scanned), len(set(scanned)))
+        self.assertTrue('%s/inner/src/new' % self.outer in monitor.watched)
+        self.assertFalse('%s/build' % self.outer in monitor.watched)
+
+    def test_symlinked_checkout_is_resolved_through_both_paths(self):
+        self.init_repo('elsewhere')
+        os.rename('%s/elsewhere' % self.basedir, '%s-elsewhere' % self.basedir)
+        os.symlink('%s-elsewhere' % self.basedir, '%s/link' % self.basedir)
+        try:
+            monitor = RepositorySet(self.basedir)
+            repo = monitor.get('link')
+            monitor.notify('%s/link/file' % self.basedir)
+            monitor.notify('%s-elsewhere/file' % self.basedir)
+            self.assertEquals(len(repo.log), 2)
+        finally:
+            os.system('rm -rf %s-elsewhere' % self.basedir)
+
+    def test_deleted_and_moved_directories_are_reindexed(self):
+        os.makedirs('%s/a/sub' % self.outer)
+        monitor = RepositorySet(self.basedir)
+        repo = monitor.get('outer')
+
+        os.rename('%s/a' % self.outer, '%s/b' % self.outer)
+        monitor.check()
+        self.assertTrue('%s/a' % self.outer not in monitor.watched)
+        self.assertTrue('%s/a/sub' % self.outer not in monitor.watched)
+        self.assertTrue('%s/b/sub' % self.outer in monitor.watched)
+
+        repo.clear()
+        open('%s/b/sub/file' % self.outer, 'w').close()
+        monitor.check()
+        self.assertTrue(len(repo.log) > 0)
+
+        os.system('rm -rf %s/b' % self.outer)
+        monitor.check()
+        self.assertEquals([ path for path in monitor.watched if path.startswith('%s/b' % self.outer) ], [])
+
+    def test_removed_repository_is_forgotten(self):
+        self.init_repo('other')
+        monitor = RepositorySet(self.basedir)
+        os.system('rm -rf %s/other' % self.basedir)
+        monitor.check()
+        self.assertTrue('other' not in monitor)
+        self.assertTrue('outer' in monitor)
+
 class FileSystemMonitoringTest(BaseTest):
 
     def test_monitor_is_notified_when_file_changes(self):
@@ -220,6 +505,33 @@ class FileSystemMonitoringTest(BaseTest):
         self.assertTrue(len(repo.log) > 0)        
         repo.clear()
 
+    def test_new_directory_tree_is_watched_once_and_logged_once(self):
+        self.init_repo('testrepo')
+        monitor = RepositorySet(self.basedir)
+        repo = monitor.get('testrepo')
+        repo.clear()
+
+        added = []
+        add_watch = monitor.wm.add_watch
+        def counting_add_watch(path, *args, **kwargs):
+            added.append(path)
+            return add_watch(path, *args, **kwargs)
+        monitor.wm.add_watch = counting_add_watch
+
+        tree = os.path.join(self.basedir, 'testrepo', 'tree')
+        directories = [ tree ]
+        for first in 'abc':
+            for second in 'xyz':
+                directories.append(os.path.join(tree, first))
+                directories.append(os.path.join(tree, first, second))
+                os.makedirs(os.path.join(tree, first, second))
+                for i in range(10):
+                    open(os.path.join(tree, first, second, 'file%d' % i), 'w').close()
+        monitor.check()
+
+        self.assertEquals(sorted(added), sorted(set(directories)))
+        self.assertEquals(len(repo.log), 1)
+
     def test_if_new_directory_is_created_and_instantly_removed_error_does_not_happen(self):
         self.init_repo('testrepo')
         monitor = RepositorySet(self.basedir)
@@ -241,11 +553,6 @@ class CommitTest(BaseTest):
         self.init_repo('testrepo')
         self.testfile = '%s/testrepo/testfile' % self.basedir
 
-    def stdout(self, command):
-        proc = subprocess.Popen(command.split(), stdout=subprocess.PIPE)
-        proc.wait()
-        return proc.stdout.read()
-        
     def test_commit(self):
         monitor = RepositorySet(self.basedir)
         repo = monitor.get('testrepo')
@@ -335,6 +642,45 @@ class CommitTest(BaseTest):
         self.assertTrue(not repo.is_commit('d34a3a0c29dbfab0dc7469cb6f7afeb52d6d1edd'))
         self.assertTrue(repo.is_commit('f7eb24d3aeb8d6ac71f147eaad97fd44192d6365'))
 
+    def test_object_types_are_read_from_a_persistent_cat_file(self):
+        repo = RepositorySet(self.basedir).get('testrepo')
+        commit_id, blob_id = self.make_commit()
+
+        self.assertTrue(repo.is_commit(commit_id))
+        proc = repo.cat_file.processes['--batch-check']
+        self.assertTrue(not repo.is_commit(blob_id))
+        self.assertTrue(not repo.is_commit('0' * 40))
+        self.assertTrue(repo.cat_file.processes['--batch-check'] is proc)
+        self.assertTrue('Trampometro tester' in repo.cat_file.contents(commit_id))
+        repo.cat_file.close()
+
+    def test_cat_file_is_restarted_if_it_dies(self):
+        repo = RepositorySet(self.basedir).get('testrepo')
+        commit_id, blob_id = self.make_commit()
+
+        self.assertTrue(repo.is_commit(commit_id))
+        repo.cat_file.processes['--batch-check'].kill()
+        repo.cat_file.processes['--batch-check'].wait()
+        self.assertTrue(not repo.is_commit(blob_id))
+        repo.cat_file.close()
+
+    def test_cat_file_is_closed_when_idle(self):
+        monitor = RepositorySet(self.basedir)
+        repo = monitor.get('testrepo')
+        commit_id, blob_id = self.make_commit()
+
+        self.set_now(10**9)
+        # Objects of the commit are checked as their events come, and the
+        # commit is read to be logged
+        monitor.check()
+        self.assertEquals(sorted(repo.cat_file.processes), ['--batch', '--batch-check'])
+
+        self.set_now(10**9 + CATFILE_IDLE_TIMEOUT)
+        monitor.tick()
+        self.assertEquals(len(repo.cat_file.processes), 0)
+        self.assertTrue(repo.is_commit(commit_id))
+        repo.cat_file.close()
+
     def test_pull_is_not_considered(self):
 
         os.chdir(self.basedir)
@@ -372,6 +718,268 @@ class CommitTest(BaseTest):
         self.assertTrue('second commit' in content)
         self.assertTrue('00:01:50' in content)
 
+class BackgroundCommitTest(BaseTest):
+
+    def setUp(self):
+        super(BackgroundCommitTest, self).setUp()
+        self.init_repo('testrepo')
+        self.testfile = '%s/testrepo/testfile' % self.basedir
+
+    def test_commit_is_logged_in_background(self):
+        monitor = RepositorySet(self.basedir, background=True)
+        try:
+            self.set_now(10**9)
+            open(self.testfile, 'w').write('hello')
+            monitor.check()
+            self.set_now(10**9 + 45)
+            open(self.testfile, 'a').write(' world')
+            monitor.check()
+
+            os.chdir('%s/testrepo' % self.basedir)
+            os.system('git add testfile >/dev/null')
+            os.system('git commit -a -m "Background message" >/dev/null')
+            monitor.check()
+            self.assertEquals(monitor.status, 'testrepo 00:00:45')
+            monitor.wait()
+            monitor.check()
+            monitor.wait()
+        finally:
+            monitor.workers.stop()
+
+        content = [ line.strip() for line in open('meta/worklog') ]
+        self.assertEquals(content.count('Background message'), 1)
+        self.assertTrue('00:00:45' in content)
+        self.assertTrue('nothing to commit' in self.stdout('git status meta'))
+
+    def test_commit_made_while_logging_is_not_lost(self):
+        monitor = RepositorySet(self.basedir, background=True)
+        repository = monitor['testrepo']
+        log_commit = repository.log_commit
+        committed, handled = threading.Event(), threading.Event()
+        def log_and_commit_again(object_id, worked_time):
+            log_commit(object_id, worked_time)
+            os.system('cd %s/testrepo && echo again >> testfile && git commit -q -a -m "Second message"' % self.basedir)
+            committed.set()
+            # Its events are seen before we are done
+            handled.wait(5)
+        repository.log_commit = log_and_commit_again
+        try:
+            self.make_commit()
+            monitor.check()
+            self.assertTrue(repository.busy)
+            committed.wait(5)
+            monitor.check()
+            handled.set()
+            monitor.wait()
+            monitor.check()
+            monitor.wait()
+        finally:
+            handled.set()
+            monitor.workers.stop()
+
+        content = [ line.strip() for line in open('meta/worklog') ]
+        self.assertEquals(content.count('Second message'), 1)
+        self.assertEquals(self.stdout('git log -1 --format=%s').strip(), 'Second message')
+
+    def test_repositories_are_committed_in_parallel(self):
+        self.init_repo('otherrepo')
+        monitor = RepositorySet(self.basedir, background=True)
+        try:
+            for name in ('testrepo', 'otherrepo'):
+                open('%s/%s/testfile' % (self.basedir, name), 'w').write(name)
+                os.system('cd %s/%s && git add testfile && git commit -q -m "%s commit"' % (self.basedir, name, name))
+            cwd = os.getcwd()
+            monitor.check()
+            monitor.wait()
+            self.assertEquals(os.getcwd(), cwd)
+        finally:
+            monitor.workers.stop()
+
+        for name in ('testrepo', 'otherrepo'):
+            content = [ line.strip() for line in open('%s/%s/meta/worklog' % (self.basedir, name)) ]
+            self.assertTrue('%s commit' % name in content)
+
+    def test_worker_lanes_keep_order_and_run_in_parallel(self):
+        pool = WorkerPool(2)
+        blocker = threading.Event()
+        done = []
+        try:
+            pool.submit('slow', blocker.wait)
+            pool.submit('slow', done.append, 'slow 1')
+            pool.submit('slow', done.append, 'slow 2')
+            finished = threading.Event()
+            pool.submit('fast', finished.set)
+            finished.wait(5)
+            self.assertTrue(finished.is_set())
+            self.assertEquals(done, [])
+
+            blocker.set()
+            pool.wait()
+            self.assertEquals(done, ['slow 1', 'slow 2'])
+        finally:
+            blocker.set()
+            pool.stop()
+
+    def test_commits_missed_on_queue_overflow_are_recovered(self):
+        monitor = RepositorySet(self.basedir)
+
+        self.set_now(10**9)
+        monitor.notify(self.testfile)
+        self.set_now(10**9 + 30)
+        monitor.notify(self.testfile)
+
+        self.make_commit()
+        os.mkdir('newdir')
+        monitor.overflow()
+
+        content = [ line.strip() for line in open('meta/worklog') ]
+        self.assertTrue('test commit' in content)
+        self.assertTrue('00:00:30' in content)
+        self.assertTrue(monitor.wm.get_wd('%s/testrepo/newdir' % self.basedir) is not None)
+
+class ReflogCommitTest(BaseTest):
+
+    def setUp(self):
+        super(ReflogCommitTest, self).setUp()
+        self.init_repo('testrepo')
+        self.testfile = '%s/testrepo/testfile' % self.basedir
+
+    def watched_paths(self, monitor):
+        return [ watch.path for watch in monitor.wm.watches.values() ]
+
+    def test_objects_are_not_watched(self):
+        self.make_commit()
+        monitor = RepositorySet(self.basedir, commit_detection=DETECT_REFLOG)
+
+        watched = self.watched_paths(monitor)
+        self.assertTrue('%s/testrepo/.git' % self.basedir in watched)
+        self.assertTrue('%s/testrepo/.git/refs/heads' % self.basedir in watched)
+        self.assertTrue(not [ path for path in watched if '/.git/objects' in path ])
+
+    def test_commit_is_detected_from_reflog(self):
+        monitor = RepositorySet(self.basedir, commit_detection=DETECT_REFLOG)
+
+        self.set_now(10**9)
+        open(self.testfile, 'w').write('hello')
+        monitor.check()
+        self.set_now(10**9 + 90)
+        open(self.testfile, 'a').write(' world')
+        monitor.check()
+
+        os.chdir('%s/testrepo' % self.basedir)
+        os.system('git add testfile >/dev/null')
+        os.system('git commit -a -m "Reflog message" >/dev/null')
+        monitor.check()
+
+        content = [ line.strip() for line in open('meta/worklog') ]
+        self.assertTrue('Reflog message' in content)
+        self.assertTrue('00:01:30' in content)
+        self.assertEquals(content.count('Reflog message'), 1)
+
+    def test_pull_is_not_considered_from_reflog(self):
+        self.make_commit()
+        os.chdir(self.basedir)
+        os.system('git clone testrepo testclone 2>/dev/null >/dev/null')
+
+        os.chdir('%s/testrepo' % self.basedir)
+        open('somefile', 'w').write('hello world')
+        os.system('git add somefile >/dev/null')
+        os.system('git commit -a -m "upstream commit" >/dev/null')
+
+        monitor = RepositorySet(self.basedir, commit_detection=DETECT_REFLOG)
+        os.chdir('%s/testclone' % self.basedir)
+        os.system('git config user.name "Trampometro tester"')
+        os.system('git config user.email "trampometro@example.com"')
+
+        self.set_now(10**9)
+        open('testfile', 'w').write('hello')
+        monitor.check()
+        os.system('git pull >/dev/null 2>/dev/null')
+        monitor.check()
+        self.assertTrue(not os.path.exists('meta/worklog'))
+
+        self.set_now(10**9 + 30)
+        open('testfile', 'a').write('!!')
+        monitor.check()
+        os.system('git commit -a -m "local commit" 2>/dev/null > /dev/null')
+        monitor.check()
+
+        content = [ line.strip() for line in open('meta/worklog') ]
+        self.assertTrue('local commit' in content)
+        self.assertTrue('upstream commit' not in content)
+
+class IgnoreTest(BaseTest):
+
+    def setUp(self):
+        super(IgnoreTest, self).setUp()
+        self.init_repo('testrepo')
+        self.repodir = '%s/testrepo' % self.basedir
+
+    def write(self, path, content=''):
+        open(os.path.join(self.repodir, path), 'w').write(content)
+
+    def makedirs(self, path):
+        os.makedirs(os.path.join(self.repodir, path))
+
+    def test_gitignore_patterns(self):
+        self.makedirs('sub')
+        self.write('.gitignore', 'build/\n*.o\n!keep.o\n/rootonly\ndocs/**/*.tmp\n')
+        self.write('sub/.gitignore', 'local\n')
+        ignore = RepositorySet(self.basedir).get('testrepo').ignore
+
+        self.assertTrue(ignore.ignored('build', True))
+        self.assertTrue(ignore.ignored('build/lib/x.py'))
+        self.assertTrue(not ignore.ignored('build'))
+        self.assertTrue(ignore.ignored('src/main.o'))
+        self.assertTrue(not ignore.ignored('src/keep.o'))
+        self.assertTrue(ignore.ignored('rootonly'))
+        self.assertTrue(not ignore.ignored('src/rootonly'))
+        self.assertTrue(ignore.ignored('docs/a/b/c.tmp'))
+        self.assertTrue(ignore.ignored('sub/local'))
+        self.assertTrue(not ignore.ignored('local'))
+        self.assertTrue(not ignore.ignored('src/main.c'))
+
+    def test_ignored_paths_are_not_logged(self):
+        self.write('.gitignore', '*.o\n')
+        self.write('.git/info/exclude', 'scratch\n')
+        monitor = RepositorySet(self.basedir)
+        repo = monitor.get('testrepo')
+
+        monitor.notify('%s/main.o' % self.repodir)
+        monitor.notify('%s/scratch' % self.repodir)
+        self.assertEquals(len(repo.log), 0)
+
+        monitor.notify('%s/main.c' % self.repodir)
+        self.assertEquals(len(repo.log), 1)
+
+    def test_ignored_directories_are_not_watched(self):
+        self.write('.gitignore', 'node_modules/\n')
+        self.makedirs('node_modules/lib/deep')
+        self.makedirs('src')
+        monitor = RepositorySet(self.basedir)
+
+        watched = [ watch.path for watch in monitor.wm.watches.values() ]
+        self.assertTrue('%s/src' % self.repodir in watched)
+        self.assertTrue(not [ path for path in watched if 'node_modules' in path ])
+
+    def test_rules_are_reloaded_when_gitignore_changes(self):
+        self.makedirs('out')
+        monitor = RepositorySet(self.basedir)
+        repo = monitor.get('testrepo')
+        self.assertTrue(monitor.wm.get_wd('%s/out' % self.repodir) is not None)
+
+        self.write('.gitignore', 'out/\n')
+        monitor.check()
+        repo.clear()
+
+        self.assertTrue(monitor.wm.get_wd('%s/out' % self.repodir) is None)
+        monitor.notify('%s/out/file' % self.repodir)
+        self.assertEquals(len(repo.log), 0)
+
+        self.write('.gitignore', '')
+        monitor.check()
+        self.assertTrue(monitor.wm.get_wd('%s/out' % self.repodir) is not None)
+
 class StatusTest(BaseTest):
 
     def setUp(self):
@@ -396,6 +1004,43 @@ class StatusTest(BaseTest):
         self.monitor.check()
         self.assertEquals(self.monitor.status, 'Working on repo1')
 
+    def test_status_changes_are_notified(self):
+        changes = []
+        self.monitor.add_listener(changes.append)
+
+        open('repo1/asdf', 'w').close()
+        self.monitor.check()
+        open('repo1/asdf', 'w').close()
+        self.monitor.check()
+        open('repo2/asdf', 'w').close()
+        self.monitor.check()
+
+        self.assertEquals(changes, ['Working on repo1', 'Working on repo2'])
+
+    def test_events_are_processed_from_fileno_without_waiting(self):
+        self.monitor.process()
+        self.assertEquals(self.monitor.status, 'IDLE')
+
+        open('repo1/asdf', 'w').close()
+        self.monitor.process()
+        self.assertEquals(self.monitor.status, 'Working on repo1')
+        self.assertTrue(self.monitor.fileno() > 0)
+
+    def test_next_timeout_is_idle_deadline(self):
+        self.set_now(100)
+        self.assertEquals(self.monitor.next_timeout(), None)
+
+        open('repo1/asdf', 'w').close()
+        self.monitor.process()
+        self.monitor.flush()
+        self.assertEquals(self.monitor.next_timeout(), DEFAULT_HEARTBEAT)
+
+        self.set_now(100 + DEFAULT_HEARTBEAT + 1)
+        self.assertEquals(self.monitor.next_timeout(), 0)
+        self.monitor.tick()
+        self.assertEquals(self.monitor.status, 'IDLE')
+        self.assertEquals(self.monitor.next_timeout(), None)
+
     def test_inactivity_makes_status_idle(self):
         self.assertEquals(self.monitor.status, 'IDLE')
         self.monitor.check()
@@ -432,3 +1077,989 @@ class StatusTest(BaseTest):
 
 
         
+
+JOHN = 'John <john@example.com>'
+MARY = 'Mary <mary@example.com>'
+
+class ReportTest(BaseTest):
+
+    def setUp(self):
+        super(ReportTest, self).setUp()
+        self.init_repo('repo1')
+        self.init_repo('repo2')
+        self.index = ReportIndex('%s/index.json' % self.basedir)
+
+    def log_entry(self, repo, author, worked, summary, date):
+        os.chdir('%s/%s' % (self.basedir, repo))
+        if not os.path.isdir('meta'):
+            os.mkdir('meta')
+        open('meta/worklog', 'a').write('\n%s\n%s\n%s\n' % (author, worked, summary))
+        os.system('git add meta/worklog')
+        os.system('GIT_AUTHOR_DATE="%s 12:00" GIT_COMMITTER_DATE="%s 12:00" git commit -q -m "%s"' % (date, date, summary))
+
+    def repositories(self):
+        return { 'repo1': '%s/repo1' % self.basedir, 'repo2': '%s/repo2' % self.basedir }
+
+    def test_incomplete_entry_is_left_for_later(self):
+        first = '\n%s\n01:00:00\nfirst\n' % JOHN
+        worklog = StringIO(first + '\n%s\n00:30:00\n' % MARY)
+        entries = list(parse_worklog(worklog))
+        self.assertEquals(entries, [(JOHN, 3600, 'first', len(first))])
+        worklog = StringIO(worklog.getvalue() + 'second\n')
+        self.assertEquals(list(parse_worklog(worklog, len(first))),
+                          [(MARY, 1800, 'second', len(worklog.getvalue()))])
+
+    def test_totals_by_repository_author_day_and_week(self):
+        self.log_entry('repo1', JOHN, '01:00:00', 'first', '2011-03-07')
+        self.log_entry('repo1', MARY, '00:30:00', 'second', '2011-03-08')
+        self.log_entry('repo2', JOHN, '00:15:00', 'third', '2011-03-14')
+
+        rows, total = report(self.index, self.repositories())
+        self.assertEquals(rows, [('repo1', 5400), ('repo2', 900)])
+        self.assertEquals(total, 6300)
+
+        rows, total = report(self.index, self.repositories(), 'author')
+        self.assertEquals(rows, [(JOHN, 4500), (MARY, 1800)])
+        rows, total = report(self.index, self.repositories(), 'week')
+        self.assertEquals(rows, [('2011-W10', 5400), ('2011-W11', 900)])
+        rows, total = report(self.index, self.repositories(), 'day', since='2011-03-08', author='John')
+        self.assertEquals(rows, [('2011-03-14', 900)])
+
+    def test_index_is_updated_incrementally(self):
+        self.log_entry('repo1', JOHN, '01:00:00', 'first', '2011-03-07')
+        report(self.index, self.repositories())
+        self.index.save()
+
+        self.log_entry('repo1', JOHN, '00:10:00', 'second', '2011-03-07')
+        index = ReportIndex(self.index.filename)
+        offset = index.repositories['%s/repo1' % self.basedir]['offset']
+
+        parsed = []
+        def spy(worklog, offset=0):
+            parsed.append(offset)
+            return parse_worklog(worklog, offset)
+        patch = fudge.patch_object(trampometro.report, 'parse_worklog', spy)
+        try:
+            rows, total = report(index, self.repositories())
+            report(index, self.repositories())
+        finally:
+            patch.restore()
+        self.assertEquals(parsed, [offset])
+        self.assertEquals(rows, [('repo1', 4200)])
+
+    def test_rewritten_worklog_is_indexed_again(self):
+        self.log_entry('repo1', JOHN, '01:00:00', 'first', '2011-03-07')
+        self.log_entry('repo1', JOHN, '01:00:00', 'second', '2011-03-07')
+        report(self.index, self.repositories())
+
+        os.system('git reset -q --hard HEAD~1')
+        rows, total = report(self.index, self.repositories())
+        self.assertEquals(rows, [('repo1', 3600)])
+
+    def test_entries_are_dated_by_the_commit_adding_them(self):
+        self.log_entry('repo1', JOHN, '01:00:00', 'first', '2011-03-07')
+        # Appended, but not amended into a commit yet
+        open('meta/worklog', 'a').write('\n%s\n00:30:00\nsecond\n' % JOHN)
+        self.assertEquals(report(self.index, self.repositories(), 'day')[0], [('2011-03-07', 3600)])
+
+        os.system('echo change > file && git add file meta/worklog')
+        os.system('GIT_AUTHOR_DATE="2011-03-09 12:00" GIT_COMMITTER_DATE="2011-03-09 12:00" git commit -q -m second')
+        # A commit not touching the worklog dates nothing
+        os.system('echo more >> file && GIT_AUTHOR_DATE="2011-03-10 12:00" git commit -q -a -m third')
+        self.assertEquals(report(self.index, self.repositories(), 'day')[0],
+                          [('2011-03-07', 3600), ('2011-03-09', 1800)])
+
+    def test_entries_without_author_are_parsed(self):
+        worklog = StringIO('\nold one\n00:10:00\n\n%s\n01:00:00\nnew one\n' % JOHN)
+        self.assertEquals([ entry[:3] for entry in parse_worklog(worklog) ],
+                          [('', 600, 'old one'), (JOHN, 3600, 'new one')])
+
+    def test_empty_summary_and_broken_entries_are_parsed(self):
+        # git commit --allow-empty-message logs an empty summary
+        worklog = StringIO('\n%s\n00:10:00\n\n\n%s\n00:05:00\nsecond\n' % (JOHN, MARY) +
+                           '\n%s\nbroken\nthird\n\nold one\n00:01:00\n' % JOHN)
+        self.assertEquals([ entry[:3] for entry in parse_worklog(worklog) ],
+                          [(JOHN, 600, ''), (MARY, 300, 'second'), ('', 60, 'old one')])
+
+class SweepTest(BaseTest):
+
+    def setUp(self):
+        super(SweepTest, self).setUp()
+        self.init_repo('repo1')
+        self.repo = Repository('%s/repo1' % self.basedir)
+        generator = random.Random(42)
+        self.now = 10**9
+        for i in range(500):
+            # Mostly short gaps, some long pauses and a few clock skews backwards
+            self.now += generator.choice([5, 30, 120, 400, 2000, -50])
+            self.set_now(self.now)
+            self.repo.notify()
+        self.repo.flush()
+        self.heartbeats = [0, 60, 120, 300, 600, 3600]
+
+    def test_sweep_matches_calculate_time(self):
+        expected = [ self.repo.calculate_time(heartbeat) for heartbeat in self.heartbeats ]
+        self.assertEquals(sweep(self.repo.log, self.heartbeats), expected)
+        self.assertEquals(sweep_files([self.repo.logfile], self.heartbeats), expected)
+
+    def test_pure_python_fallback_gives_the_same_result(self):
+        expected = sweep(self.repo.log, self.heartbeats)
+        patch = fudge.patch_object(trampometro.sweep, 'numpy', None)
+        try:
+            self.assertEquals(sweep(self.repo.log, self.heartbeats), expected)
+        finally:
+            patch.restore()
+
+class MetricsTest(BaseTest):
+
+    def setUp(self):
+        super(MetricsTest, self).setUp()
+        self.init_repo('repo1')
+        self.stats_file = '%s/stats/stats.json' % self.basedir
+        self.monitor = RepositorySet(self.basedir, stats_file=self.stats_file)
+
+    def test_events_are_counted_per_mask_and_repository(self):
+        open('%s/repo1/.gitignore' % self.basedir, 'w').write('*.pyc\n')
+        self.monitor.reload_ignore('repo1')
+        self.monitor.notify('%s/repo1/file' % self.basedir, 'IN_CLOSE_WRITE')
+        self.monitor.notify('%s/repo1/file.pyc' % self.basedir, 'IN_CLOSE_WRITE')
+        self.monitor.notify('%s/repo1/.worklog' % self.basedir, 'IN_CLOSE_WRITE')
+        self.monitor.notify('/elsewhere/file', 'IN_CREATE')
+
+        counters = self.monitor.metrics.counters
+        self.assertEquals(counters['events.IN_CLOSE_WRITE'], 3)
+        self.assertEquals(counters['events.IN_CREATE'], 1)
+        self.assertEquals(counters['repository.repo1.events'], 2)
+        self.assertEquals(counters['events.dropped.ignored'], 1)
+        self.assertEquals(counters['events.dropped.worklog'], 1)
+        self.assertEquals(counters['events.dropped.unknown'], 1)
+        self.assertEquals(self.monitor.metrics.histograms['notify.us'].count, 4)
+
+    def test_histogram_buckets_are_powers_of_two(self):
+        metrics = Metrics()
+        for value in (1, 3, 3, 100, 1000):
+            metrics.observe('latency', value)
+        snapshot = metrics.snapshot()['histograms']['latency']
+        self.assertEquals(snapshot['buckets'], { 2: 1, 4: 2, 128: 1, 1024: 1 })
+        self.assertEquals(snapshot['p50'], 4)
+        self.assertEquals(snapshot['max'], 1000)
+
+    def test_snapshots_are_merged(self):
+        first, second = Metrics(), Metrics()
+        first.count('events', 2)
+        second.count('events')
+        second.count('commits')
+        for value in (1, 3):
+            first.observe('latency', value)
+        for value in (3, 100):
+            second.observe('latency', value)
+        merged = merge_snapshots([first.snapshot({ 'watches': 10 }), second.snapshot({ 'watches': 5 })])
+        self.assertEquals(merged['counters'], { 'events': 3, 'commits': 1 })
+        self.assertEquals(merged['gauges'], { 'watches': 15 })
+        self.assertEquals(merged['histograms']['latency']['buckets'], { 2: 1, 4: 2, 128: 1 })
+        self.assertEquals((merged['histograms']['latency']['count'], merged['histograms']['latency']['max']), (4, 100))
+
+    def test_stats_file_is_rewritten_while_metrics_change(self):
+        self.set_now(1000)
+        self.monitor.tick()
+        self.assertFalse(os.path.exists(self.stats_file))
+
+        self.monitor.notify('%s/repo1/file' % self.basedir, 'IN_CLOSE_WRITE')
+        self.assertEquals(self.monitor.next_timeout(), 0)
+        self.monitor.tick()
+        stats = json.load(open(self.stats_file))
+        self.assertEquals(stats['counters']['events.IN_CLOSE_WRITE'], 1)
+        self.assertEquals(stats['gauges']['repositories'], 1)
+        self.assertTrue(stats['gauges']['watches'] > 0)
+
+        self.monitor.notify('%s/repo1/file' % self.basedir, 'IN_CLOSE_WRITE')
+        self.monitor.tick()
+        self.assertEquals(json.load(open(self.stats_file))['counters']['events.IN_CLOSE_WRITE'], 1)
+        self.set_now(1000 + STATS_INTERVAL)
+        self.monitor.tick()
+        self.assertEquals(json.load(open(self.stats_file))['counters']['events.IN_CLOSE_WRITE'], 2)
+
+class TraceTest(BaseTest):
+
+    def setUp(self):
+        super(TraceTest, self).setUp()
+        self.init_repo('repo1')
+        self.trace = '%s/trace' % self.basedir
+
+    def test_events_are_recorded_and_replayed(self):
+        monitor = RepositorySet(self.basedir, trace=self.trace)
+        os.mkdir('%s/repo1/dir' % self.basedir)
+        monitor.check()
+        open('%s/repo1/dir/file' % self.basedir, 'w').write('hello')
+        monitor.check()
+        monitor.flush()
+        recorded = monitor['repo1'].log
+        self.assertTrue(len(recorded) >= 3)
+
+        events = list(read_trace(self.trace))
+        self.assertEquals(events[0][1:], (pyinotify.IN_CREATE | pyinotify.IN_ISDIR, '%s/repo1/dir' % self.basedir))
+        self.assertEquals(len(events), len(recorded))
+
+        monitor['repo1'].clear()
+        replayed, seconds = replay(self.trace, RepositorySet(self.basedir))
+        self.assertEquals(replayed, len(events))
+        # Logged at the recorded time of each event, not at replay time
+        self.assertEquals(monitor['repo1'].log, [ float('%.6f' % event[0]) for event in events ])
+
+    def test_replay_uses_simulated_clock_and_prefix_map(self):
+        self.set_now(10**9)
+        writer = TraceWriter(self.trace)
+        for i, path in enumerate(['/old/repo1/a', '/old/repo1/b', '/old/repo1/.worklog', '/old/repo1/c']):
+            writer.record(10**9 + i * 60, pyinotify.IN_CLOSE_WRITE, path)
+        writer.close()
+        open(self.trace, 'a').write('\x00\x01')
+
+        monitor = RepositorySet(self.basedir)
+        replayed, seconds = replay(self.trace, monitor, prefixes=[('/old', self.basedir)])
+        self.assertEquals(replayed, 4)
+        self.assertEquals(monitor['repo1'].log, [10**9, 10**9 + 60, 10**9 + 180])
+        self.assertEquals(monitor['repo1'].calculate_time(), 180)
+        self.assertEquals(time.time(), 10**9)
+
+    def test_replay_leaves_repositories_untouched(self):
+        self.init_repo('testrepo')
+        self.testfile = '%s/testrepo/testfile' % self.basedir
+        commit_id, blob_id = self.make_commit()
+        open('%s/repo1/.worklog' % self.basedir, 'w').write('900\n')
+        writer = TraceWriter(self.trace)
+        writer.record(1000, pyinotify.IN_CLOSE_WRITE, self.testfile)
+        writer.record(1060, pyinotify.IN_CLOSE_WRITE, self.testfile)
+        writer.record(1070, pyinotify.IN_CREATE, '%s/testrepo/.git/objects/%s/%s' %
+                      (self.basedir, commit_id[:2], commit_id[2:]))
+        writer.close()
+
+        trampometro.trace.main([self.trace, self.basedir])
+        self.assertEquals(self.stdout('git rev-parse HEAD').strip(), commit_id)
+        self.assertFalse(os.path.exists('%s/testrepo/.worklog' % self.basedir))
+        self.assertEquals(open('%s/repo1/.worklog' % self.basedir).read(), '900\n')
+
+class StoreTest(BaseTest):
+
+    def setUp(self):
+        super(StoreTest, self).setUp()
+        self.init_repo('repo1')
+        self.init_repo('repo2')
+        self.store = ActivityStore('%s/store/activity.db' % self.basedir)
+
+    def test_activity_goes_to_store_instead_of_worklog(self):
+        monitor = RepositorySet(self.basedir, store=self.store)
+        for now in (1000, 1060, 1120):
+            self.set_now(now)
+            monitor.notify('%s/repo1/file' % self.basedir)
+        monitor.notify('%s/repo2/file' % self.basedir)
+        monitor.flush()
+
+        self.assertFalse(os.path.exists('%s/repo1/.worklog' % self.basedir))
+        self.assertEquals(self.store.timestamps('%s/repo1' % self.basedir), [1000, 1060, 1120])
+        self.assertEquals(self.store.timestamps('%s/repo1' % self.basedir, since=1050, until=1100), [1060])
+        self.assertEquals(Repository('%s/repo1' % self.basedir, store=self.store).calculate_time(), 120)
+
+        monitor['repo1'].clear()
+        self.assertEquals(monitor['repo1'].log, [])
+        self.assertEquals(len(monitor['repo2'].log), 1)
+
+    def test_worklog_is_imported_on_first_start(self):
+        open('%s/repo1/.worklog' % self.basedir, 'w').write('1000.0\n1100.0\n')
+        monitor = RepositorySet(self.basedir, store=self.store.filename)
+        self.assertFalse(os.path.exists('%s/repo1/.worklog' % self.basedir))
+        self.assertEquals(monitor['repo1'].log, [1000, 1100])
+        self.assertEquals(monitor['repo1'].calculate_time(), 100)
+
+        # Imported once only
+        open('%s/repo1/.worklog' % self.basedir, 'w').write('5000.0\n')
+        monitor = RepositorySet(self.basedir, store=self.store.filename)
+        self.assertEquals(monitor['repo1'].log, [1000, 1100])
+
+    def test_store_uses_wal(self):
+        self.assertEquals(self.store.db.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+
+class NotesTest(BaseTest):
+
+    def setUp(self):
+        super(NotesTest, self).setUp()
+        self.init_repo('testrepo')
+        self.testfile = '%s/testrepo/testfile' % self.basedir
+
+    def work(self, monitor, seconds, start=10**9):
+        self.set_now(start)
+        open(self.testfile, 'a').write('hello')
+        monitor.check()
+        self.set_now(start + seconds)
+        open(self.testfile, 'a').write(' world')
+        monitor.check()
+
+    def test_worked_time_is_noted_without_amending(self):
+        monitor = RepositorySet(self.basedir, annotate=ANNOTATE_NOTES)
+        self.work(monitor, 90)
+        first, blob = self.make_commit()
+        monitor.check()
+
+        self.assertEquals(self.stdout('git rev-parse HEAD').strip(), first)
+        self.assertEquals(self.stdout('git notes --ref trampometro show HEAD'), '00:01:30\n')
+        self.assertFalse(os.path.exists('meta'))
+        self.assertEquals(self.stdout('git status --porcelain --untracked-files=no'), '')
+
+        self.work(monitor, 30, 10**9 + 100)
+        os.system('git commit -q -a -m "second commit"')
+        monitor.check()
+        # Counted from the first commit's own events
+        self.assertEquals(self.stdout('git notes --ref trampometro show HEAD'), '00:00:40\n')
+        self.assertEquals(self.stdout('git notes --ref trampometro show HEAD~1'), '00:01:30\n')
+        self.assertEquals(monitor['testrepo'].notes.metrics.counters['git.fast-import'], 1)
+        monitor['testrepo'].notes.close()
+
+    def test_notes_writer_continues_notes_of_earlier_runs(self):
+        monitor = RepositorySet(self.basedir, annotate=ANNOTATE_NOTES)
+        self.work(monitor, 60)
+        self.make_commit()
+        monitor.check()
+        monitor['testrepo'].notes.close()
+
+        monitor = RepositorySet(self.basedir, annotate=ANNOTATE_NOTES)
+        self.work(monitor, 120)
+        os.system('git commit -q -a -m "second commit"')
+        monitor.check()
+        monitor['testrepo'].notes.close()
+        self.assertEquals(self.stdout('git notes --ref trampometro show HEAD~1'), '00:01:00\n')
+        self.assertEquals(self.stdout('git notes --ref trampometro show HEAD'), '00:02:00\n')
+
+    def test_packs_and_notes_are_not_watched(self):
+        monitor = RepositorySet(self.basedir, annotate=ANNOTATE_NOTES)
+        self.work(monitor, 60)
+        self.make_commit()
+        monitor.check()
+        monitor['testrepo'].notes.close()
+        monitor.check()
+
+        gitdir = '%s/testrepo/.git' % self.basedir
+        self.assertTrue('%s/objects' % gitdir in monitor.watched)
+        self.assertTrue('%s/objects/pack' % gitdir not in monitor.watched)
+        self.assertTrue('%s/refs/notes' % gitdir not in monitor.watched)
+
+class BulkOperationTest(BaseTest):
+
+    def setUp(self):
+        super(BulkOperationTest, self).setUp()
+        self.init_repo('testrepo')
+        self.testfile = '%s/testrepo/testfile' % self.basedir
+        self.gitdir = '%s/testrepo/.git' % self.basedir
+        self.monitor = RepositorySet(self.basedir)
+        self.repo = self.monitor['testrepo']
+
+    def test_gc_is_a_bulk_operation(self):
+        self.set_now(1000)
+        open('%s/gc.pid' % self.gitdir, 'w').close()
+        self.monitor.notify('%s/gc.pid' % self.gitdir, 'IN_CREATE')
+        self.assertTrue(self.repo.bulk)
+        for i in range(10):
+            self.monitor.notify('%s/objects/pack/pack-%d' % (self.gitdir, i), 'IN_CREATE')
+        self.assertEquals(self.repo.log, [])
+
+        self.set_now(1000 + BULK_QUIET)
+        self.monitor.tick()
+        self.assertTrue(self.repo.bulk)
+        os.remove('%s/gc.pid' % self.gitdir)
+        self.monitor.tick()
+        self.assertFalse(self.repo.bulk)
+        self.assertEquals(self.monitor.metrics.counters['events.bulk'], 11)
+
+        self.monitor.notify(self.testfile, 'IN_CLOSE_WRITE')
+        self.assertEquals(len(self.repo.log), 1)
+
+    def test_event_storm_is_bulk_only_while_index_is_locked(self):
+        self.set_now(1000)
+        for i in range(BULK_RATE * 2):
+            self.monitor.notify('%s/testrepo/file%d' % (self.basedir, i), 'IN_CLOSE_WRITE')
+        self.assertFalse(self.repo.bulk)
+        self.assertEquals(len(self.repo.log), BULK_RATE * 2)
+
+        self.set_now(1001)
+        open('%s/index.lock' % self.gitdir, 'w').close()
+        for i in range(BULK_RATE * 2):
+            self.monitor.notify('%s/testrepo/file%d' % (self.basedir, i), 'IN_CLOSE_WRITE')
+        self.assertTrue(self.repo.bulk)
+        self.assertEquals(len(self.repo.log), BULK_RATE * 2 + BULK_RATE - 1)
+        os.remove('%s/index.lock' % self.gitdir)
+
+    def test_commits_made_during_bulk_operation_are_logged_after_it(self):
+        self.set_now(1000)
+        open(self.testfile, 'w').write('hello')
+        self.monitor.check()
+        os.mkdir('%s/rebase-merge' % self.gitdir)
+        self.monitor.check()
+        self.assertTrue(self.repo.bulk)
+
+        self.set_now(1060)
+        commit_id, blob_id = self.make_commit()
+        self.monitor.check()
+        self.assertFalse(os.path.exists('meta/worklog'))
+
+        os.rmdir('%s/rebase-merge' % self.gitdir)
+        self.monitor.check()
+        self.assertTrue(self.repo.bulk)
+        self.set_now(1060 + BULK_QUIET)
+        self.monitor.tick()
+        self.assertFalse(self.repo.bulk)
+        content = [ line.strip() for line in open('meta/worklog') ]
+        self.assertTrue('test commit' in content)
+
+    def test_stopped_rebase_does_not_hold_bulk_operation(self):
+        self.set_now(1000)
+        os.mkdir('%s/rebase-merge' % self.gitdir)
+        self.monitor.check()
+        self.assertTrue(self.repo.bulk)
+        self.set_now(1000 + BULK_QUIET)
+        self.monitor.tick()
+        self.assertTrue(self.repo.bulk)
+
+        # Stopped on a conflict, the user edits while rebase-merge is still there
+        self.set_now(1000 + BULK_STALLED)
+        self.monitor.tick()
+        self.assertFalse(self.repo.bulk)
+        open(self.testfile, 'w').write('hello')
+        self.monitor.check()
+        self.assertTrue(self.repo.log)
+        self.assertEquals(self.monitor.status, 'Working on testrepo')
+        self.assertEquals(self.monitor.sessions.sessions['testrepo'][:2], [1000 + BULK_STALLED] * 2)
+        os.rmdir('%s/rebase-merge' % self.gitdir)
+
+class DaemonTest(BaseTest):
+
+    def setUp(self):
+        super(DaemonTest, self).setUp()
+        self.init_repo('testrepo')
+        self.testfile = '%s/testrepo/testfile' % self.basedir
+        self.socket = '%s/run/socket' % self.basedir
+        self.daemon = Daemon(RepositorySet(self.basedir), self.socket)
+        self.client = Client(self.socket)
+
+    def tearDown(self):
+        self.client.close()
+        self.daemon.close()
+        super(DaemonTest, self).tearDown()
+
+    def ask(self, command):
+        self.client.sock.sendall(json.dumps({ 'command': command }) + '\n')
+        return self.receive()
+
+    def receive(self):
+        for i in range(5):
+            self.daemon.step(0)
+        return self.client.read()
+
+    def test_status_and_times_are_answered(self):
+        self.assertEquals(self.ask('status'), { 'status': 'IDLE' })
+        self.set_now(1000)
+        self.daemon.monitor.notify(self.testfile)
+        self.set_now(1060)
+        self.daemon.monitor.notify(self.testfile)
+        self.assertEquals(self.ask('repositories'), { 'repositories': { 'testrepo': 60 } })
+        self.assertEquals(self.ask('commits'), { 'commits': [] })
+        self.assertTrue('counters' in self.ask('stats'))
+        self.assertTrue('error' in self.ask('shutdown'))
+
+    def test_subscribers_are_pushed_status_and_commits(self):
+        self.assertEquals(self.ask('subscribe'), { 'event': 'status', 'status': 'IDLE' })
+
+        open(self.testfile, 'w').write('hello')
+        self.assertEquals(self.receive(), { 'event': 'status', 'status': 'Working on testrepo' })
+
+        commit_id, blob_id = self.make_commit()
+        event = self.receive()
+        while event['event'] != 'commit':
+            event = self.receive()
+        self.assertEquals((event['repository'], event['commit']), ('testrepo', commit_id))
+        self.assertEquals([ commit['commit'] for commit in self.ask('commits')['commits'] ], [commit_id])
+
+    def test_only_one_daemon_runs(self):
+        self.assertRaises(RuntimeError, Daemon, self.daemon.monitor, self.socket)
+        self.client.close()
+        self.daemon.close()
+        self.assertFalse(os.path.exists(self.socket))
+
+        # A socket left behind by a crash is taken over
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(self.socket)
+        stale.close()
+        self.daemon = Daemon(RepositorySet(self.basedir), self.socket)
+        self.client = Client(self.socket)
+        self.assertEquals(self.ask('status'), { 'status': 'IDLE' })
+
+class SessionsTest(BaseTest):
+
+    def setUp(self):
+        super(SessionsTest, self).setUp()
+        self.closed = []
+        self.sessions = Sessions(300, lambda *session: self.closed.append(session))
+
+    def test_sessions_close_a_heartbeat_after_their_last_event(self):
+        for now in range(0, 250, 10):
+            self.sessions.touch('repo1', now)
+        self.sessions.touch('repo2', 100)
+        # Events only move the session along, the heap keeps one deadline per session
+        self.assertEquals(len(self.sessions.heap), 2)
+
+        self.sessions.expire(400)
+        self.assertEquals(self.closed, [])
+        self.assertEquals(self.sessions.next_deadline(), 400)
+        self.sessions.expire(401)
+        self.assertEquals(self.closed, [('repo2', 100, 100)])
+        self.sessions.expire(540)
+        self.assertEquals(self.closed, [('repo2', 100, 100)])
+        self.sessions.expire(540.5)
+        self.assertEquals(self.closed, [('repo2', 100, 100), ('repo1', 0, 240)])
+        self.assertEquals(len(self.sessions), 0)
+        self.assertEquals(self.sessions.next_deadline(), None)
+
+    def test_late_event_starts_a_new_session(self):
+        self.sessions.touch('repo1', 0)
+        self.sessions.touch('repo1', 301)
+        self.assertEquals(self.closed, [('repo1', 0, 0)])
+        self.sessions.expire(602)
+        self.assertEquals(self.closed, [('repo1', 0, 0), ('repo1', 301, 301)])
+
+    def test_clock_going_back_closes_sessions_in_the_future(self):
+        self.sessions.touch('repo1', 1000)
+        self.sessions.touch('repo2', 100)
+        self.sessions.expire(300)
+        self.sessions.expire(200)
+        self.assertEquals(self.closed, [('repo1', 1000, 1000)])
+        self.sessions.touch('repo1', 210)
+        self.sessions.expire(1301)
+        self.assertEquals(sorted(self.closed), [('repo1', 210, 210), ('repo1', 1000, 1000), ('repo2', 100, 100)])
+
+    def test_status_is_idle_once_all_sessions_closed(self):
+        self.init_repo('repo1')
+        self.init_repo('repo2')
+        monitor = RepositorySet(self.basedir)
+        monitor.add_session_listener(lambda *session: self.closed.append(session))
+
+        self.set_now(1000)
+        monitor.notify('%s/repo1/file' % self.basedir, 'IN_CLOSE_WRITE')
+        self.set_now(1100)
+        monitor.notify('%s/repo2/file' % self.basedir, 'IN_CLOSE_WRITE')
+        self.assertEquals(monitor.live, set(['repo1', 'repo2']))
+
+        self.set_now(1000 + DEFAULT_HEARTBEAT + 1)
+        monitor.tick()
+        self.assertEquals(self.closed, [('repo1', 1000, 1000)])
+        self.assertEquals(monitor.status, 'Working on repo2')
+        # Flushed at the same time, so neither needs tick() anymore
+        self.assertEquals(monitor.live, set())
+
+        self.set_now(1100 + DEFAULT_HEARTBEAT + 1)
+        self.assertEquals(monitor.next_timeout(), 0)
+        monitor.tick()
+        self.assertEquals(monitor.status, 'IDLE')
+        self.assertEquals(monitor.metrics.counters['sessions'], 2)
+        self.assertEquals(monitor.next_timeout(), None)
+
+    def test_session_reopened_before_its_deadline_is_seen_keeps_status(self):
+        self.init_repo('repo1')
+        monitor = RepositorySet(self.basedir)
+        monitor.add_session_listener(lambda *session: self.closed.append(session))
+        self.set_now(1000)
+        monitor.notify('%s/repo1/file' % self.basedir, 'IN_CLOSE_WRITE')
+        # Back from suspend, the event comes before tick() expires the session
+        self.set_now(5000)
+        monitor.notify('%s/repo1/.git/index' % self.basedir, 'IN_CLOSE_WRITE')
+        self.assertEquals(self.closed, [('repo1', 1000, 1000)])
+        self.assertEquals(len(monitor.sessions), 1)
+        self.assertEquals(monitor.status, 'Working on repo1')
+
+class BackendTest(BaseTest):
+
+    def setUp(self):
+        super(BackendTest, self).setUp()
+        self.init_repo('repo1')
+        self.init_repo('testrepo')
+        self.testfile = '%s/testrepo/testfile' % self.basedir
+        self.polled = '%s/testrepo' % self.basedir
+
+    def test_repositories_can_be_polled(self):
+        monitor = RepositorySet(self.basedir, backends={ self.polled: BACKEND_POLL })
+        repo = monitor['testrepo']
+        self.assertTrue(monitor.wm.get_wd(self.polled) is None)
+        self.assertTrue(monitor.wm.get_wd('%s/repo1' % self.basedir) is not None)
+        self.assertEquals(len(monitor.filenos()), 1)
+
+        open(self.testfile, 'w').write('hello')
+        monitor.check()
+        self.assertEquals(len(repo.log), 1)
+
+        os.makedirs('%s/src/lib' % self.polled)
+        monitor.check()
+        self.assertTrue('%s/src/lib' % self.polled in monitor.watched)
+        open('%s/src/lib/module.py' % self.polled, 'w').close()
+        monitor.check()
+        self.assertEquals(len(repo.log), 3)
+
+        # Rewritten in place, the directory does not change
+        open('%s/src/lib/module.py' % self.polled, 'w').write('changed')
+        monitor.check()
+        self.assertEquals(len(repo.log), 4)
+        monitor.check()
+        self.assertEquals(len(repo.log), 4)
+
+        os.system('rm -rf %s/src' % self.polled)
+        monitor.check()
+        self.assertFalse('%s/src/lib' % self.polled in monitor.watched)
+        self.assertFalse('%s/src/lib' % self.polled in monitor.backend(BACKEND_POLL).snapshots)
+
+    def test_commits_are_detected_in_polled_repositories(self):
+        monitor = RepositorySet(self.basedir, backend=BACKEND_POLL)
+        self.assertEquals(monitor.filenos(), [])
+        commits = []
+        monitor.add_commit_listener(lambda *commit: commits.append(commit[:2]))
+        commit_id, blob_id = self.make_commit()
+        monitor.check()
+        self.assertEquals(commits, [('testrepo', commit_id)])
+
+    def test_polls_are_spaced_by_interval(self):
+        monitor = RepositorySet(self.basedir, backend=BACKEND_POLL)
+        backend = monitor.backend(BACKEND_POLL)
+        self.set_now(1000)
+        monitor.process()
+        self.assertEquals(monitor.next_timeout(), backend.interval)
+
+        open(self.testfile, 'w').write('hello')
+        self.set_now(1000 + backend.interval - 1)
+        monitor.process()
+        self.assertEquals(len(monitor['testrepo'].log), 0)
+        self.set_now(1000 + backend.interval)
+        monitor.process()
+        self.assertEquals(len(monitor['testrepo'].log), 1)
+
+    def test_fanotify_marks_whole_filesystems(self):
+        try:
+            FanotifyBackend(None).close()
+        except OSError:
+            self.skipTest('fanotify needs CAP_SYS_ADMIN')
+        monitor = RepositorySet(self.basedir, backends={ self.polled: BACKEND_FANOTIFY })
+        backend = monitor.backend(BACKEND_FANOTIFY)
+        self.assertEquals(len(backend.marks), 1)
+        self.assertEquals(len(monitor.filenos()), 2)
+
+        open(self.testfile, 'w').write('hello')
+        open('%s/elsewhere' % self.basedir, 'w').write('hello')
+        monitor.check()
+        # Created and written, merged in one event as fanotify does
+        self.assertEquals(len(monitor['testrepo'].log), 2)
+        self.assertTrue(monitor.metrics.counters['events.dropped.unwatched'] > 0)
+
+        os.makedirs('%s/src/lib' % self.polled)
+        monitor.check()
+        self.assertTrue('%s/src/lib' % self.polled in backend.directories)
+        os.rename('%s/src' % self.polled, '%s/source' % self.polled)
+        monitor.check()
+        self.assertFalse('%s/src/lib' % self.polled in backend.directories)
+        self.assertTrue('%s/source/lib' % self.polled in backend.directories)
+
+        commits = []
+        monitor.add_commit_listener(lambda *commit: commits.append(commit[:2]))
+        commit_id, blob_id = self.make_commit()
+        monitor.check()
+        self.assertEquals(commits, [('testrepo', commit_id)])
+        monitor.close()
+
+class WorklogTest(BaseTest):
+
+    def setUp(self):
+        super(WorklogTest, self).setUp()
+        self.init_repo('repo1')
+        self.logfile = '%s/repo1/.worklog' % self.basedir
+        generator = random.Random(42)
+        now = 10**9
+        log = open(self.logfile, 'w')
+        for i in range(5000):
+            now += generator.choice([1, 1, 1, 1, 1, 5, 30, 59, 120, 400, 2000, -50])
+            log.write('%.6f\n' % now)
+        log.close()
+        self.heartbeats = [60, 120, 300, 600, 3600]
+
+    def worked(self):
+        repo = Repository('%s/repo1' % self.basedir)
+        return [ round(repo.calculate_time(heartbeat), 6) for heartbeat in self.heartbeats ]
+
+    def test_compacted_log_gives_the_same_worked_time(self):
+        expected = self.worked()
+        swept = sweep_files([self.logfile], self.heartbeats)
+        lines = len(open(self.logfile).readlines())
+        Repository('%s/repo1' % self.basedir).compact()
+
+        self.assertTrue(len(open(self.logfile).readlines()) < lines / 2)
+        self.assertEquals(self.worked(), expected)
+        self.assertEquals([ round(total, 6) for total in sweep_files([self.logfile], self.heartbeats) ],
+                          [ round(total, 6) for total in swept ])
+
+    def test_appends_during_compaction_are_kept(self):
+        def append():
+            open(self.logfile, 'a').write('2000000000.000000\n')
+            return True
+        worklog.compact(self.logfile, threading.Lock(), append)
+        self.assertEquals(open(self.logfile).readlines()[-1], '2000000000.000000\n')
+        self.assertEquals(worklog.read(self.logfile)[-1], (2 * 10**9, 2 * 10**9))
+
+        # Cleared meanwhile, the compacted log would bring old activity back
+        open(self.logfile, 'w').write('%.6f\n' % 10**9)
+        self.assertFalse(worklog.compact(self.logfile, threading.Lock(), lambda: False))
+        self.assertEquals(open(self.logfile).read(), '%.6f\n' % 10**9)
+
+    def test_large_logs_are_compacted_by_the_monitor(self):
+        monitor = RepositorySet(self.basedir)
+        self.assertEquals(monitor.live, set(['repo1']))
+        monitor.tick()
+        self.assertTrue(' ' in open(self.logfile).readline())
+        self.assertEquals(monitor['repo1'].uncompacted, 0)
+        self.assertEquals(monitor.live, set())
+
+    def test_compacted_log_is_not_compacted_again(self):
+        Repository('%s/repo1' % self.basedir).compact()
+        intervals = worklog.read(self.logfile)
+        # Compacted, and still large
+        open(self.logfile, 'w').write(worklog.format_intervals(intervals * 50))
+        self.assertTrue(os.path.getsize(self.logfile) > COMPACTION_SIZE)
+        self.assertEquals(Repository('%s/repo1' % self.basedir).uncompacted, 0)
+
+        open(self.logfile, 'a').write('2000000000.000000\n2000000001.000000\n')
+        self.assertEquals(Repository('%s/repo1' % self.basedir).uncompacted, 36)
+
+    def test_sweep_refuses_heartbeats_below_the_gap(self):
+        self.assertRaises(SystemExit, trampometro.sweep.main, ['-H', '30,300', self.logfile])
+        self.assertRaises(SystemExit, trampometro.sweep.main, ['--from', '10', self.logfile])
+
+    def test_intervals_are_merged_only_within_the_gap(self):
+        intervals = worklog.parse('10.0\n20.0\n100.0 200.0\n250.0\n240.0\n')
+        self.assertEquals(worklog.merge(intervals, 60), [(10.0, 20.0), (100.0, 250.0), (240.0, 240.0)])
+        self.assertEquals(worklog.expand([(0.0, 150.0), (200.0, 200.0)], 60), [0.0, 60.0, 120.0, 150.0, 200.0])
+
+class BinaryLogTest(BaseTest):
+
+    def setUp(self):
+        super(BinaryLogTest, self).setUp()
+        self.init_repo('repo1')
+        self.repodir = '%s/repo1' % self.basedir
+
+    def notify(self, repo, *times):
+        for now in times:
+            self.set_now(now)
+            repo.notify()
+
+    def test_only_appended_records_are_decoded(self):
+        repo = Repository(self.repodir, log_format=WORKLOG_BINARY)
+        self.notify(repo, 1000, 1060, 1120)
+        self.assertEquals(repo.log, [1000, 1060, 1120])
+        self.assertEquals(os.path.getsize(repo.logfile), HEADER.size + 3 * 16)
+        records = repo.binary.records
+
+        self.notify(repo, 1180)
+        offset = repo.binary.offset
+        self.assertEquals(repo.log, [1000, 1060, 1120, 1180])
+        self.assertTrue(repo.binary.records is records)
+        self.assertEquals(repo.binary.offset, offset + 16)
+        self.assertEquals(repo.calculate_time(), 180)
+
+        repo.clear()
+        self.assertEquals(repo.log, [])
+        self.notify(repo, 5000)
+        self.assertEquals(repo.log, [5000])
+
+    def test_text_log_is_converted(self):
+        open('%s/.worklog' % self.repodir, 'w').write('1000.000000\n1100.000000\n1200.000000 1500.000000\n')
+        expected = Repository(self.repodir).calculate_time()
+        repo = Repository(self.repodir, log_format=WORKLOG_BINARY)
+        self.assertFalse(os.path.exists('%s/.worklog' % self.repodir))
+        self.assertEquals(repo.binary.intervals(), [(1000, 1000), (1100, 1100), (1200, 1500)])
+        self.assertEquals(repo.calculate_time(), expected)
+        self.assertEquals(sweep_files([repo.logfile], [DEFAULT_HEARTBEAT]), [expected])
+
+    def test_other_versions_are_left_alone(self):
+        logfile = '%s/.worklog.bin' % self.repodir
+        data = HEADER.pack(BINARY_MAGIC, 2) + 'records of a newer daemon'
+        open(logfile, 'wb').write(data)
+        self.assertRaises(ValueError, BinaryLog(logfile).append, [(1000, 1000)])
+        # The repository is still monitored, its activity is just not logged
+        monitor = RepositorySet(self.basedir, log_format=WORKLOG_BINARY)
+        repo = monitor['repo1']
+        self.assertTrue(repo.refused)
+        self.notify(repo, 1000, 1060)
+        repo.flush()
+        repo.compact()
+        repo.clear()
+        self.assertEquals(repo.log, [])
+        self.assertEquals(open(logfile, 'rb').read(), data)
+
+        open(logfile, 'wb').write('1000.000000\n')
+        self.assertRaises(ValueError, BinaryLog(logfile).read)
+
+    def test_only_events_to_merge_count_as_uncompacted(self):
+        repo = Repository(self.repodir, log_format=WORKLOG_BINARY)
+        self.notify(repo, *range(1000, 1600, 10))
+        repo.flush()
+        self.assertEquals(Repository(self.repodir, log_format=WORKLOG_BINARY).uncompacted, 59 * 16)
+        repo.compact()
+        # Events far apart merge with nothing
+        self.notify(repo, 5000, 6000)
+        repo.flush()
+        self.assertEquals(Repository(self.repodir, log_format=WORKLOG_BINARY).uncompacted, 0)
+
+    def test_log_rewritten_by_another_version_is_no_longer_written(self):
+        repo = Repository(self.repodir, log_format=WORKLOG_BINARY)
+        self.notify(repo, 1000)
+        repo.flush()
+        data = HEADER.pack(BINARY_MAGIC, 2) + 'records of a newer daemon'
+        open(repo.logfile, 'wb').write(data)
+
+        self.notify(repo, 1060)
+        repo.flush()
+        self.assertTrue(repo.refused)
+        self.assertEquals(repo.buffer, [])
+        self.notify(repo, 1120)
+        repo.flush()
+        self.assertEquals(open(repo.logfile, 'rb').read(), data)
+
+    def test_log_rewritten_by_another_version_is_refused_on_commit(self):
+        # make_commit works in testrepo
+        os.rename(self.repodir, '%s/testrepo' % self.basedir)
+        self.testfile = '%s/testrepo/testfile' % self.basedir
+        monitor = RepositorySet(self.basedir, log_format=WORKLOG_BINARY)
+        repo = monitor['testrepo']
+        self.set_now(1000)
+        monitor.notify(self.testfile)
+        self.set_now(1060)
+        monitor.notify(self.testfile)
+        repo.flush()
+        data = HEADER.pack(BINARY_MAGIC, 2) + 'records of a newer daemon'
+        open(repo.logfile, 'wb').write(data)
+
+        # Worked time comes from memory, clearing is the first to see the log
+        commit_id, blob_id = self.make_commit()
+        monitor.commit('testrepo', commit_id)
+        self.assertTrue(repo.refused)
+        self.assertEquals(open(repo.logfile, 'rb').read(), data)
+        self.assertTrue('00:01:00' in [ line.strip() for line in open('meta/worklog') ])
+
+    def test_binary_log_is_compacted(self):
+        repo = Repository(self.repodir, log_format=WORKLOG_BINARY)
+        self.notify(repo, *range(1000, 1600, 10) + range(5000, 5100, 30))
+        expected = [ repo.calculate_time(heartbeat) for heartbeat in (60, 300) ]
+        # Read before compaction, the new file must be read from the start
+        repo.log
+        repo.compact()
+        self.assertEquals(repo.binary.intervals(), [(1000, 1590), (5000, 5090)])
+
+        self.notify(repo, 5100)
+        repo = Repository(self.repodir, log_format=WORKLOG_BINARY)
+        self.assertEquals([ repo.calculate_time(heartbeat) for heartbeat in (60, 300) ],
+                          [ total + 10 for total in expected ])
+
+class ShardTest(BaseTest):
+
+    def setUp(self):
+        super(ShardTest, self).setUp()
+        for name in ('repo1', 'repo2', 'repo3', 'repo4'):
+            self.init_repo(name)
+        self.coordinator = Coordinator(self.basedir, 2)
+        self.statuses = []
+        self.coordinator.add_listener(self.statuses.append)
+
+    def tearDown(self):
+        self.coordinator.close()
+        super(ShardTest, self).tearDown()
+
+    def wait_for(self, condition):
+        for i in range(100):
+            self.coordinator.process()
+            if condition():
+                return
+            time.sleep(0.05)
+        self.fail('timed out')
+
+    def worker_of(self, name):
+        path = '%s/%s' % (os.path.realpath(self.basedir), name)
+        return self.coordinator.workers[shard_of(path, 2)]
+
+    def test_shard_of_is_stable(self):
+        self.assertEquals(shard_of('/home/user/devel/project', 7), shard_of('/home/user/devel/project', 7))
+        self.assertEquals(set([ shard_of('/devel/project%d' % i, 4) for i in range(100) ]), set(range(4)))
+
+    def test_repositories_are_split_across_workers(self):
+        workers = self.coordinator.workers
+        self.assertEquals(sorted(workers[0].repositories.keys() + workers[1].repositories.keys()),
+                          ['repo1', 'repo2', 'repo3', 'repo4'])
+        self.assertNotEquals(workers[0].process.pid, workers[1].process.pid)
+        self.assertEquals(sorted(self.coordinator.worked()), ['repo1', 'repo2', 'repo3', 'repo4'])
+        stats = self.coordinator.stats()
+        self.assertEquals(stats['gauges']['repositories'], 4)
+        self.assertEquals(stats['gauges']['shards'], 2)
+
+    def test_status_is_merged(self):
+        open('%s/repo1/testfile' % self.basedir, 'w').write('hello')
+        self.wait_for(lambda: self.coordinator.status == 'Working on repo1')
+        open('%s/repo3/testfile' % self.basedir, 'w').write('hello')
+        self.wait_for(lambda: self.coordinator.status == 'Working on repo3')
+        self.assertEquals(self.statuses, ['Working on repo1', 'Working on repo3'])
+        self.assertEquals(self.coordinator.stats()['counters']['events.IN_CLOSE_WRITE'], 2)
+
+    def test_new_repositories_go_to_their_worker(self):
+        self.init_repo('repo5')
+        self.coordinator.rescan()
+        self.assertEquals(self.worker_of('repo5').repositories['repo5'],
+                          '%s/repo5' % os.path.realpath(self.basedir))
+        self.assertTrue('repo5' in self.coordinator.worked())
+        open('%s/repo5/testfile' % self.basedir, 'w').write('hello')
+        self.wait_for(lambda: self.coordinator.status == 'Working on repo5')
+
+        os.system('rm -rf %s/repo5' % self.basedir)
+        self.coordinator.rescan()
+        self.assertFalse('repo5' in self.worker_of('repo5').repositories)
+        self.assertFalse('repo5' in self.coordinator.worked())
+
+    def test_broken_repository_is_skipped_by_its_worker(self):
+        self.coordinator.close()
+        self.init_repo('broken')
+        open('%s/broken/.worklog' % self.basedir, 'w').write('garbage\n')
+        self.coordinator = Coordinator(self.basedir, 2)
+        worker = self.worker_of('broken')
+        self.assertTrue('broken' in worker.repositories)
+        self.assertEquals(sorted(self.coordinator.worked()), ['repo1', 'repo2', 'repo3', 'repo4'])
+
+        # The others in its shard are still watched
+        name = [ name for name in worker.repositories if name != 'broken' ][0]
+        open('%s/%s/testfile' % (self.basedir, name), 'w').write('hello')
+        self.wait_for(lambda: self.coordinator.status == 'Working on %s' % name)
+
+    def test_worker_failing_to_start_is_started_later(self):
+        self.coordinator.close()
+        fake = fudge.Fake('RepositorySet', callable=True).raises(OSError('no watches left'))
+        patch = fudge.patch_object(trampometro.shard, 'RepositorySet', fake)
+        try:
+            self.coordinator = Coordinator(self.basedir, 2)
+            self.coordinator.process()
+        finally:
+            patch.restore()
+        self.assertEquals(self.coordinator.running(), [])
+        self.assertEquals(self.coordinator.metrics.counters['shards.failures'], 2)
+        self.assertEquals(self.coordinator.worked(), {})
+
+        for worker in self.coordinator.workers:
+            worker.retry = time.time() - 1
+        self.assertEquals(self.coordinator.next_timeout(), 0)
+        self.coordinator.process()
+        self.assertEquals(len(self.coordinator.running()), 2)
+        self.assertEquals(sorted(self.coordinator.worked()), ['repo1', 'repo2', 'repo3', 'repo4'])
+
+    def test_dead_worker_is_restarted(self):
+        worker = self.worker_of('repo1')
+        worker.process.terminate()
+        worker.process.join()
+        self.coordinator.process()
+        self.assertTrue(worker.process.is_alive())
+        self.assertEquals(self.coordinator.metrics.counters['shards.restarts'], 1)
+        open('%s/repo1/testfile' % self.basedir, 'w').write('hello')
+        self.wait_for(lambda: self.coordinator.status == 'Working on repo1')
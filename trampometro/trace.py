@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Traces of raw inotify events, to replay real workloads offline.
+
+A trace is MAGIC followed by one record per event: timestamp (double),
+mask (uint32) and path length (uint16), little endian, then the path.
+"""
+
+import os, sys, time, struct, shutil, tempfile, pyinotify
+from optparse import OptionParser
+
+MAGIC = 'TRMTRACE'
+RECORD = struct.Struct('<dIH')
+# Simulated seconds between ticks while replaying
+REPLAY_TICK = 1
+
+class TraceWriter(object):
+
+    def __init__(self, filename):
+        self.trace = open(filename, 'wb')
+        self.trace.write(MAGIC)
+
+    def record(self, timestamp, mask, path):
+        self.trace.write(RECORD.pack(timestamp, mask, len(path)))
+        self.trace.write(path)
+
+    def flush(self):
+        self.trace.flush()
+
+    def close(self):
+        self.trace.close()
+
+def read_trace(filename):
+    trace = open(filename, 'rb')
+    if trace.read(len(MAGIC)) != MAGIC:
+        raise ValueError('%s is not a trampometro trace' % filename)
+    while True:
+        header = trace.read(RECORD.size)
+        if len(header) < RECORD.size:
+            # The last record may be cut if the recording process died
+            return
+        timestamp, mask, length = RECORD.unpack(header)
+        path = trace.read(length)
+        if len(path) < length:
+            return
+        yield timestamp, mask, path
+
+def rewrite(path, prefixes):
+    for old, new in prefixes:
+        if path == old or path.startswith(old + '/'):
+            return new + path[len(old):]
+    return path
+
+def replay(filename, monitor, realtime=False, prefixes=()):
+    """
+    Feeds a trace to monitor.notify with time.time returning the recorded
+    timestamps, as fast as possible or, if realtime, at the recorded pace.
+    Returns the number of events and the real seconds it took.
+
+    Whatever the monitor does with them is done for real: main replays on
+    a dry run monitor with a temporary store, so no repository is touched.
+    """
+    real_time, sleep = time.time, time.sleep
+    now = [0]
+    time.time = lambda: now[0]
+    events = 0
+    last_tick = None
+    started = real_time()
+    try:
+        for timestamp, mask, path in read_trace(filename):
+            if realtime and last_tick is not None:
+                delay = (timestamp - first) - (real_time() - started)
+                if delay > 0:
+                    sleep(delay)
+            now[0] = timestamp
+            if last_tick is None:
+                first = last_tick = timestamp
+            elif not 0 <= timestamp - last_tick < REPLAY_TICK:
+                monitor.tick()
+                last_tick = timestamp
+            events += 1
+            if mask & pyinotify.IN_Q_OVERFLOW:
+                monitor.overflow()
+            elif mask & (pyinotify.IN_MOVE_SELF | pyinotify.IN_IGNORED):
+                # Only meaningful for the watch descriptors of the recording process
+                continue
+            else:
+                monitor.notify(rewrite(path, prefixes), pyinotify.EventsCodes.maskname(mask))
+        monitor.tick()
+        monitor.flush()
+    finally:
+        time.time = real_time
+    return events, real_time() - started
+
+def main(args):
+    from trampometro import RepositorySet
+    from trampometro.store import ActivityStore
+    parser = OptionParser(usage='%prog replay [options] trace development_dir [development_dir ...]')
+    parser.add_option('-r', '--realtime', action='store_true', default=False,
+                      help='replay at the recorded pace instead of as fast as possible')
+    parser.add_option('-m', '--map', action='append', default=[], metavar='OLD=NEW',
+                      help='replace a path prefix from the recording machine')
+    options, args = parser.parse_args(args)
+    if len(args) < 2:
+        parser.print_usage()
+        sys.exit(0)
+
+    prefixes = [ prefix.split('=', 1) for prefix in options.map ]
+    # Commits found are only counted and activity goes to a temporary store,
+    # so neither HEAD nor any .worklog changes
+    directory = tempfile.mkdtemp(prefix='trampometro-replay-')
+    try:
+        store = ActivityStore(os.path.join(directory, 'activity.db'), take_over=False)
+        monitor = RepositorySet(args[1:], store=store, dry_run=True)
+        try:
+            events, seconds = replay(args[0], monitor, options.realtime, prefixes)
+        finally:
+            monitor.close()
+    finally:
+        shutil.rmtree(directory)
+    commits = monitor.metrics.counters.get('commits', 0)
+    print "%d events in %.3fs, %.1f events/s, %d commits found" % (
+        events, seconds, events / seconds if seconds else 0, commits)
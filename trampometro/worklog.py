@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""
+The .worklog file of a repository. Events are appended one timestamp per
+line, and compaction replaces them with one 'start end' line per interval
+of events at most COMPACTION_GAP apart. Time worked is the same either way
+for any heartbeat of at least COMPACTION_GAP.
+
+.worklog.bin holds the same as BINARY_MAGIC and a version number followed
+by start and end of each interval as little endian doubles, equal for an
+event, so it is read without parsing and only from where it was left.
+"""
+
+import os, sys, mmap, struct
+from array import array
+
+COMPACTION_GAP = 60
+# Bytes of raw timestamps appended before a worklog is compacted
+COMPACTION_SIZE = 64 * 1024
+
+WORKLOG_TEXT = 'text'
+WORKLOG_BINARY = 'binary'
+
+BINARY_MAGIC = 'TRMLOG'
+# Logs of any other version are neither read nor written
+BINARY_VERSION = 1
+HEADER = struct.Struct('<6sH')
+RECORD = struct.Struct('<dd')
+
+def parse(data):
+    # (start, end) of each line in log order, a lone timestamp being (t, t)
+    intervals = []
+    for line in data.splitlines():
+        fields = line.split()
+        if len(fields) == 1:
+            timestamp = float(fields[0])
+            intervals.append((timestamp, timestamp))
+        elif len(fields) == 2:
+            intervals.append((float(fields[0]), float(fields[1])))
+    return intervals
+
+def read(filename):
+    try:
+        return parse(open(filename).read())
+    except IOError:
+        return []
+
+def merge(intervals, gap=COMPACTION_GAP):
+    # Going back in time always ends an interval, as it ends a session
+    merged = []
+    for start, end in intervals:
+        if merged and 0 <= start - merged[-1][1] <= gap:
+            merged[-1][1] = end
+        else:
+            merged.append([start, end])
+    return [ tuple(interval) for interval in merged ]
+
+def expand(intervals, step=COMPACTION_GAP):
+    # Timestamps no more than step apart standing for each interval, for
+    # whatever only takes a flat list of events
+    timestamps = []
+    for start, end in intervals:
+        timestamps.append(start)
+        timestamp = start + step
+        while timestamp < end:
+            timestamps.append(timestamp)
+            timestamp += step
+        if end != start:
+            timestamps.append(end)
+    return timestamps
+
+def format_intervals(intervals):
+    return ''.join([ '%.6f %.6f\n' % interval for interval in intervals ])
+
+def uncompacted(filename):
+    # Bytes of raw timestamps after the last compacted line, read from the end
+    try:
+        log = open(filename)
+    except IOError:
+        return 0
+    log.seek(0, os.SEEK_END)
+    position = log.tell()
+    tail = ''
+    while position > 0 and ' ' not in tail:
+        step = min(4096, position)
+        position -= step
+        log.seek(position)
+        tail = log.read(step) + tail
+    log.close()
+    if ' ' not in tail:
+        return len(tail)
+    newline = tail.find('\n', tail.rindex(' '))
+    return len(tail) - newline - 1 if newline >= 0 else 0
+
+def compact(filename, lock, unchanged=lambda: True):
+    """
+    Rewrites filename as merged intervals. Reading and merging are done
+    without lock, so appends go on meanwhile; what was appended is copied
+    as it is when the new file is put in place, under lock, and nothing
+    is written if unchanged() says the log was cleared in between.
+    """
+    try:
+        data = open(filename).read()
+    except IOError:
+        return False
+    # A line still being appended is left for the tail
+    data = data[:data.rfind('\n') + 1]
+    intervals = merge(parse(data))
+    with lock:
+        if not unchanged():
+            return False
+        log = open(filename)
+        log.seek(len(data))
+        tail = log.read()
+        log.close()
+        tmp = '%s.tmp' % filename
+        compacted = open(tmp, 'w')
+        compacted.write(format_intervals(intervals))
+        compacted.write(tail)
+        compacted.close()
+        os.rename(tmp, filename)
+    return True
+
+class BinaryLog(object):
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.reset()
+
+    def reset(self):
+        # Records decoded so far, as start, end, start, end...
+        self.records = array('d')
+        self.offset = HEADER.size
+        self.inode = None
+
+    def check(self, log):
+        # False for a new, empty log
+        header = log.read(HEADER.size)
+        if not header:
+            return False
+        if len(header) < HEADER.size or HEADER.unpack(header)[0] != BINARY_MAGIC:
+            raise ValueError('%s is not a trampometro log' % self.filename)
+        version = HEADER.unpack(header)[1]
+        if version != BINARY_VERSION:
+            raise ValueError('%s is a version %d log, this trampometro only knows version %d'
+                             % (self.filename, version, BINARY_VERSION))
+        return True
+
+    def append(self, intervals):
+        records = array('d')
+        for start, end in intervals:
+            records.append(start)
+            records.append(end)
+        if sys.byteorder == 'big':
+            records.byteswap()
+        log = open(self.filename, 'ab+')
+        try:
+            log.seek(0)
+            if not self.check(log):
+                log.write(HEADER.pack(BINARY_MAGIC, BINARY_VERSION))
+            else:
+                # Whatever a crash left of a record would shift all that follows
+                size = os.fstat(log.fileno()).st_size
+                log.truncate(size - (size - HEADER.size) % RECORD.size)
+            log.write(records.tostring())
+        finally:
+            log.close()
+
+    def read(self):
+        try:
+            log = open(self.filename, 'rb')
+        except IOError:
+            self.reset()
+            return self.records
+        try:
+            info = os.fstat(log.fileno())
+            if info.st_ino != self.inode or info.st_size < self.offset:
+                # Compacted or cleared since last read
+                self.reset()
+                self.inode = info.st_ino
+            if not self.check(log):
+                return self.records
+            end = info.st_size - (info.st_size - HEADER.size) % RECORD.size
+            if end > self.offset:
+                data = mmap.mmap(log.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    records = array('d')
+                    records.fromstring(buffer(data, self.offset, end - self.offset))
+                finally:
+                    data.close()
+                if sys.byteorder == 'big':
+                    records.byteswap()
+                self.records.extend(records)
+                self.offset = end
+        finally:
+            log.close()
+        return self.records
+
+    def intervals(self):
+        records = self.read()
+        return zip(records[0::2], records[1::2])
+
+    def uncompacted(self):
+        # Bytes of the trailing events compaction would merge away; those of
+        # a compacted log are more than COMPACTION_GAP apart
+        records = self.read()
+        count = 0
+        for i in range(len(records) - 2, 0, -2):
+            start, end = records[i], records[i + 1]
+            if start != end or not 0 <= start - records[i - 1] <= COMPACTION_GAP:
+                break
+            count += 1
+        return count * RECORD.size
+
+    def clear(self):
+        try:
+            log = open(self.filename, 'rb+')
+        except IOError:
+            return
+        try:
+            if self.check(log):
+                log.truncate(HEADER.size)
+        finally:
+            log.close()
+        self.reset()
+
+def compact_binary(filename, lock, unchanged=lambda: True):
+    # As compact, for a BinaryLog
+    if not os.path.exists(filename):
+        return False
+    log = BinaryLog(filename)
+    intervals = merge(log.intervals())
+    with lock:
+        if not unchanged():
+            return False
+        data = open(filename, 'rb')
+        data.seek(log.offset)
+        tail = data.read()
+        data.close()
+        tmp = '%s.tmp' % filename
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        BinaryLog(tmp).append(intervals)
+        compacted = open(tmp, 'ab')
+        compacted.write(tail)
+        compacted.close()
+        os.rename(tmp, filename)
+    return True
+
+def convert(text, binary):
+    # Moves the events of a text log to the end of a binary one
+    intervals = read(text)
+    if intervals:
+        BinaryLog(binary).append(intervals)
+    os.remove(text)
+
+def main(args):
+    from trampometro import find_repositories
+    if not args:
+        print "Usage: trampometro convert development_dir [development_dir ...]"
+        sys.exit(0)
+    for path in find_repositories([ os.path.realpath(path) for path in args ]):
+        text = os.path.join(path, '.worklog')
+        if os.path.exists(text):
+            convert(text, '%s.bin' % text)
+            print "Converted %s" % text